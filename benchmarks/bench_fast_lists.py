@@ -0,0 +1,78 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+# Unit list conversion and JSON encoding, the boto3 resource layer
+# against the DYNAMODB_FAST_LISTS path. Both start from a parsed Query
+# response, the resource side runs boto3's own output transformation so
+# it pays what a real table.query() does. No network involved.
+# Run from the top level: python3 benchmarks/bench_fast_lists.py
+
+import os
+import sys
+import copy
+import json
+import base64
+import random
+import decimal
+import timeit
+
+import boto3
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+from boto3.dynamodb.transform import TransformationInjector
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('TOKEN_SECRET', str(base64.b64encode(b'benchmark'*8), 'utf-8'))
+
+from web.models import DecimalEncoder # pylint: disable=wrong-import-position
+from web.rest import compile_schema, MemberSchema, PageLogSchema # pylint: disable=wrong-import-position
+
+
+def members(rand, i):
+    return {'member_id':10000+i, 'name':'Member {}'.format(i), 'unit':'bench',
+            'roles':set(rand.sample(['unit-admin', 'contact-maintainer', 'none', 'pager'], 2))}
+
+
+def pages(rand, i):
+    return {'phone_number':'614{:08d}'.format(i), 'unit':'bench', 'body':'Page body {}'.format(i),
+            'timestamp':decimal.Decimal('{:.6f}'.format(1500000000 + rand.random() * 1e7))}
+
+
+def wire_response(gen, count):
+    rand = random.Random(count)
+    serializer = TypeSerializer()
+    items = [{k:serializer.serialize(v) for (k, v) in gen(rand, i).items()} for i in range(count)]
+    return {'Items':items, 'Count':count, 'ScannedCount':count}
+
+
+def main():
+    client = boto3.client('dynamodb', region_name='ap-southeast-2',
+                          aws_access_key_id='bench', aws_secret_access_key='bench')
+    query_model = client.meta.service_model.operation_model('Query')
+    injector = TransformationInjector(deserializer=TypeDeserializer())
+
+    def resource_path(response):
+        # The transformation edits the response in place
+        parsed = copy.deepcopy(response)
+        injector.inject_attribute_value_output(parsed, query_model)
+        return json.dumps(parsed['Items'], cls=DecimalEncoder)
+
+    def fast_path(response, python_item):
+        parsed = copy.deepcopy(response)
+        return json.dumps([python_item(item) for item in parsed['Items']], cls=DecimalEncoder)
+
+    print("{:>10} {:>8} {:>12} {:>12} {:>8}".format('list', 'items', 'resource ms', 'fast ms', 'speedup'))
+    for (name, gen, schema) in (('members', members, MemberSchema), ('pagelog', pages, PageLogSchema)):
+        python_item = compile_schema(schema).python_item
+        for count in (1000, 10000):
+            response = wire_response(gen, count)
+            assert(json.loads(resource_path(response)) is not None)
+            copy_time = min(timeit.repeat(lambda: copy.deepcopy(response), number=1, repeat=3))
+            slow = min(timeit.repeat(lambda: resource_path(response), number=1, repeat=5)) - copy_time
+            fast = min(timeit.repeat(lambda: fast_path(response, python_item), number=1, repeat=5)) - copy_time
+            print("{:>10} {:>8} {:>12.1f} {:>12.1f} {:>7.1f}x".format(
+                name, count, slow * 1e3, fast * 1e3, slow / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+# Member name search, index build and lookup times for large units.
+# Run from the top level: python3 benchmarks/bench_member_search.py
+
+import os
+import sys
+import base64
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('TOKEN_SECRET', str(base64.b64encode(b'benchmark'*8), 'utf-8'))
+
+from web.search import PrefixIndex, normalise # pylint: disable=wrong-import-position
+
+FIRST = ['Jane', 'John', 'José', 'Mary', 'Ahmed', 'Li', 'Zoë', 'Peter', 'Aroha', 'Sam']
+LAST = ['Smith', 'Jones', 'Ávila', 'Nguyen', 'Williams', 'Brown', 'Taylor', 'Singh', 'Kelly', 'Ngata']
+
+
+def gen_members(count):
+    rand = random.Random(count)
+    return [{'member_id':i, 'unit':'bench',
+             'name':'{} {}{}'.format(rand.choice(FIRST), rand.choice(LAST), rand.randint(0, 999))}
+            for i in range(count)]
+
+
+def main():
+    print("{:>8} {:>10} {:>12}".format('members', 'build ms', 'search us'))
+    for count in (100, 1000, 5000, 20000):
+        members = gen_members(count)
+        index = PrefixIndex('name', 300)
+        build = min(timeit.repeat(lambda: index.build('bench', members, 0), number=1, repeat=3))
+        built = index.get('bench')
+        queries = [normalise(q) for q in ('j', 'smi', 'ávila4', 'ngata 12', 'zo')]
+        number = 2000
+        search = min(timeit.repeat(lambda: [built.search(q, 25) for q in queries],
+                                   number=number, repeat=3)) / (number * len(queries))
+        print("{:>8} {:>10.1f} {:>12.1f}".format(count, build * 1e3, search * 1e6))
+
+
+if __name__ == '__main__':
+    main()
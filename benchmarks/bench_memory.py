@@ -0,0 +1,163 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+# Peak memory per request phase of the unit member list against unit
+# size, using the web.memory tracing. moto_server runs in its own
+# process so its allocations aren't counted in the query phase.
+#
+# Run from the top level: python3 benchmarks/bench_memory.py
+# As a regression guard, --max-per-member fails the run when the peak
+# for any size exceeds that many bytes per member, and --json writes
+# the results for comparison between runs.
+
+import os
+import sys
+import time
+import json
+import base64
+import signal
+import socket
+import logging
+import argparse
+import subprocess
+
+import jwt
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+STAGE = 'bench'
+SECRET = b'benchmark'*8
+SIZES = (100, 1000, 5000, 20000)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_moto(port):
+    proc = subprocess.Popen([sys.executable, '-m', 'moto.server', '-p', str(port)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("moto_server did not start")
+
+
+def seed(dynamodb, unit, count):
+    resource = dynamodb.thread_dynamodb()
+    resource.Table(dynamodb.gen_table_name(STAGE, 'unit')).put_item(Item={'name':unit, 'capcode':count})
+    table = resource.Table(dynamodb.gen_table_name(STAGE, 'member'))
+    with table.batch_writer() as batch:
+        for i in range(count):
+            batch.put_item(Item={
+                'member_id' : 100000 * len(str(count)) + i,
+                'name' : 'Member {} of {}'.format(i, unit),
+                'unit' : unit,
+                'roles' : json.dumps(['unit-admin']),
+            })
+
+
+def token(unit):
+    claims = {
+        'member_id' : 1,
+        'name' : 'Memory Bench',
+        'unit' : unit,
+        'roles' : [],
+        'permissions' : ['member-read'],
+        'iss' : 'sms-page',
+        'exp' : int(time.time()) + 3600,
+    }
+    return str(jwt.encode(claims, SECRET, algorithm='HS256'), 'utf-8')
+
+
+class Reports(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.reports = []
+
+    def emit(self, record):
+        if hasattr(record, 'memory'):
+            self.reports.append(record.memory)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('sizes', nargs='*', type=int, default=SIZES, help='members per unit')
+    parser.add_argument('--max-per-member', type=float, help='fail above this many peak bytes per member')
+    parser.add_argument('--json', help='also write the results here')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    port = free_port()
+    proc = start_moto(port)
+    try:
+        # Both read their configuration on import
+        os.environ.update(DYNAMODB_ENDPOINT='http://127.0.0.1:{}'.format(port), STAGE=STAGE,
+                          MEMORY_PROFILING='1', TOKEN_SECRET=str(base64.b64encode(SECRET), 'utf-8'))
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        sys.path.insert(0, TOP)
+        import dynamodb # pylint: disable=import-outside-toplevel
+        import web # pylint: disable=import-outside-toplevel
+
+        dynamodb.create(STAGE)
+        handler = Reports()
+        logger = logging.getLogger('web.memory')
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        client = web.app.test_client()
+
+        def get_members(unit):
+            web.ratelimit.buckets.clear()
+            resp = client.get('/rest/unit/{}/members'.format(unit), headers={
+                'Authorization':'Bearer ' + token(unit), 'Cache-Control':'no-cache'})
+            if resp.status_code != 200:
+                raise RuntimeError("{} returned {}".format(unit, resp.status_code))
+            return handler.reports[-1]
+
+        # The first request loads botocore's service model and so on
+        seed(dynamodb, 'Warm', 1)
+        get_members('Warm')
+
+        print("{:>8} {:>10} {:>10} {:>10} {:>12} {:>10} {:>10}".format(
+            'members', 'peak KiB', 'B/member', 'query', 'deserialize', 'encode', 'respond'))
+        results = []
+        failed = False
+        for count in args.sizes:
+            unit = 'Unit{}'.format(count)
+            seed(dynamodb, unit, count)
+            report = get_members(unit)
+            phases = {name:values['peak'] for (name, values) in report['phases'].items()}
+            per_member = report['peak'] / count
+            print("{:>8} {:>10.0f} {:>10.0f} {:>10.0f} {:>12.0f} {:>10.0f} {:>10.0f}".format(
+                count, report['peak'] / 1024, per_member, phases['query'] / 1024,
+                phases['deserialize'] / 1024, phases['encode'] / 1024, phases['respond'] / 1024))
+            results.append({'members':count, 'peak':report['peak'], 'per_member':per_member,
+                            'phases':report['phases']})
+            if args.max_per_member and per_member > args.max_per_member:
+                failed = True
+        print("Phase columns are KiB")
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=1)
+        if failed:
+            raise SystemExit("Peak above {} bytes per member".format(args.max_per_member))
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait()
+
+
+if __name__ == '__main__':
+    main()
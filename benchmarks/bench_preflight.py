@@ -0,0 +1,89 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+# Middleware overhead, the separate CORS and auth layers the app used to
+# stack against the combined EdgeMiddleware, called directly as WSGI apps.
+# Run from the top level: python3 benchmarks/bench_preflight.py
+
+import os
+import sys
+import time
+import base64
+import timeit
+import functools
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('TOKEN_SECRET', str(base64.b64encode(b'benchmark'*8), 'utf-8'))
+
+import jwt # pylint: disable=wrong-import-position
+from flask import Flask # pylint: disable=wrong-import-position
+from werkzeug.test import EnvironBuilder # pylint: disable=wrong-import-position
+
+import web # pylint: disable=wrong-import-position
+from web.authenticate import AuthMiddleware, token_secret # pylint: disable=wrong-import-position
+
+
+class CORSMiddleware:
+    # Baseline, the CORS layer EdgeMiddleware replaced. Every request,
+    # preflights included, went through Flask.
+    def __init__(self, wrapapp):
+        self.app = wrapapp
+
+    def __call__(self, environ, start_response):
+        def custom_start_response(status, headers, exc_info=None):
+            headers.extend(web.CORS_HEADERS)
+            return start_response(status, headers, exc_info)
+        return self.app(environ, custom_start_response)
+
+
+def start_response(status, headers, exc_info=None):
+    return None
+
+
+def environ_for(method, path, headers):
+    builder = EnvironBuilder(method=method, path=path, headers=headers)
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+
+def call(stack, environ):
+    body = stack(dict(environ), start_response)
+    for _ in body:
+        pass
+    if hasattr(body, 'close'):
+        body.close()
+
+
+def main():
+    flask_app = functools.partial(Flask.wsgi_app, web.app)
+    stacks = {
+        'separate' : AuthMiddleware(CORSMiddleware(flask_app), skip_paths=['/metrics']),
+        'combined' : web.EdgeMiddleware(flask_app, skip_paths=web.public_paths),
+    }
+    token = str(jwt.encode({'member_id':1, 'iss':'sms-page', 'exp':int(time.time())+3600},
+                           token_secret, algorithm='HS256'), 'utf-8')
+    requests = {
+        'preflight' : environ_for('OPTIONS', '/rest/unit/test/members', {
+            'Origin':'https://example.org',
+            'Access-Control-Request-Method':'GET',
+            'Access-Control-Request-Headers':'authorization',
+        }),
+        'public GET /' : environ_for('GET', '/', {'Authorization':'Bearer '+token}),
+    }
+
+    number = 2000
+    print("{:<14} {:>14} {:>14} {:>8}".format('request', 'separate us', 'combined us', 'speedup'))
+    for (name, environ) in requests.items():
+        times = {}
+        for (stack_name, stack) in stacks.items():
+            best = min(timeit.repeat(lambda: call(stack, environ), number=number, repeat=5))
+            times[stack_name] = best / number * 1e6
+        print("{:<14} {:>14.1f} {:>14.1f} {:>7.1f}x".format(
+            name, times['separate'], times['combined'], times['separate'] / times['combined']))
+
+
+if __name__ == '__main__':
+    main()
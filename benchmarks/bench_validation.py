@@ -0,0 +1,78 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+# Validation throughput, per request schema setup against the compiled
+# schemas used by DynamoResource.
+# Run from the top level: python3 benchmarks/bench_validation.py
+# No database is needed, the unit existence check is pre-seeded.
+
+import os
+import sys
+import time
+import base64
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('TOKEN_SECRET', str(base64.b64encode(b'benchmark'*8), 'utf-8'))
+
+import marshmallow # pylint: disable=wrong-import-position
+from web import rest # pylint: disable=wrong-import-position
+
+rest.ExistingUnit.known_units['Bellarine'] = float('inf')
+
+
+def gen_contact(i):
+    return {'phone_number':'614{:08d}'.format(i), 'unit':'Bellarine', 'member_id':str(i)}
+
+
+def uncompiled_single(item):
+    # As single_put worked before compiled schemas
+    rest.ContactSchema(strict=True).validate(item)
+    for name, field in rest.ContactSchema._declared_fields.items():
+        if isinstance(field, marshmallow.fields.Integer):
+            item[name] = int(item.get(name))
+
+
+def uncompiled_batch(items):
+    for item in items:
+        uncompiled_single(item)
+
+
+def compiled_single(item):
+    compiled = rest.compile_schema(rest.ContactSchema)
+    compiled.validate(item)
+    compiled.cast_item(item)
+
+
+def compiled_batch(items):
+    compiled = rest.compile_schema(rest.ContactSchema)
+    compiled.validate(items, many=True)
+    for item in items:
+        compiled.cast_item(item)
+
+
+def report(name, func, make_arg, items_per_call, repeat=5):
+    number = max(1, 2000 // items_per_call)
+    best = min(timeit.repeat(lambda: func(make_arg()), number=number, repeat=repeat))
+    rate = number * items_per_call / best
+    print("{:<24} {:>12,.0f} items/s".format(name, rate))
+    return rate
+
+
+def main():
+    print("Validation throughput, best of 5")
+    single = gen_contact(1)
+    batch = [gen_contact(i) for i in range(1000)]
+    old = report('single, per request', uncompiled_single, lambda: dict(single), 1)
+    new = report('single, compiled', compiled_single, lambda: dict(single), 1)
+    print("  speedup {:.2f}x".format(new / old))
+    old = report('1k batch, per item', uncompiled_batch, lambda: [dict(i) for i in batch], 1000)
+    new = report('1k batch, compiled', compiled_batch, lambda: [dict(i) for i in batch], 1000)
+    print("  speedup {:.2f}x".format(new / old))
+
+
+if __name__ == '__main__':
+    start = time.monotonic()
+    main()
+    print("Completed in {:.1f}s".format(time.monotonic() - start))
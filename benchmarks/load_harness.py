@@ -0,0 +1,386 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+# Scenario load test against a local DynamoDB stand-in.
+#
+# Starts moto_server (or uses --endpoint, eg. DynamoDB Local), creates
+# and seeds a 'load' stage, starts serve.py against it, then runs
+# virtual users through weighted scenarios for a fixed time.
+# Throughput, error rates and latency percentiles are reported for each
+# scenario and each request within it.
+#
+# Run from the top level:
+#   python3 benchmarks/load_harness.py --scale small --concurrency 32
+#   python3 benchmarks/load_harness.py --scale full --endpoint http://localhost:8000
+# The full scale writes two million page log rows, moto keeps those in
+# memory so use DynamoDB Local for it.
+#
+# Each scenario iteration acts as a random seeded member, so the per
+# member rate limits only trip when a scale is small for the concurrency.
+# Refusals are reported separately from errors.
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import signal
+import socket
+import argparse
+import threading
+import subprocess
+import http.client
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import jwt
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+STAGE = 'load'
+SECRET = base64.b64encode(b'load-test'*8)
+
+# units, members, contacts, page log rows
+SCALES = {
+    'small'  : (20, 2000, 2000, 20000),
+    'medium' : (100, 10000, 10000, 200000),
+    'full'   : (300, 30000, 30000, 2000000),
+}
+
+FIRST = ['Jane', 'John', 'José', 'Mary', 'Ahmed', 'Li', 'Zoë', 'Peter', 'Aroha', 'Sam', 'Ruth', 'Tom']
+LAST = ['Smith', 'Jones', 'Ávila', 'Nguyen', 'Williams', 'Brown', 'Taylor', 'Singh', 'Kelly', 'Ngata']
+
+UNIT_ADMIN_PERMISSIONS = ['myunit-unit-write', 'myunit-contact-write', 'myunit-contact-read',
+                          'myunit-pagelog-read', 'myunit-member-write', 'myunit-member-read']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, proc, name):
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("{} exited with {}".format(name, proc.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("{} did not start".format(name))
+
+
+def start(cmd, env, port, name):
+    proc = subprocess.Popen(cmd, cwd=TOP, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port, proc, name)
+    return proc
+
+
+# Seeding
+
+class Dataset:
+    # What was written, scenarios pick their targets from it
+    def __init__(self):
+        self.units = []
+        self.members = {} # unit -> [member_id]
+        self.contacts = {} # unit -> [(phone_number, member_id)]
+
+
+def _write(dynamodb, table, items):
+    dtable = dynamodb.thread_dynamodb().Table(dynamodb.gen_table_name(STAGE, table))
+    with dtable.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+    return len(items)
+
+
+def _chunks(items, size=1000):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+def seed(dynamodb, scale, concurrency):
+    (units, members, contacts, pages) = SCALES[scale]
+    rand = random.Random(1)
+    data = Dataset()
+    start = time.monotonic()
+
+    dynamodb.delete(STAGE, wait=True)
+    dynamodb.create(STAGE)
+    dynamodb.populate_role(STAGE)
+
+    data.units = ['Unit{:03d}'.format(i) for i in range(units)]
+    unit_items = [{'name':u, 'capcode':10000+i} for (i, u) in enumerate(data.units)]
+
+    member_items = []
+    for i in range(members):
+        unit = data.units[i % units]
+        member_id = 10000 + i
+        data.members.setdefault(unit, []).append(member_id)
+        member_items.append({
+            'member_id' : member_id,
+            'name' : '{} {}'.format(rand.choice(FIRST), rand.choice(LAST)),
+            'unit' : unit,
+            'roles' : json.dumps(['unit-admin']), # As populate() and /authenticate expect
+        })
+
+    contact_items = []
+    for i in range(contacts):
+        unit = data.units[i % units]
+        member_id = rand.choice(data.members[unit])
+        phone = '614{:08d}'.format(i)
+        data.contacts.setdefault(unit, []).append((phone, member_id))
+        contact_items.append({'phone_number':phone, 'unit':unit, 'member_id':member_id})
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(_write, dynamodb, 'unit', unit_items)]
+        futures += [pool.submit(_write, dynamodb, 'member', c) for c in _chunks(member_items)]
+        futures += [pool.submit(_write, dynamodb, 'contact', c) for c in _chunks(contact_items)]
+        written = sum(f.result() for f in futures)
+
+        # Page log rows are generated per chunk, never all held at once
+        now = time.time()
+        def page_chunk(first, count):
+            crand = random.Random(first)
+            items = []
+            for i in range(first, first + count):
+                unit = data.units[i % units]
+                (phone, _) = crand.choice(data.contacts[unit])
+                items.append({
+                    'unit' : unit,
+                    'timestamp' : int(now) - 90*86400 + i, # Unique per unit
+                    'phone_number' : phone,
+                    'body' : 'LOAD TEST PAGE {} - {}'.format(i, unit),
+                })
+            return _write(dynamodb, 'page_log', items)
+        futures = [pool.submit(page_chunk, i, min(1000, pages - i)) for i in range(0, pages, 1000)]
+        written += sum(f.result() for f in futures)
+
+    print("Seeded {} items ({} units, {} members, {} contacts, {} pages) in {:.1f}s".format(
+        written, units, members, contacts, pages, time.monotonic() - start))
+    return data
+
+
+# Scenarios
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = collections.defaultdict(list) # name -> seconds
+        self.errors = collections.Counter()
+        self.limited = collections.Counter()
+
+    def record(self, name, seconds, status):
+        with self.lock:
+            self.latency[name].append(seconds)
+            if status == 429:
+                self.limited[name] += 1
+            elif status is None or status >= 400:
+                self.errors[name] += 1
+
+
+class User:
+    # A virtual user, one keep-alive connection
+    def __init__(self, port, data, stats, rand):
+        self.port = port
+        self.data = data
+        self.stats = stats
+        self.rand = rand
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        self.ok = True
+        self.limited = False
+
+    def token(self, unit, member_id, permissions=UNIT_ADMIN_PERMISSIONS):
+        claims = {
+            'member_id' : str(member_id),
+            'name' : 'Load {}'.format(member_id),
+            'unit' : unit,
+            'roles' : ['unit-admin'],
+            'permissions' : permissions,
+            'auth_time' : int(time.time()), # For /authenticate/refresh
+            'iss' : 'sms-page',
+            'exp' : int(time.time()) + 3600,
+        }
+        return str(jwt.encode(claims, base64.b64decode(SECRET), algorithm='HS256'), 'utf-8')
+
+    def request(self, scenario, step, method, path, token, body=None, content_type=None):
+        headers = {'Authorization':'Bearer ' + token}
+        if content_type:
+            headers['Content-Type'] = content_type
+        start = time.perf_counter()
+        status = None
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            resp = self.conn.getresponse()
+            resp.read()
+            status = resp.status
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        self.stats.record(scenario + ' ' + step, time.perf_counter() - start, status)
+        if status == 429:
+            self.limited = True
+        elif status is None or status >= 400:
+            self.ok = False
+        return status
+
+    def member(self):
+        unit = self.rand.choice(self.data.units)
+        return unit, self.rand.choice(self.data.members[unit])
+
+    def login(self):
+        (unit, member_id) = self.member()
+        self.request('login', 'refresh', 'POST', '/authenticate/refresh', self.token(unit, member_id))
+
+    def unit_browse(self):
+        (unit, member_id) = self.member()
+        token = self.token(unit, member_id)
+        self.request('unit_browse', 'unit', 'GET', '/rest/unit/'+unit, token)
+        self.request('unit_browse', 'members', 'GET', '/rest/unit/'+unit+'/members', token)
+        self.request('unit_browse', 'contacts', 'GET', '/rest/unit/'+unit+'/contacts', token)
+        prefix = self.rand.choice(FIRST)[:2]
+        self.request('unit_browse', 'search', 'GET', '/rest/unit/'+unit+'/members?q='+prefix, token)
+
+    def contact_edit(self):
+        (unit, member_id) = self.member()
+        token = self.token(unit, member_id)
+        (phone, owner) = self.rand.choice(self.data.contacts[unit])
+        self.request('contact_edit', 'get', 'GET', '/rest/contact/'+phone, token)
+        body = 'unit={}&member_id={}'.format(unit, owner)
+        self.request('contact_edit', 'put', 'PUT', '/rest/contact/'+phone, token,
+                     body, 'application/x-www-form-urlencoded')
+
+    def page_storm(self):
+        # The paging service logging a burst of pages for one unit
+        unit = self.rand.choice(self.data.units)
+        token = self.token(unit, 0, ['pagelog-write', 'pagelog-read'])
+        now = time.time()
+        entries = [{
+            'phone_number' : phone,
+            'timestamp' : now + i / 1000.0,
+            'body' : 'LOAD TEST STORM {}'.format(i),
+        } for (i, (phone, _)) in enumerate(self.rand.sample(self.data.contacts[unit],
+                                                            min(25, len(self.data.contacts[unit]))))]
+        self.request('page_storm', 'post', 'POST', '/rest/unit/'+unit+'/pagelog', token,
+                     json.dumps(entries), 'application/json')
+        self.request('page_storm', 'stats', 'GET', '/rest/unit/'+unit+'/pagelog/stats?granularity=hour', token)
+
+
+SCENARIOS = ['login', 'unit_browse', 'contact_edit', 'page_storm']
+
+
+def run_user(port, data, stats, weights, deadline, seed_value):
+    rand = random.Random(seed_value)
+    user = User(port, data, stats, rand)
+    names = list(weights)
+    totals = [weights[n] for n in names]
+    while time.monotonic() < deadline:
+        scenario = rand.choices(names, totals)[0]
+        user.ok = True
+        user.limited = False
+        start = time.perf_counter()
+        getattr(user, scenario)()
+        status = None if not user.ok else 429 if user.limited else 200
+        stats.record(scenario, time.perf_counter() - start, status)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(stats, duration):
+    print("{:<24} {:>8} {:>8} {:>7} {:>7} {:>8} {:>8} {:>8}".format(
+        'scenario / request', 'count', 'per s', 'err %', '429 %', 'p50 ms', 'p90 ms', 'p99 ms'))
+    results = {}
+    for name in sorted(stats.latency, key=lambda n: (n.split(' ')[0], ' ' in n, n)):
+        latency = sorted(stats.latency[name])
+        count = len(latency)
+        row = {
+            'count' : count,
+            'rate' : count / duration,
+            'errors' : stats.errors[name] / count * 100,
+            'limited' : stats.limited[name] / count * 100,
+            'p50' : percentile(latency, 0.5) * 1e3,
+            'p90' : percentile(latency, 0.9) * 1e3,
+            'p99' : percentile(latency, 0.99) * 1e3,
+        }
+        results[name] = row
+        label = name if ' ' not in name else '  ' + name.split(' ', 1)[1]
+        print("{:<24} {count:>8} {rate:>8.1f} {errors:>7.2f} {limited:>7.2f} {p50:>8.1f} {p90:>8.1f} {p99:>8.1f}".format(
+            label, **row))
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--concurrency', type=int, default=16, help='virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--weights', default='login=2,unit_browse=3,contact_edit=4,page_storm=1',
+                        help='scenario=weight, comma separated')
+    parser.add_argument('--endpoint', help='DynamoDB endpoint to use instead of starting moto_server')
+    parser.add_argument('--workers', type=int, default=2, help='serve.py worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='serve.py threads per worker')
+    parser.add_argument('--json', help='also write the results here')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    weights = {}
+    for part in args.weights.split(','):
+        (name, weight) = part.split('=')
+        if name not in SCENARIOS:
+            raise SystemExit("Unknown scenario {}, expected one of {}".format(name, ', '.join(SCENARIOS)))
+        weights[name] = float(weight)
+
+    env = dict(os.environ)
+    env.setdefault('AWS_ACCESS_KEY_ID', 'load')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'load')
+    procs = []
+    try:
+        if args.endpoint:
+            endpoint = args.endpoint
+        else:
+            db_port = free_port()
+            procs.append(start([sys.executable, '-m', 'moto.server', '-p', str(db_port)],
+                               env, db_port, 'moto_server'))
+            endpoint = 'http://127.0.0.1:{}'.format(db_port)
+
+        # dynamodb.py connects on import
+        os.environ.update(DYNAMODB_ENDPOINT=endpoint, AWS_ACCESS_KEY_ID=env['AWS_ACCESS_KEY_ID'],
+                          AWS_SECRET_ACCESS_KEY=env['AWS_SECRET_ACCESS_KEY'])
+        sys.path.insert(0, TOP)
+        import dynamodb # pylint: disable=import-outside-toplevel
+        data = seed(dynamodb, args.scale, max(4, args.concurrency))
+
+        app_port = free_port()
+        env.update(DYNAMODB_ENDPOINT=endpoint, STAGE=STAGE, TOKEN_SECRET=str(SECRET, 'utf-8'),
+                   PORT=str(app_port), HOST='127.0.0.1', WEB_WORKERS=str(args.workers),
+                   WEB_THREADS=str(args.threads))
+        procs.append(start([sys.executable, 'serve.py'], env, app_port, 'serve.py'))
+
+        print("Running {} users for {}s: {}".format(args.concurrency, args.duration, args.weights))
+        stats = Stats()
+        deadline = time.monotonic() + args.duration
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [pool.submit(run_user, app_port, data, stats, weights, deadline, i)
+                       for i in range(args.concurrency)]
+            for f in futures:
+                f.result()
+        results = report(stats, args.duration)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=1)
+    finally:
+        for proc in reversed(procs):
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
+
+
+if __name__ == '__main__':
+    main()
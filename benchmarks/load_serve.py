@@ -0,0 +1,203 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+# Throughput of serve.py as worker processes are added.
+# moto_server stands in for DynamoDB with a small seeded unit. Clients
+# cycle through authenticated /rest reads of the unit, members and
+# contacts, so each request decodes its token and goes through the rate
+# limits, the response cache, the DynamoDB connections of its worker
+# thread and JSON encoding. Every other request sends
+# 'Cache-Control: no-cache' to reach DynamoDB, the rest are mostly
+# answered from the cache. Rate limits are raised out of the way.
+# moto_server is a single process, at high worker counts it rather than
+# serve.py can be what limits the scaling.
+# Run from the top level: python3 benchmarks/load_serve.py [workers ...]
+# Without arguments it tries 1, 2, 4 ... up to the number of cores.
+
+import os
+import sys
+import time
+import json
+import base64
+import socket
+import signal
+import http.client
+import subprocess
+import multiprocessing
+
+import jwt
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PORT = int(os.environ.get('BENCH_PORT', 8731))
+DURATION = float(os.environ.get('BENCH_SECONDS', 5))
+CLIENTS = int(os.environ.get('BENCH_CLIENTS', multiprocessing.cpu_count() * 4))
+SECRET = base64.b64encode(b'benchmark'*8)
+STAGE = 'bench'
+UNIT = 'Bench'
+MEMBERS = 50
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, proc, name):
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("{} exited with {}".format(name, proc.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("{} did not start".format(name))
+
+
+def start_moto(port):
+    proc = subprocess.Popen([sys.executable, '-m', 'moto.server', '-p', str(port)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port, proc, 'moto_server')
+    return proc
+
+
+def seed():
+    # dynamodb reads DYNAMODB_ENDPOINT on import
+    sys.path.insert(0, TOP)
+    import dynamodb # pylint: disable=import-outside-toplevel
+
+    dynamodb.create(STAGE)
+    resource = dynamodb.thread_dynamodb()
+    resource.Table(dynamodb.gen_table_name(STAGE, 'unit')).put_item(Item={'name':UNIT, 'capcode':1000})
+    members = resource.Table(dynamodb.gen_table_name(STAGE, 'member'))
+    contacts = resource.Table(dynamodb.gen_table_name(STAGE, 'contact'))
+    with members.batch_writer() as mbatch, contacts.batch_writer() as cbatch:
+        for i in range(MEMBERS):
+            mbatch.put_item(Item={'member_id':1000 + i, 'name':'Member {}'.format(i), 'unit':UNIT,
+                                  'roles':json.dumps(['unit-admin'])})
+            cbatch.put_item(Item={'phone_number':'614{:08d}'.format(i), 'unit':UNIT, 'member_id':1000 + i})
+
+
+def paths():
+    # Not the whole unit lists, their own limits aren't raised by RATE_LIMIT
+    result = ['/rest/unit/{}'.format(UNIT)]
+    for i in range(0, MEMBERS, 5):
+        result += ['/rest/member/{}'.format(1000 + i), '/rest/member/{}/contacts'.format(1000 + i),
+                   '/rest/contact/614{:08d}'.format(i)]
+    return result
+
+
+def token():
+    claims = {
+        'member_id' : 1000,
+        'name' : 'Load Test',
+        'unit' : UNIT,
+        'roles' : [],
+        'permissions' : ['unit-read', 'member-read', 'contact-read'],
+        'iss' : 'sms-page',
+        'exp' : int(time.time()) + 3600,
+    }
+    return str(jwt.encode(claims, base64.b64decode(SECRET), algorithm='HS256'), 'utf-8')
+
+
+def start_server(workers, endpoint):
+    env = dict(os.environ, PORT=str(PORT), HOST='127.0.0.1', WEB_WORKERS=str(workers),
+               WEB_THREADS='4', TOKEN_SECRET=str(SECRET, 'utf-8'), STAGE=STAGE,
+               DYNAMODB_ENDPOINT=endpoint, RATE_LIMIT='1000000', RATE_LIMIT_BURST='1000000')
+    proc = subprocess.Popen([sys.executable, 'serve.py'], cwd=TOP, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(PORT, proc, 'serve.py')
+    return proc
+
+
+def client(args):
+    (bearer, until, offset) = args
+    targets = paths()
+    conn = http.client.HTTPConnection('127.0.0.1', PORT)
+    headers = {'Authorization':'Bearer ' + bearer}
+    fresh = dict(headers, **{'Cache-Control':'no-cache'})
+    latencies = []
+    errors = 0
+    i = offset
+    while time.monotonic() < until:
+        i += 1
+        start = time.perf_counter()
+        try:
+            conn.request('GET', targets[i % len(targets)], headers=fresh if i % 2 else headers)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', PORT)
+        latencies.append(time.perf_counter() - start)
+    return latencies, errors
+
+
+def run(workers, bearer, endpoint):
+    proc = start_server(workers, endpoint)
+    try:
+        until = time.monotonic() + DURATION
+        with multiprocessing.Pool(CLIENTS) as pool:
+            results = pool.map(client, [(bearer, until, c) for c in range(CLIENTS)])
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait()
+
+    latencies = sorted(l for (ls, _) in results for l in ls)
+    errors = sum(e for (_, e) in results)
+    return {
+        'workers' : workers,
+        'requests' : len(latencies),
+        'rps' : len(latencies) / DURATION,
+        'errors' : errors,
+        'p50_ms' : latencies[len(latencies) // 2] * 1e3,
+        'p99_ms' : latencies[int(len(latencies) * 0.99)] * 1e3,
+    }
+
+
+def main():
+    cores = multiprocessing.cpu_count()
+    counts = [int(a) for a in sys.argv[1:]]
+    if not counts:
+        counts = [1]
+        while counts[-1] * 2 <= cores:
+            counts.append(counts[-1] * 2)
+
+    moto_port = free_port()
+    endpoint = 'http://127.0.0.1:{}'.format(moto_port)
+    moto = start_moto(moto_port)
+    try:
+        os.environ.update(DYNAMODB_ENDPOINT=endpoint)
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        seed()
+
+        bearer = token()
+        print("{} cores, {} clients, {}s per run".format(cores, CLIENTS, DURATION))
+        print("{:>8} {:>10} {:>8} {:>8} {:>8} {:>8}".format('workers', 'req/s', 'scaling', 'errors', 'p50 ms', 'p99 ms'))
+        base = None
+        results = []
+        for workers in counts:
+            r = run(workers, bearer, endpoint)
+            base = base or r['rps']
+            print("{workers:>8} {rps:>10.0f} {scale:>7.2f}x {errors:>8} {p50_ms:>8.1f} {p99_ms:>8.1f}".format(
+                scale=r['rps'] / base, **r))
+            results.append(r)
+    finally:
+        moto.send_signal(signal.SIGTERM)
+        moto.wait()
+    if os.environ.get('BENCH_JSON'):
+        with open(os.environ['BENCH_JSON'], 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,25 @@
 # sms-page-rest is free software, you can distribute or modify it
 # under the terms of the GNU Affero General Public License (AGPL-3).
 
+import os
+import csv
+import gzip
 import json
+import hashlib
+import time
 import uuid
 import decimal
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
+import botocore.config
+import botocore.exceptions
 from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+
+from pagestats import record_pages, count_pages
 
 
 # table contact
@@ -17,6 +29,7 @@ from boto3.dynamodb.conditions import Key, Attr
 #   member_id
 # Global secondary index on contact
 #   unit (partition), phone_number (range)
+#   member_id (partition), phone_number (range)
 
 # table member
 #   member_id (hash)
@@ -35,18 +48,48 @@ from boto3.dynamodb.conditions import Key, Attr
 #   timestamp (range)
 #   phone_number
 #   body
+# Global secondary index on page_log
+#   phone_number (partition), timestamp (range)
 
 # table unit
 #   name (hash)
 #   capcode
 
-tables = ['contact', 'member', 'unit', 'role', 'page_log']
+# table page_stats
+#   unit (hash)
+#   bucket (range) - see pagestats
+#   pages
+
+# table removal
+#   unit_list (hash) - '<table>/<unit>' the item moved out of
+#   removed_id (range) - '<updated_at>/<item key>', see web.rest
+#   item_key
+#   updated_at
+
+tables = ['contact', 'member', 'unit', 'role', 'page_log', 'page_stats', 'removal']
+
+# Same throttling behaviour as the web service, see web.models
+retry_config = botocore.config.Config(retries={'mode':'adaptive', 'max_attempts':10})
 
-aws = boto3.Session()
-if "pytest" in sys.modules:
-    dynamodb = aws.resource('dynamodb', endpoint_url='http://localhost:8000')
-else:
-    dynamodb = aws.resource('dynamodb', region_name='ap-southeast-2', use_ssl=True)
+def connect():
+    # boto3 resources aren't thread safe, workers each need their own
+    aws = boto3.Session()
+    if "pytest" in sys.modules:
+        return aws.resource('dynamodb', endpoint_url='http://localhost:8000', config=retry_config)
+    if os.environ.get('DYNAMODB_ENDPOINT'):
+        return aws.resource('dynamodb', endpoint_url=os.environ['DYNAMODB_ENDPOINT'],
+                            region_name='ap-southeast-2', config=retry_config)
+    return aws.resource('dynamodb', region_name='ap-southeast-2', use_ssl=True,
+                        config=retry_config)
+
+dynamodb = connect()
+
+_thread_state = threading.local()
+
+def thread_dynamodb():
+    if not hasattr(_thread_state, 'dynamodb'):
+        _thread_state.dynamodb = connect()
+    return _thread_state.dynamodb
 
 # Best run python3 -i dynamodb.py, then call functions by hand
 
@@ -65,6 +108,35 @@ def gen_table_name(stage, table):
     return 'sms-page-'+stage+'-'+table
 
 
+contact_member_index = {
+    "IndexName" : "contact_member",
+    "KeySchema" : [
+        { 'AttributeName' : 'member_id', 'KeyType' : 'HASH', },
+        { 'AttributeName' : 'phone_number', 'KeyType' : 'RANGE', },
+    ],
+    'Projection' : { 'ProjectionType' : 'ALL' },
+    'ProvisionedThroughput' : {
+        'ReadCapacityUnits': 10,
+        'WriteCapacityUnits': 10
+    }
+}
+
+# Unit lists changed since a watermark, see changes_get() in web/rest.py
+contact_updated_index = {
+    "IndexName" : "contact_updated",
+    "KeySchema" : [
+        { 'AttributeName' : 'unit', 'KeyType' : 'HASH', },
+        { 'AttributeName' : 'updated_at', 'KeyType' : 'RANGE', },
+    ],
+    'Projection' : { 'ProjectionType' : 'ALL' },
+    'ProvisionedThroughput' : {
+        'ReadCapacityUnits': 10,
+        'WriteCapacityUnits': 10
+    }
+}
+
+member_updated_index = dict(contact_updated_index, IndexName="member_updated")
+
 def create_contact(stage):
     table = dynamodb.create_table(
         TableName = gen_table_name(stage, 'contact'),
@@ -74,6 +146,8 @@ def create_contact(stage):
         AttributeDefinitions = [
             { 'AttributeName':'phone_number', 'AttributeType':'S', },
             { 'AttributeName':'unit', 'AttributeType':'S', },
+            { 'AttributeName':'member_id', 'AttributeType':'N', },
+            { 'AttributeName':'updated_at', 'AttributeType':'N', },
         ],
         ProvisionedThroughput = {
             'ReadCapacityUnits': 10,
@@ -90,10 +164,29 @@ def create_contact(stage):
                 'ReadCapacityUnits': 10,
                 'WriteCapacityUnits': 10
             }
-        } ],
+        }, contact_member_index, contact_updated_index ],
     )
     print("Create contact status:", table.table_status)
 
+def add_index(stage, table, index, attributes, wait=True, timeout=600):
+    # Adds a global secondary index to a stage created without it
+    # attributes are the AttributeDefinitions the index keys need
+    dynamodb.meta.client.update_table(
+        TableName = gen_table_name(stage, table),
+        AttributeDefinitions = attributes,
+        GlobalSecondaryIndexUpdates = [ { 'Create' : index } ],
+    )
+    if wait:
+        # The index is backfilled from existing items before going ACTIVE
+        return wait_until_active(stage, timeout, wait_tables=[table])
+    return None
+
+def add_contact_member_index(stage, wait=True, timeout=600):
+    return add_index(stage, 'contact', contact_member_index, [
+        { 'AttributeName':'phone_number', 'AttributeType':'S', },
+        { 'AttributeName':'member_id', 'AttributeType':'N', },
+    ], wait, timeout)
+
 # table member
 #   member_id (hash)
 #   name
@@ -107,6 +200,7 @@ def create_member(stage):
         AttributeDefinitions = [
             { 'AttributeName':'member_id', 'AttributeType':'N', },
             { 'AttributeName':'unit', 'AttributeType':'S', },
+            { 'AttributeName':'updated_at', 'AttributeType':'N', },
         ],
         ProvisionedThroughput = {
             'ReadCapacityUnits': 10,
@@ -123,11 +217,24 @@ def create_member(stage):
                 'ReadCapacityUnits': 10,
                 'WriteCapacityUnits': 10
             }
-        } ],
+        }, member_updated_index ],
     )
     print("Create member status:", table.table_status)
 
 
+page_log_phone_index = {
+    "IndexName" : "page_log_phone",
+    "KeySchema" : [
+        { 'AttributeName' : 'phone_number', 'KeyType' : 'HASH', },
+        { 'AttributeName' : 'timestamp', 'KeyType' : 'RANGE', },
+    ],
+    'Projection' : { 'ProjectionType' : 'ALL' },
+    'ProvisionedThroughput' : {
+        'ReadCapacityUnits': 10,
+        'WriteCapacityUnits': 10
+    }
+}
+
 def create_page_log(stage):
     table = dynamodb.create_table(
         TableName = gen_table_name(stage, 'page_log'),
@@ -138,14 +245,80 @@ def create_page_log(stage):
         AttributeDefinitions = [
             { 'AttributeName':'unit', 'AttributeType':'S' },
             { 'AttributeName':'timestamp', 'AttributeType':'N' },
+            { 'AttributeName':'phone_number', 'AttributeType':'S' },
         ],
         ProvisionedThroughput = {
             'ReadCapacityUnits': 10,
             'WriteCapacityUnits': 10
-        }
+        },
+        GlobalSecondaryIndexes = [ page_log_phone_index ],
     )
     print("Create page_log status:", table.table_status)
 
+def create_page_stats(stage):
+    table = dynamodb.create_table(
+        TableName = gen_table_name(stage, 'page_stats'),
+        KeySchema = [
+            { 'AttributeName':'unit', 'KeyType':'HASH' },
+            { 'AttributeName':'bucket', 'KeyType':'RANGE' },
+        ],
+        AttributeDefinitions = [
+            { 'AttributeName':'unit', 'AttributeType':'S' },
+            { 'AttributeName':'bucket', 'AttributeType':'S' },
+        ],
+        ProvisionedThroughput = {
+            'ReadCapacityUnits': 10,
+            'WriteCapacityUnits': 10
+        }
+    )
+    print("Create page_stats status:", table.table_status)
+
+def create_removal(stage):
+    # Contacts and members moved out of a unit, see web.rest.changes_get
+    table = dynamodb.create_table(
+        TableName = gen_table_name(stage, 'removal'),
+        KeySchema = [
+            { 'AttributeName':'unit_list', 'KeyType':'HASH' },
+            { 'AttributeName':'removed_id', 'KeyType':'RANGE' },
+        ],
+        AttributeDefinitions = [
+            { 'AttributeName':'unit_list', 'AttributeType':'S' },
+            { 'AttributeName':'removed_id', 'AttributeType':'S' },
+        ],
+        ProvisionedThroughput = {
+            'ReadCapacityUnits': 10,
+            'WriteCapacityUnits': 10
+        }
+    )
+    print("Create removal status:", table.table_status)
+
+def enable_removal_ttl(stage):
+    # Removal items carry their expiry in 'expires', see
+    # web.rest.removal_item. The table has to be ACTIVE first.
+    try:
+        dynamodb.meta.client.update_time_to_live(
+            TableName = gen_table_name(stage, 'removal'),
+            TimeToLiveSpecification = { 'Enabled':True, 'AttributeName':'expires' },
+        )
+    except botocore.exceptions.ClientError as err:
+        if 'already enabled' not in err.response.get('Error', {}).get('Message', ''):
+            raise
+
+def add_page_log_phone_index(stage, wait=True, timeout=600):
+    return add_index(stage, 'page_log', page_log_phone_index, [
+        { 'AttributeName':'phone_number', 'AttributeType':'S' },
+        { 'AttributeName':'timestamp', 'AttributeType':'N' },
+    ], wait, timeout)
+
+def add_change_indexes(stage, wait=True, timeout=600):
+    # Follow with stamp_updated_at(), the indexes only hold stamped items
+    attributes = [
+        { 'AttributeName':'unit', 'AttributeType':'S', },
+        { 'AttributeName':'updated_at', 'AttributeType':'N', },
+    ]
+    add_index(stage, 'contact', contact_updated_index, attributes, wait, timeout)
+    return add_index(stage, 'member', member_updated_index, attributes, wait, timeout)
+
 def create_unit(stage):
     table = dynamodb.create_table(
         TableName = gen_table_name(stage, 'unit'),
@@ -179,63 +352,103 @@ def create_role(stage):
     print("Create role status:", table.table_status)
 
 
-def create(stage):
-    try:
-        create_contact(stage)
-    except dynamodb.meta.client.exceptions.ResourceInUseException:
-        print("Contact table already exists")
-
-    try:
-        create_member(stage)
-    except dynamodb.meta.client.exceptions.ResourceInUseException:
-        print("Member table already exists")
-
-    try:
-        create_page_log(stage)
-    except dynamodb.meta.client.exceptions.ResourceInUseException:
-        print("Page log table already exists")
-
-    try:
-        create_unit(stage)
-    except dynamodb.meta.client.exceptions.ResourceInUseException:
-        print("Unit table already exists")
-
+# Table creators, run concurrently by create()
+# create_table is a plain client call, safe to share the resource
+creators = {
+    'contact'  : create_contact,
+    'member'   : create_member,
+    'page_log' : create_page_log,
+    'page_stats' : create_page_stats,
+    'unit'     : create_unit,
+    'role'     : create_role,
+    'removal'  : create_removal,
+}
+
+def _error_code(err):
+    return err.response.get('Error', {}).get('Code')
+
+def create(stage, wait=True, timeout=300):
+    # Tables are created in parallel, then we wait for all to be ACTIVE
+    with ThreadPoolExecutor(max_workers=len(creators)) as pool:
+        futures = {pool.submit(creators[t], stage):t for t in tables}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except botocore.exceptions.ClientError as err:
+                if _error_code(err) != 'ResourceInUseException':
+                    raise
+                print("Table {} already exists".format(futures[future]))
+
+    if wait:
+        result = wait_until_active(stage, timeout)
+        enable_removal_ttl(stage)
+        return result
+    return None # Call enable_removal_ttl() once the tables are ACTIVE
+
+
+def _table_status(stage, table):
+    # None once the table is gone. A table isn't usable until its
+    # indexes are ACTIVE as well.
+    client = dynamodb.meta.client # Clients are thread safe, resources aren't
     try:
-        create_role(stage)
-    except dynamodb.meta.client.exceptions.ResourceInUseException:
-        print("Role table already exists")
-
-
-def wait_until_active(stage):
-    # Create takes a few seconds to process
-    # Can't populate the table until the creation is complete
+        desc = client.describe_table(TableName=gen_table_name(stage, table))['Table']
+    except botocore.exceptions.ClientError as err:
+        if _error_code(err) == 'ResourceNotFoundException':
+            return None
+        raise
+    for index in desc.get('GlobalSecondaryIndexes', []):
+        if index.get('IndexStatus', 'ACTIVE') != 'ACTIVE':
+            return 'INDEX-' + index['IndexStatus']
+    return desc['TableStatus']
+
+def _wait_for_table(stage, table, wanted, deadline):
+    # Polls with exponential backoff, 0.1s doubling up to 5s per attempt
+    start = time.monotonic()
+    delay = 0.1
     while True:
-        status = {}
-        for t in tables:
+        status = _table_status(stage, table)
+        if status == wanted:
+            return time.monotonic() - start
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Table {} is {}, expected {}".format(table, status, wanted or 'deleted'))
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 5)
+
+def _wait_for_tables(stage, wanted, timeout, wait_tables):
+    deadline = time.monotonic() + timeout
+    ready = {}
+    failures = []
+    with ThreadPoolExecutor(max_workers=len(wait_tables)) as pool:
+        futures = {pool.submit(_wait_for_table, stage, t, wanted, deadline):t for t in wait_tables}
+        for future in as_completed(futures):
+            t = futures[future]
             try:
-                tname = gen_table_name(stage, t)
-                status[t] = dynamodb.Table(t).table_status
-            except dynamodb.meta.client.exceptions.ResourceNotFoundException:
-                status[t] = 'NON-EXISTANT'
-
-        print("Waiting for tables to become active: ", ", ".join(['{} == {}'.format(s, status[s]) for s in status]))
+                ready[t] = future.result()
+                print("Table {} {} after {:.1f}s".format(t, wanted or 'deleted', ready[t]))
+            except TimeoutError as err:
+                failures.append(str(err))
+    if failures:
+        raise TimeoutError("Tables not ready after {}s: {}".format(timeout, "; ".join(failures)))
+    return ready # table -> seconds waited
+
+def wait_until_active(stage, timeout=300, wait_tables=None):
+    # Create takes a few seconds to process
+    # Can't populate the table until the creation is complete
+    return _wait_for_tables(stage, 'ACTIVE', timeout, wait_tables or tables)
 
-        still_waiting = False
-        for s in status:
-            if status[s] != 'ACTIVE':
-                still_waiting = True
-
-        if not still_waiting:
-            break
+def wait_until_deleted(stage, timeout=300, wait_tables=None):
+    return _wait_for_tables(stage, None, timeout, wait_tables or tables)
 
 def add_pagelog(stage, unit, timestamp, phone_number, body):
-    table = dynamodb.Table(gen_table_name(stage, 'page_log'))
-    table.put_item(Item={
+    item = {
         'unit':unit,
         'timestamp':timestamp,
         'phone_number':phone_number,
         'body':body
-    })
+    }
+    dynamodb.Table(gen_table_name(stage, 'page_log')).put_item(Item=item)
+    record_pages(dynamodb.Table(gen_table_name(stage, 'page_stats')), [item])
 
 def add_role(stage, name, permissions):
     table = dynamodb.Table(gen_table_name(stage, 'role'))
@@ -245,7 +458,7 @@ def populate_role(stage):
     table = dynamodb.Table(gen_table_name(stage, 'role'))
 
     table.put_item(Item={'name':'unit-admin', 'permissions':['myunit-unit-write', 'myunit-contact-write', 'myunit-contact-read', 'myunit-pagelog-read', 'myunit-member-write', 'myunit-member-read']})
-    table.put_item(Item={'name':'site-admin', 'permissions':['unit-read', 'unit-write', 'contact-write', 'contact-read', 'pagelog-read', 'member-write', 'member-read']})
+    table.put_item(Item={'name':'site-admin', 'permissions':['unit-read', 'unit-write', 'contact-write', 'contact-read', 'pagelog-read', 'pagelog-write', 'member-write', 'member-read']})
     table.put_item(Item={'name':'contact-maintainer', 'permissions':['myunit-contact-write', 'myunit-contact-read', 'myunit-pagelog-read']})
     table.put_item(Item={'name':'none', 'permissions':['myunit-pagelog-read']})
 
@@ -265,12 +478,398 @@ def populate(stage):
     })
     print("Table population complete")
 
-def delete(stage):
+def delete(stage, wait=False, timeout=300):
     for t in tables:
         try:
             dynamodb.Table(gen_table_name(stage, t)).delete()
         except dynamodb.meta.client.exceptions.ResourceNotFoundException:
             pass # Already deleted, mission accomplished
+    if wait:
+        return wait_until_deleted(stage, timeout)
+    return None
+
+
+# Bulk import
+# Files are CSV with a header row, or JSON holding a list of objects.
+# Each file holds a single kind of record, validated with the same
+# schemas as the rest interface before being written.
+# Records are split into chunks, each chunk is validated and written by
+# a worker with batch_writer. Completed chunks are recorded in a
+# checkpoint file, rerunning the same import skips them.
+
+# kind -> (table, web.rest resource)
+import_kinds = {
+    'unit'     : ('unit', 'UnitTable'),
+    'member'   : ('member', 'MemberTable'),
+    'contact'  : ('contact', 'ContactTable'),
+    'page_log' : ('page_log', 'PageLogUnitTable'),
+}
+
+def read_records(path):
+    if path.endswith('.json'):
+        with open(path) as f:
+            return json.load(f, parse_float=decimal.Decimal)
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+def _load_checkpoint(checkpoint, path, chunk_size):
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return set()
+    with open(checkpoint) as f:
+        state = json.load(f)
+    if state.get('path') != path or state.get('chunk_size') != chunk_size:
+        raise ValueError("Checkpoint {} is for a different import".format(checkpoint))
+    return set(state.get('done', []))
+
+def _save_checkpoint(checkpoint, path, chunk_size, done):
+    if checkpoint is None:
+        return
+    tmp = checkpoint + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'path':path, 'chunk_size':chunk_size, 'done':sorted(done)}, f)
+    os.replace(tmp, checkpoint) # Never leave a half written checkpoint
+
+def _current_units(stage, table_name, key, values):
+    # key value -> unit, for the items that exist
+    name = gen_table_name(stage, table_name)
+    values = list(set(values)) # Duplicate keys are rejected
+    units = {}
+    for i in range(0, len(values), 100): # BatchGetItem limit
+        request = {name : {
+            'Keys' : [{key:v} for v in values[i:i+100]],
+            'ProjectionExpression' : '#k, #u',
+            'ExpressionAttributeNames' : {'#k':key, '#u':'unit'},
+            'ConsistentRead' : True,
+        }}
+        while request:
+            response = thread_dynamodb().batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(name, []):
+                units[item[key]] = item.get('unit')
+            request = response.get('UnprocessedKeys')
+    return units
+
+def _import_chunk(stage, kind, records):
+    # Runs in a worker thread, returns validation errors or None
+    from web import rest # Only needed here, requires TOKEN_SECRET
+    (table_name, resource_name) = import_kinds[kind]
+    resource = getattr(rest, resource_name)()
+
+    if kind == 'member':
+        for r in records:
+            roles = r.get('roles') or ['none']
+            if isinstance(roles, str):
+                roles = roles.split(';') # CSV, as exported
+            r['roles'] = set(roles)
+
+    compiled = rest.compile_schema(resource.schema)
+    try:
+        compiled.validate(records, many=True)
+    except rest.marshmallow.exceptions.ValidationError as err:
+        return err.normalized_messages()
+    stamp = rest.change_stamp()
+    for r in records:
+        compiled.cast_item(r)
+        if resource.stamp_updates:
+            r['updated_at'] = stamp # As single_put()
+
+    if resource.stamp_updates:
+        # Moves are recorded before the items are written. A rerun after
+        # a failure stamps the items again, so they follow the removals.
+        key = resource.partition_key
+        units = _current_units(stage, table_name, key, [r[key] for r in records])
+        with thread_dynamodb().Table(gen_table_name(stage, 'removal')).batch_writer() as batch:
+            for r in records:
+                old_unit = units.get(r[key])
+                if old_unit is not None and old_unit != r.get('unit'):
+                    batch.put_item(Item=rest.removal_item(table_name, old_unit, r[key], stamp))
+
+    table = thread_dynamodb().Table(gen_table_name(stage, table_name))
+    pkeys = [k for k in (resource.partition_key, resource.range_key) if k]
+    with table.batch_writer(overwrite_by_pkeys=pkeys) as batch:
+        for r in records:
+            batch.put_item(Item=r)
+    if kind == 'page_log':
+        # A rerun chunk is counted again, rebuild_page_stats() corrects it
+        record_pages(thread_dynamodb().Table(gen_table_name(stage, 'page_stats')), records)
+    return None
+
+def import_data(stage, kind, path, concurrency=4, chunk_size=500, checkpoint=None):
+    # eg. import_data('prod', 'member', 'members.csv', checkpoint='members.ckpt')
+    if kind not in import_kinds:
+        raise ValueError("Unknown kind {}, expected one of {}".format(kind, ", ".join(import_kinds)))
+
+    # Unit checks in the schemas look at the stage's unit table
+    os.environ['STAGE'] = stage
+
+    records = read_records(path)
+    chunks = [records[i:i+chunk_size] for i in range(0, len(records), chunk_size)]
+    done = _load_checkpoint(checkpoint, path, chunk_size)
+    todo = [i for i in range(len(chunks)) if i not in done]
+    print("Importing {} {} records, {} chunks remaining".format(
+        len(records), kind, len(todo)))
+
+    errors = {}
+    written = 0
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(_import_chunk, stage, kind, chunks[i]):i for i in todo}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                failure = future.result()
+            except Exception as err:
+                failure = str(err) # Left out of the checkpoint, retried next run
+            if failure:
+                errors[i] = failure
+                print("Chunk {} failed: {}".format(i, failure))
+                continue
+
+            done.add(i)
+            _save_checkpoint(checkpoint, path, chunk_size, done)
+            written += len(chunks[i])
+            elapsed = time.monotonic() - start
+            print("{}/{} chunks, {} records written, {:.0f} records/s".format(
+                len(done), len(chunks), written, written / elapsed if elapsed else 0))
+
+    elapsed = time.monotonic() - start
+    print("Import complete: {} records in {:.1f}s, {} chunks failed".format(
+        written, elapsed, len(errors)))
+    return {'written':written, 'seconds':elapsed, 'errors':errors}
+
+
+# Backup and restore
+# Each table is read with a parallel segmented Scan, every segment writes
+# gzip compressed JSON lines files of at most chunk_items items. Items are
+# stored in DynamoDB's typed form, so sets and numbers survive the trip.
+# manifest.json records the item count and sha256 of every file.
+# Throughput is tuned with segments (parallel scans), page_size (items per
+# scan request) and concurrency (parallel restore writers).
+
+def _write_backup_file(directory, table, segment, index, items):
+    serializer = TypeSerializer()
+    lines = []
+    for item in items:
+        typed = {k:serializer.serialize(v) for k, v in item.items()}
+        lines.append(json.dumps(typed, sort_keys=True))
+    data = gzip.compress(('\n'.join(lines) + '\n').encode('utf-8'))
+
+    name = '{}-{:03d}-{:05d}.jsonl.gz'.format(table, segment, index)
+    with open(os.path.join(directory, name), 'wb') as f:
+        f.write(data)
+    return {'file':name, 'items':len(items), 'sha256':hashlib.sha256(data).hexdigest()}
+
+def _read_backup_file(directory, entry):
+    with open(os.path.join(directory, entry['file']), 'rb') as f:
+        data = f.read()
+    if hashlib.sha256(data).hexdigest() != entry['sha256']:
+        raise ValueError("Checksum mismatch in {}".format(entry['file']))
+    deserializer = TypeDeserializer()
+    items = []
+    for line in gzip.decompress(data).decode('utf-8').splitlines():
+        if line:
+            typed = json.loads(line)
+            items.append({k:deserializer.deserialize(v) for k, v in typed.items()})
+    if len(items) != entry['items']:
+        raise ValueError("Item count mismatch in {}".format(entry['file']))
+    return items
+
+def _backup_segment(stage, table, segment, segments, directory, chunk_items, page_size):
+    dtable = thread_dynamodb().Table(gen_table_name(stage, table))
+    kwargs = {'Segment':segment, 'TotalSegments':segments}
+    if page_size:
+        kwargs['Limit'] = page_size
+
+    files = []
+    buffer = []
+    while True:
+        response = dtable.scan(**kwargs)
+        buffer.extend(response['Items'])
+        while len(buffer) >= chunk_items:
+            files.append(_write_backup_file(directory, table, segment, len(files), buffer[:chunk_items]))
+            buffer = buffer[chunk_items:]
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            break
+        kwargs['ExclusiveStartKey'] = last_key
+    if buffer:
+        files.append(_write_backup_file(directory, table, segment, len(files), buffer))
+    return files
+
+def backup(stage, directory, segments=4, chunk_items=5000, page_size=None, backup_tables=None):
+    # eg. backup('prod', 'backup-2017-11-01')
+    backup_tables = backup_tables or tables
+    os.makedirs(directory, exist_ok=True)
+    manifest = {'stage':stage, 'created':int(time.time()), 'tables':{}}
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        for t in backup_tables:
+            futures = [pool.submit(_backup_segment, stage, t, seg, segments, directory,
+                                   chunk_items, page_size) for seg in range(segments)]
+            files = [f for future in futures for f in future.result()]
+            count = sum(f['items'] for f in files)
+            manifest['tables'][t] = {'items':count, 'files':files}
+            print("Backed up {}: {} items in {} files".format(t, count, len(files)))
+
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    print("Backup complete in {:.1f}s".format(time.monotonic() - start))
+    return manifest
+
+def _load_manifest(directory):
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        return json.load(f)
+
+def table_count(stage, table):
+    # Exact count, DescribeTable's ItemCount is only updated every 6 hours
+    dtable = dynamodb.Table(gen_table_name(stage, table))
+    kwargs = {'Select':'COUNT'}
+    count = 0
+    while True:
+        response = dtable.scan(**kwargs)
+        count += response['Count']
+        if not response.get('LastEvaluatedKey'):
+            return count
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def verify_backup(directory, stage=None):
+    # Checks every file against the manifest checksums and counts.
+    # If a stage is given the live table counts are compared as well.
+    manifest = _load_manifest(directory)
+    ok = True
+    for (t, info) in manifest['tables'].items():
+        try:
+            items = sum(len(_read_backup_file(directory, f)) for f in info['files'])
+        except (ValueError, OSError) as err:
+            print("{}: {}".format(t, err))
+            ok = False
+            continue
+        if items != info['items']:
+            print("{}: manifest lists {} items, files hold {}".format(t, info['items'], items))
+            ok = False
+        if stage is not None:
+            live = table_count(stage, t)
+            if live != items:
+                print("{}: backup holds {} items, table holds {}".format(t, items, live))
+                ok = False
+    print("Backup verified" if ok else "Backup verification FAILED")
+    return ok
+
+def _restore_file(stage, table, directory, entry):
+    items = _read_backup_file(directory, entry)
+    dtable = thread_dynamodb().Table(gen_table_name(stage, table))
+    with dtable.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+    return len(items)
+
+def restore(stage, directory, concurrency=8, restore_tables=None):
+    # Tables must already exist, see create()
+    manifest = _load_manifest(directory)
+    restore_tables = restore_tables or list(manifest['tables'])
+
+    start = time.monotonic()
+    counts = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for t in restore_tables:
+            files = manifest['tables'][t]['files']
+            futures = [pool.submit(_restore_file, stage, t, directory, f) for f in files]
+            counts[t] = sum(future.result() for future in futures)
+            print("Restored {}: {} of {} items".format(t, counts[t], manifest['tables'][t]['items']))
+    print("Restore complete in {:.1f}s".format(time.monotonic() - start))
+    return counts
+
+
+# Page log rollups, see pagestats
+# The log is scanned in parallel segments and counted in memory, then
+# every rollup item is overwritten with the recount. Rollups without any
+# log entries left are deleted. Pages logged during a rebuild may be
+# missed, run it while paging is quiet.
+
+def _count_segment(stage, segment, segments):
+    dtable = thread_dynamodb().Table(gen_table_name(stage, 'page_log'))
+    kwargs = {
+        'Segment' : segment,
+        'TotalSegments' : segments,
+        'ProjectionExpression' : 'unit, #t',
+        'ExpressionAttributeNames' : {'#t':'timestamp'}, # Reserved word
+    }
+    counts = count_pages([])
+    while True:
+        response = dtable.scan(**kwargs)
+        counts.update(count_pages(response['Items']))
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            return counts
+        kwargs['ExclusiveStartKey'] = last_key
+
+def rebuild_page_stats(stage, segments=4):
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        futures = [pool.submit(_count_segment, stage, seg, segments) for seg in range(segments)]
+        counts = futures[0].result()
+        for future in futures[1:]:
+            counts.update(future.result())
+
+    dtable = dynamodb.Table(gen_table_name(stage, 'page_stats'))
+    stale = set()
+    kwargs = {'ProjectionExpression':'unit, #b', 'ExpressionAttributeNames':{'#b':'bucket'}}
+    while True:
+        response = dtable.scan(**kwargs)
+        stale.update((i['unit'], i['bucket']) for i in response['Items'])
+        if not response.get('LastEvaluatedKey'):
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    stale.difference_update(counts)
+
+    with dtable.batch_writer() as batch:
+        for ((unit, name), pages) in counts.items():
+            batch.put_item(Item={'unit':unit, 'bucket':name, 'pages':pages})
+        for (unit, name) in stale:
+            batch.delete_item(Key={'unit':unit, 'bucket':name})
+    print("Rebuilt {} page stats, removed {} in {:.1f}s".format(
+        len(counts), len(stale), time.monotonic() - start))
+    return counts
+
+# table -> key attribute, for tables listed by changed_since
+stamped_tables = {'contact':'phone_number', 'member':'member_id'}
+
+def _stamp_segment(stage, table, stamp, segment, segments):
+    key = stamped_tables[table]
+    dtable = thread_dynamodb().Table(gen_table_name(stage, table))
+    kwargs = {
+        'Segment' : segment,
+        'TotalSegments' : segments,
+        'ProjectionExpression' : key,
+        'FilterExpression' : Attr('updated_at').not_exists(),
+    }
+    count = 0
+    while True:
+        response = dtable.scan(**kwargs)
+        for item in response['Items']:
+            # Leaves anything written through the service meanwhile
+            dtable.update_item(Key={key:item[key]},
+                               UpdateExpression='SET updated_at = if_not_exists(updated_at, :t)',
+                               ExpressionAttributeValues={':t':stamp})
+        count += len(response['Items'])
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            return count
+        kwargs['ExclusiveStartKey'] = last_key
+
+def stamp_updated_at(stage, segments=4):
+    # Gives items written before change tracking an updated_at, so the
+    # first changed_since=0 sync returns them
+    from web.rest import change_stamp # Requires TOKEN_SECRET
+    stamp = change_stamp()
+    counts = {}
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        for table in stamped_tables:
+            futures = [pool.submit(_stamp_segment, stage, table, stamp, seg, segments)
+                       for seg in range(segments)]
+            counts[table] = sum(f.result() for f in futures)
+    print("Stamped {}".format(", ".join("{} {}".format(n, t) for (t, n) in counts.items())))
+    return counts
 
 def lookup_contact(num):
     table = dynamodb.Table('contact')
@@ -286,5 +885,4 @@ def lookup_contact(num):
 
 
 #create()
-#wait_until_active()
 #populate()
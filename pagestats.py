@@ -0,0 +1,63 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+import datetime
+import collections
+
+# Page log rollups. Every page log write adds to a counter for the unit's
+# hour and day, so activity reports read a handful of items rather than
+# the log itself. Counters are only ever added to with atomic updates,
+# any number of writers can share them.
+#
+# Shared by the web service and dynamodb.py, outside the web package so
+# the command line tools can use it without Flask or TOKEN_SECRET.
+#
+# table page_stats
+#   unit (hash)
+#   bucket (range) - granularity#UTC start, eg. 'day#2017-11-03'
+#   pages
+#
+# A request retried after a failure can count pages twice, and log
+# entries written behind our back aren't counted. dynamodb.py
+# rebuild_page_stats() recounts from the log.
+
+granularities = {
+    'hour' : '%Y-%m-%dT%H',
+    'day'  : '%Y-%m-%d',
+}
+
+
+def bucket(granularity, timestamp):
+    when = datetime.datetime.fromtimestamp(float(timestamp), datetime.timezone.utc)
+    return granularity + '#' + when.strftime(granularities[granularity])
+
+
+def bucket_start(name):
+    # Epoch seconds at the start of a bucket
+    (granularity, label) = name.split('#', 1)
+    when = datetime.datetime.strptime(label, granularities[granularity])
+    return int(when.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def count_pages(entries):
+    # (unit, bucket) -> pages, entries need a unit and timestamp
+    counts = collections.Counter()
+    for entry in entries:
+        for granularity in granularities:
+            counts[(entry['unit'], bucket(granularity, entry['timestamp']))] += 1
+    return counts
+
+
+def record_pages(table, entries):
+    # One update per bucket touched, a page storm in a single hour is
+    # two updates. Raises ClientError.
+    # Entries with the same unit and timestamp are one log item, the
+    # batch writer keeps only the last, so they are only counted once.
+    entries = {(e['unit'], e['timestamp']):e for e in entries}.values()
+    for ((unit, name), pages) in sorted(count_pages(entries).items()):
+        table.update_item(
+            Key = {'unit':unit, 'bucket':name},
+            UpdateExpression = 'ADD pages :n',
+            ExpressionAttributeValues = {':n':pages},
+        )
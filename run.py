@@ -1,8 +1,10 @@
 import os
 import base64
 
+# Development server only, see serve.py for production
+# A throwaway secret unless one is supplied
 if __name__ == '__main__':
-    os.environ['TOKEN_SECRET'] = str(base64.b64encode(b'secret'*11), 'utf-8')
+    os.environ.setdefault('TOKEN_SECRET', str(base64.b64encode(b'secret'*11), 'utf-8'))
 
 from web import app
 
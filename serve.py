@@ -0,0 +1,66 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+# Production server, for running outside of Lambda.
+# Worker processes each run a pool of threads, the app is loaded once
+# in the master and forked. Configured from the environment:
+#   PORT         listen port, default 8000
+#   WEB_WORKERS  worker processes, default 2 per core plus 1
+#   WEB_THREADS  threads per worker, default 4
+#   WEB_TIMEOUT  seconds before a stuck worker is restarted, default 30
+# TOKEN_SECRET and STAGE must be set, as for Lambda.
+#
+# Each worker process keeps its own in-memory state: the /metrics
+# counters, the item cache, the rate limit buckets and the DynamoDB
+# throttling rate. /metrics reports only the worker that answered it.
+#
+# kill -HUP <master pid> replaces the workers gracefully, requests in
+# progress are allowed to finish. To load new code without dropping
+# connections use USR2 then WINCH, see the gunicorn documentation.
+
+import os
+import multiprocessing
+
+import gunicorn.app.base
+
+
+def options():
+    return {
+        'bind' : '{}:{}'.format(os.environ.get('HOST', '0.0.0.0'), os.environ.get('PORT', 8000)),
+        'workers' : int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1)),
+        'threads' : int(os.environ.get('WEB_THREADS', 4)),
+        'worker_class' : 'gthread',
+        'timeout' : int(os.environ.get('WEB_TIMEOUT', 30)),
+        'graceful_timeout' : int(os.environ.get('WEB_TIMEOUT', 30)),
+        'preload_app' : True,
+        'post_fork' : post_fork,
+        'accesslog' : os.environ.get('WEB_ACCESS_LOG'), # '-' for stdout
+    }
+
+
+def post_fork(server, worker):
+    # Connections must not be shared with the master or other workers
+    from web.models import forget_dynamodb
+    forget_dynamodb()
+
+
+class Server(gunicorn.app.base.BaseApplication):
+    # pylint: disable=abstract-method
+    def __init__(self, app, config):
+        self.application = app
+        self.config = config
+        super().__init__()
+
+    def load_config(self):
+        for (key, value) in self.config.items():
+            if value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+if __name__ == '__main__':
+    from web import app
+    Server(app, options()).run()
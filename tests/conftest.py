@@ -21,7 +21,12 @@ def app(b64_token_secret):
     # Local import to allow testing of the import
     os.environ['TOKEN_SECRET'] = b64_token_secret
     import web
+    from web.models import role_cache
     importlib.reload(web.authenticate) # Required to prevent caching of secret
+    web.ratelimit.buckets.clear() # Each test starts with full buckets
+    web.rest.ExistingUnit.known_units.clear() # Tables are recreated per test
+    web.rest.ExistingRoleSet.known_roles.clear()
+    role_cache.clear()
     app = web.app
     app.testing = True
     return app
@@ -166,7 +166,7 @@ def test_get_token(client, b64_token_secret, mocker):
     assert len(js.get('resource_token')) > 200
     token_secret = base64.b64decode(b64_token_secret)
     jjwt = jwt.decode(js.get('resource_token'), token_secret, algorithms=['HS256'], issuer='sms-page')
-    assert len(jjwt) == 7
+    assert len(jjwt) == 12
 
     assert jjwt.get('exp') is not None
     assert jjwt.get('member_id') == '123'
@@ -175,6 +175,102 @@ def test_get_token(client, b64_token_secret, mocker):
     assert jjwt.get('iss') == 'sms-page'
     assert set(jjwt.get('roles')) == set(["ARole", "BRole", "Doggone"])
     assert set(jjwt.get('permissions')) == set(["read", "dance", "dog"])
+    assert jjwt.get('roles_version') is not None
+    assert abs(jjwt.get('auth_time') - time.time()) < 60
+    # Nothing registered, so everything is carried by name
+    assert jjwt.get('perm_mask') == 0
+    assert jjwt.get('role_mask') == 0
+
+    # Registered roles and permissions are carried as bitmasks
+    dynamodb.add_role('test', 'site-admin', ['unit-read', 'member-read', 'custom'])
+    lookup.return_value = dict(lookup.return_value, roles='["site-admin"]')
+    url_rsp = client.get('/authenticate', headers=headers)
+    jjwt = jwt.decode(json.loads(url_rsp.data).get('resource_token'), token_secret, algorithms=['HS256'], issuer='sms-page')
+    from web.permissions import permission_bits, role_bits
+    assert jjwt.get('roles') == []
+    assert jjwt.get('permissions') == ['custom']
+    assert role_bits.decode(jjwt.get('role_mask')) == set(['site-admin'])
+    assert permission_bits.decode(jjwt.get('perm_mask')) == set(['unit-read', 'member-read'])
+
+    # Role reads are cached between sign ins
+    from web import models
+    get_role = mocker.spy(models, 'get_table')
+    client.get('/authenticate', headers=headers)
+    assert not [c for c in get_role.call_args_list if c[0] == ('role',)]
+
+
+def test_refresh_token(client, b64_token_secret, mocker):
+    lookup = mocker.patch('web.authenticate.lookup_member')
+    role_lookup = mocker.patch('web.authenticate.lookup_role')
+    role_lookup.side_effect = lambda name: {'name':name, 'permissions':[name+'-perm']}
+    token_secret = base64.b64decode(b64_token_secret)
+
+    def decode(rsp):
+        tok = json.loads(rsp.data).get('resource_token')
+        return tok, jwt.decode(tok, token_secret, algorithms=['HS256'], issuer='sms-page')
+
+    lookup.return_value = {
+            'member_id' : 123,
+            'name' : "Test User",
+            'unit' : 'Test',
+            'roles' : '["ARole", "BRole"]',
+    }
+
+    # Needs a valid resource token
+    assert client.post('/authenticate/refresh').status_code == 401
+    assert client.post('/authenticate/refresh', headers={'Authorization':'Bearer XXX'}).status_code == 401
+
+    first = {
+        'member_id' : '123',
+        'name' : 'Old Name',
+        'unit' : 'Test',
+        'roles' : ['ARole', 'BRole'],
+        'roles_version' : None,
+        'permissions' : ['ARole-perm', 'BRole-perm'],
+        'auth_time' : int(time.time())-3600,
+        'iss' : 'sms-page',
+        'exp' : int(time.time())+10,
+    }
+    tok = str(jwt.encode(first, token_secret, algorithm='HS256'), 'utf-8')
+
+    # Member reread, the sign in time is carried over
+    rsp = client.post('/authenticate/refresh', headers={'Authorization':'Bearer '+tok})
+    assert rsp.status_code == 200
+    tok, claims = decode(rsp)
+    assert claims['exp'] > first['exp']
+    assert claims['auth_time'] == first['auth_time']
+    assert claims['name'] == 'Test User'
+    assert set(claims['permissions']) == set(['ARole-perm', 'BRole-perm'])
+    version = claims['roles_version']
+
+    # A role's permissions changed, the roles themselves didn't
+    role_lookup.side_effect = lambda name: {'name':name, 'permissions':[name+'-new']}
+    rsp = client.post('/authenticate/refresh', headers={'Authorization':'Bearer '+tok})
+    assert rsp.status_code == 200
+    tok, claims = decode(rsp)
+    assert set(claims['permissions']) == set(['ARole-new', 'BRole-new'])
+    assert claims['roles_version'] != version
+
+    # Roles changed, permissions are rebuilt
+    lookup.return_value = dict(lookup.return_value, roles='["CRole"]')
+    rsp = client.post('/authenticate/refresh', headers={'Authorization':'Bearer '+tok})
+    assert rsp.status_code == 200
+    tok, claims = decode(rsp)
+    assert claims['permissions'] == ['CRole-new']
+    assert claims['roles'] == ['CRole']
+
+    # Member removed
+    lookup.return_value = None
+    rsp = client.post('/authenticate/refresh', headers={'Authorization':'Bearer '+tok})
+    assert rsp.status_code == 403
+
+    # Only for so long after signing in with Graph
+    from web import authenticate
+    mocker.patch.object(authenticate, 'session_max_age', 1800)
+    assert client.post('/authenticate/refresh', headers={'Authorization':'Bearer '+tok}).status_code == 401
+    del first['auth_time']
+    old = str(jwt.encode(first, token_secret, algorithm='HS256'), 'utf-8')
+    assert client.post('/authenticate/refresh', headers={'Authorization':'Bearer '+old}).status_code == 401
 
 
 def test_auth_middleware(client, b64_token_secret):
@@ -270,6 +366,26 @@ def test_authorized(app, client, mocker):
         assert comb(mf)(unit='Test') == ({'error':'Authorization','detail':["Required role not found"]}, 403)
         assert comb(mf)(unit='NotTest') == ({'error':'Authorization','detail':["Not the member's unit"]}, 403)
 
+        # Bitmask credentials, as carried by current tokens
+        from web.permissions import permission_bits, role_bits
+        masked = Credentials(
+                member_id = 123,
+                name = 'Test User',
+                unit = 'Test',
+                roles = set(),
+                permissions = set(['sausage']),
+                role_mask = role_bits.encode(['unit-admin'])[0],
+                permission_mask = permission_bits.encode(['unit-read', 'member-read'])[0],
+        )
+        get_creds.return_value = masked
+        assert authorized(has_role('unit-admin'))(mf)() == "MF"
+        assert authorized(has_role('site-admin'))(mf)()[1] == 403
+        assert authorized(has_permission('member-read'))(mf)() == "MF"
+        assert authorized(has_permission('unit-write', 'unit-read'))(mf)() == "MF"
+        assert authorized(has_permission('member-write'))(mf)()[1] == 403
+        assert authorized(has_permission('sausage'))(mf)() == "MF"
+        get_creds.return_value = masked._replace(role_mask=0, permission_mask=0, roles=set({'foo':'bar'}), permissions=set({'sausage','frankfurt'}))
+
         assert authorized(has_permission('sausage'))(mf)() == "MF"
         assert authorized(has_permission('sausage','soup'))(mf)() == "MF"
         assert authorized(has_permission('soup'))(mf)() == ({'error':'Authorization','detail':["Required permission not found"]}, 403)
@@ -318,3 +434,32 @@ def test_authorized(app, client, mocker):
         mf_ret = "FM"
         pc = authorized(has_all(own_unit(), has_permission('sausage')))
         assert pc(mf)() == ({'error':'Authorization','detail':["Not the member's unit"]}, 403)
+
+
+def test_edge_middleware(client, b64_token_secret):
+    # Preflight is answered without reaching the app
+    pre = client.options('/rest/unit/test/members', headers={
+        'Origin':'https://example.org',
+        'Access-Control-Request-Method':'GET',
+        'Access-Control-Request-Headers':'authorization',
+    })
+    assert pre.status_code == 204
+    assert pre.data == b''
+    assert pre.headers['Access-Control-Allow-Origin'] == '*'
+    assert 'Authorization' in pre.headers['Access-Control-Allow-Headers']
+
+    # Other requests get the CORS headers added
+    rsp = client.get('/')
+    assert rsp.status_code == 200
+    assert rsp.headers['Access-Control-Allow-Origin'] == '*'
+
+    # Tokens are only decoded off the public routes
+    from web import EdgeMiddleware
+    seen = []
+    middleware = EdgeMiddleware(lambda environ, start_response: seen.append(environ), skip_paths=['/'])
+    tok = jwt.encode({'iss':'sms-page', 'exp':time.time()+10}, base64.b64decode(b64_token_secret), algorithm='HS256')
+    bearer = 'Bearer '+str(tok, 'utf-8')
+    middleware({'PATH_INFO':'/', 'HTTP_AUTHORIZATION':bearer}, None)
+    assert 'authentication.credentials' not in seen[-1]
+    middleware({'PATH_INFO':'/rest/unit/test', 'HTTP_AUTHORIZATION':bearer}, None)
+    assert seen[-1]['authentication.credentials']['iss'] == 'sms-page'
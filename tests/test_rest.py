@@ -1,4 +1,5 @@
 import pytest
+import botocore
 
 import dynamodb
 import responses
@@ -14,9 +15,8 @@ fake = Faker()
 
 @pytest.fixture
 def clear_db():
-    dynamodb.delete('test')
+    dynamodb.delete('test', wait=True)
     dynamodb.create('test')
-    #dynamodb.wait_until_active('test') # FIXME: Infinite loops
 
 @pytest.fixture
 def admin_token(token_secret):
@@ -72,7 +72,6 @@ def test_unit_contacts(client, admin_token):
     assert(jf1.get("detail") == "Cannot do operations on a non-existent table")
 
     dynamodb.create('test')
-    #dynamodb.wait_until_active('test') # TODO
 
     u1 = client.put('/rest/unit/test', data={"capcode":"23"}, headers=headers)
     assert(u1.status_code == 201)
@@ -114,7 +113,6 @@ def test_contact_table(client, admin_token):
 
 
     dynamodb.create('test')
-    # dynamodb.wait_until_active('test') # TODO
 
     u1 = client.put('/rest/unit/test', data={"capcode":"23"}, headers=headers)
     assert(u1.status_code == 201)
@@ -226,7 +224,6 @@ def test_pagelog_table(client, admin_token):
     assert(jf4.get("detail") == "Cannot do operations on a non-existent table")
 
     dynamodb.create('test')
-    #dynamodb.wait_until_active('test') # TODO
 
     # Create some dummy units
     units = ["test1", "test2", "test3"]
@@ -566,3 +563,932 @@ def test_permissions(client, clear_db):
         ('GET',  '/rest/member/666',          False),
         #('PUT',  '/rest/member/666',          False), # TODO
     ])
+
+
+def test_metrics(client, clear_db, admin_token):
+    headers = {'Authorization':"Bearer " + admin_token}
+    u1 = client.put('/rest/unit/test', headers=headers, data={"capcode":"23"})
+    assert(u1.status_code == 201)
+    g1 = client.get('/rest/unit/test', headers=headers)
+    assert(g1.status_code == 200)
+
+    m1 = client.get('/metrics')
+    assert(m1.status_code == 200)
+    assert(m1.content_type.startswith('text/plain'))
+    text = m1.data.decode('utf-8')
+    assert('# TYPE sms_page_requests_total counter' in text)
+    assert('sms_page_requests_total{resource="UnitTable",method="GET",code="200"}' in text)
+    assert('sms_page_request_duration_seconds_bucket{resource="UnitTable",method="PUT",le="+Inf"}' in text)
+    assert('sms_page_dynamodb_operations_total{table="sms-page-test-unit",operation="PutItem",outcome="ok"}' in text)
+    assert('sms_page_authorization_total{function="UnitTable.get",outcome="allowed"}' in text)
+
+
+def test_throttled(client, admin_token, mocker):
+    import botocore
+    from web import models
+    headers = {'Authorization':"Bearer " + admin_token}
+
+    throttled = botocore.exceptions.ClientError({'Error':{
+        'Code':'ProvisionedThroughputExceededException',
+        'Message':'The level of configured provisioned throughput for the table was exceeded.'
+    }}, 'GetItem')
+    get_table = mocker.patch('web.rest.get_table')
+    get_table.return_value.get_item.side_effect = throttled
+
+    g1 = client.get('/rest/unit/test', headers=headers)
+    assert(g1.status_code == 503)
+    assert(g1.headers.get('Retry-After') == str(models.retry_after))
+    assert(json.loads(g1.data).get("error") == "Throttled")
+
+    # Budget is shared by all calls within a request
+    class Op:
+        name = 'Query'
+    response = (None, {'Error':{'Code':'ThrottlingException', 'Message':'slow down'}})
+    models.reset_retry_budget(2)
+    models._spend_retry_budget(response=response, operation=Op())
+    models._spend_retry_budget(response=response, operation=Op())
+    with pytest.raises(models.RetryBudgetExhausted):
+        models._spend_retry_budget(response=response, operation=Op())
+    # Other errors don't consume the budget
+    models.reset_retry_budget(0)
+    models._spend_retry_budget(response=(None, {'Error':{'Code':'Other'}}), operation=Op())
+
+
+def test_shared_rate_limiter(app, clear_db, mocker):
+    # Each thread has its own resource, throttling is tracked for them all
+    import threading
+    from web import models
+    limiter = models._build_rate_limiter()
+    mocker.spy(limiter, 'on_sending_request')
+    mocker.spy(limiter, 'on_receiving_response')
+    mocker.patch.object(models, '_build_rate_limiter', return_value=limiter)
+    models.forget_dynamodb()
+    try:
+        resources = []
+        def read():
+            resources.append(models.get_dynamodb())
+            models.get_table('unit').get_item(Key={'name':'test'})
+        threads = [threading.Thread(target=read) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(5)
+        assert(resources[0] is not resources[1])
+        assert(limiter.on_sending_request.call_count == 2)
+        assert(limiter.on_receiving_response.call_count == 2)
+    finally:
+        mocker.stopall()
+        models.forget_dynamodb()
+
+
+def test_pagelog_post(client, clear_db, admin_token, token_secret):
+    headers = {'Authorization':"Bearer " + admin_token}
+    u1 = client.put('/rest/unit/test', data={"capcode":"23"}, headers=headers)
+    assert(u1.status_code == 201)
+
+    # Permission is separate from read
+    p0 = client.post('/rest/unit/test/pagelog', json={}, headers=headers)
+    assert(p0.status_code == 403)
+
+    write_token = jwt.encode({
+        'member_id' : 1,
+        'name' : 'Pager',
+        'unit' : 'elsewhere',
+        'roles' : [],
+        'permissions' : ['pagelog-write', 'pagelog-read'],
+        'iss' : 'sms-page',
+        'exp' : int(time.time()+1000),
+    }, token_secret, algorithm='HS256')
+    headers = {'Authorization':"Bearer " + str(write_token, 'utf-8')}
+
+    # Single form entry
+    data = {"phone_number":gen_phone(), "timestamp":"1509703002.25", "body":"Single"}
+    p1 = client.post('/rest/unit/test/pagelog', data=data, headers=headers)
+    assert(p1.status_code == 201)
+    assert(json.loads(p1.data).get("count") == 1)
+
+    # A storm of entries, several BatchWriteItem chunks
+    entries = [{
+        "phone_number":gen_phone(),
+        "timestamp":1509703100 + i/100,
+        "body":fake.text(max_nb_chars=200),
+    } for i in range(60)]
+    p2 = client.post('/rest/unit/test/pagelog', json=entries, headers=headers)
+    assert(p2.status_code == 201)
+    assert(json.loads(p2.data).get("count") == 60)
+
+    g1 = client.get('/rest/unit/test/pagelog', headers=headers)
+    assert(g1.status_code == 200)
+    assert(len(json.loads(g1.data)) == 61)
+
+    # Nothing is written if any entry is invalid
+    entries[3]["phone_number"] = "12345"
+    p3 = client.post('/rest/unit/test/pagelog', json=entries, headers=headers)
+    assert(p3.status_code == 422)
+    j3 = json.loads(p3.data)
+    assert(j3.get("error") == "ValidationError")
+    assert(list(j3.get("detail").keys()) == ['3'])
+
+    p4 = client.post('/rest/unit/other/pagelog', json=entries, headers=headers)
+    assert(p4.status_code == 404)
+
+
+def test_csv_export(client, clear_db, admin_token):
+    headers = {'Authorization':"Bearer " + admin_token}
+    u1 = client.put('/rest/unit/test', data={"capcode":"23"}, headers=headers)
+    assert(u1.status_code == 201)
+
+    phones = set(gen_phone() for i in range(30))
+    for phone in phones:
+        cr = client.put('/rest/contact/'+phone, data={"unit":"test", "member_id":"77"}, headers=headers)
+        assert(cr.status_code == 201)
+
+    headers['Accept'] = 'text/csv'
+    g1 = client.get('/rest/unit/test/contacts', headers=headers)
+    assert(g1.status_code == 200)
+    assert(g1.content_type.startswith('text/csv'))
+    rows = g1.data.decode('utf-8').splitlines()
+    # Columns follow the schema
+    assert(rows[0] == 'phone_number,unit,member_id')
+    assert(len(rows) == 31)
+    assert(set(r.split(',')[0] for r in rows[1:]) == phones)
+    assert(all(r.endswith(',test,77') for r in rows[1:]))
+
+    g2 = client.get('/rest/unit/test/pagelog', headers=headers)
+    assert(g2.status_code == 200)
+    assert(g2.data.decode('utf-8').splitlines() == ['phone_number,unit,timestamp,body'])
+
+    # JSON is still the default
+    del headers['Accept']
+    g3 = client.get('/rest/unit/test/contacts', headers=headers)
+    assert(len(json.loads(g3.data)) == 30)
+
+
+def test_csv_export_failure(app):
+    from web import rest
+    def pages():
+        yield [{'phone_number':'61400000000', 'unit':'test', 'member_id':1}]
+        raise botocore.exceptions.ClientError({'Error':{'Code':'InternalServerError'}}, 'Query')
+
+    # A failure part way through must not look like a complete export
+    with app.test_request_context('/rest/unit/test/contacts'):
+        body = rest.csv_response(rest.ContactSchema, pages()).response
+        assert(next(body).startswith('phone_number,unit,member_id'))
+        with pytest.raises(botocore.exceptions.ClientError):
+            next(body)
+
+
+def test_bulk_import(app, client, clear_db, admin_token, tmp_path):
+    from web import rest
+    headers = {'Authorization':"Bearer " + admin_token}
+    u1 = client.put('/rest/unit/test', data={"capcode":"23"}, headers=headers)
+    assert(u1.status_code == 201)
+
+    phones = sorted(set(gen_phone() for i in range(600)))
+    path = str(tmp_path / 'contacts.csv')
+    with open(path, 'w') as f:
+        f.write('phone_number,unit,member_id\n')
+        for p in phones:
+            f.write('{},test,{}\n'.format(p, gen_memberid()))
+    checkpoint = str(tmp_path / 'contacts.ckpt')
+
+    r1 = dynamodb.import_data('test', 'contact', path, concurrency=4, chunk_size=100, checkpoint=checkpoint)
+    assert(r1['written'] == len(phones))
+    assert(r1['errors'] == {})
+
+    g1 = client.get('/rest/unit/test/contacts', headers=headers)
+    assert(len(json.loads(g1.data)) == len(phones))
+
+    # Completed chunks are skipped when resumed
+    r2 = dynamodb.import_data('test', 'contact', path, concurrency=4, chunk_size=100, checkpoint=checkpoint)
+    assert(r2['written'] == 0)
+
+    # Moves by an import are recorded as removals
+    assert(client.put('/rest/unit/other', data={"capcode":"24"}, headers=headers).status_code == 201)
+    path = str(tmp_path / 'moved.csv')
+    with open(path, 'w') as f:
+        f.write('phone_number,unit,member_id\n{},other,1\n{},test,2\n'.format(phones[0], phones[1]))
+    since = rest.change_stamp()
+    assert(dynamodb.import_data('test', 'contact', path)['written'] == 2)
+    c1 = json.loads(client.get('/rest/unit/test/contacts?changed_since={}'.format(since), headers=headers).data)
+    assert(c1['removed'] == [phones[0]])
+
+    # Invalid records are reported by chunk and not written
+    path = str(tmp_path / 'members.json')
+    with open(path, 'w') as f:
+        json.dump([
+            {"member_id":1001, "name":"Valid Member", "unit":"test", "roles":[]},
+            {"member_id":1002, "name":"Bad Unit", "unit":"nowhere", "roles":[]},
+        ], f)
+    dynamodb.add_role('test', 'none', [])
+    r3 = dynamodb.import_data('test', 'member', path, chunk_size=1)
+    assert(r3['written'] == 1)
+    assert(list(r3['errors'].keys()) == [1])
+
+
+def test_member_import_roles(app, clear_db, tmp_path):
+    from web import rest
+    from web.metrics import dynamodb_count
+    dynamodb.add_role('test', 'pager', [])
+    get_table('unit').put_item(Item={'name':'test', 'capcode':23})
+    path = str(tmp_path / 'members.json')
+    with open(path, 'w') as f:
+        json.dump([{"member_id":2000+i, "name":"Member {}".format(i), "unit":"test", "roles":["pager"]}
+                   for i in range(20)], f)
+
+    # Roles are looked up once, not once per member
+    rest.ExistingRoleSet.known_roles.clear()
+    before = dynamodb_count.value('sms-page-test-role', 'Query', 'ok')
+    r1 = dynamodb.import_data('test', 'member', path, concurrency=1, chunk_size=5)
+    assert(r1['written'] == 20)
+    assert(dynamodb_count.value('sms-page-test-role', 'Query', 'ok') == before + 1)
+
+    # Unknown roles are still refused
+    with open(path, 'w') as f:
+        json.dump([{"member_id":3000, "name":"Member", "unit":"test", "roles":["pager", "wizard"]}], f)
+    r2 = dynamodb.import_data('test', 'member', path)
+    assert(r2['written'] == 0)
+
+
+def test_backup_restore(client, clear_db, admin_token, tmp_path):
+    headers = {'Authorization':"Bearer " + admin_token}
+    u1 = client.put('/rest/unit/test', data={"capcode":"23"}, headers=headers)
+    assert(u1.status_code == 201)
+    dynamodb.add_role('test', 'Grumio', ["none"])
+    for i in range(40):
+        cr = client.put('/rest/contact/'+gen_phone(), data={"unit":"test", "member_id":gen_memberid()}, headers=headers)
+        assert(cr.status_code == 201)
+    get_table('member').put_item(Item={
+        'unit'      : 'test',
+        'name'      : 'Jim Smith',
+        'member_id' : 5555,
+        'roles'     : set(['Grumio', 'none']),
+    })
+
+    directory = str(tmp_path / 'backup')
+    manifest = dynamodb.backup('test', directory, segments=1, chunk_items=7)
+    assert(manifest['tables']['contact']['items'] == 40)
+    assert(manifest['tables']['unit']['items'] == 1)
+    assert(dynamodb.verify_backup(directory, stage='test'))
+
+    c1 = json.loads(client.get('/rest/unit/test/contacts', headers=headers).data)
+    m1 = json.loads(client.get('/rest/member/5555', headers=headers).data)
+
+    dynamodb.delete('test')
+    dynamodb.create('test')
+    counts = dynamodb.restore('test', directory, concurrency=4)
+    assert(counts['contact'] == 40)
+
+    c2 = json.loads(client.get('/rest/unit/test/contacts', headers=headers).data)
+    m2 = json.loads(client.get('/rest/member/5555', headers=headers).data)
+    assert(sorted(c1, key=lambda c: c['phone_number']) == sorted(c2, key=lambda c: c['phone_number']))
+    # Roles are a set, order isn't kept
+    assert(dict(m1, roles=sorted(m1['roles'])) == dict(m2, roles=sorted(m2['roles'])))
+
+    # Corruption is detected
+    name = manifest['tables']['contact']['files'][0]['file']
+    with open(str(tmp_path / 'backup' / name), 'ab') as f:
+        f.write(b'junk')
+    assert(not dynamodb.verify_backup(directory))
+
+
+def test_item_cache(client, clear_db, admin_token, mocker):
+    from web.cache import LRUCache, MISSING
+    cache = mocker.patch('web.rest.item_cache', LRUCache(100))
+    headers = {'Authorization':"Bearer " + admin_token}
+
+    for u in ['test', 'other']:
+        ur = client.put('/rest/unit/'+u, data={"capcode":"23"}, headers=headers)
+        assert(ur.status_code == 201)
+    c1 = client.put('/rest/contact/61412123123', data={"unit":"test", "member_id":"1"}, headers=headers)
+    assert(c1.status_code == 201)
+
+    g1 = client.get('/rest/contact/61412123123', headers=headers)
+    assert(json.loads(g1.data).get('member_id') == 1)
+    l1 = client.get('/rest/unit/test/contacts', headers=headers)
+    assert(len(json.loads(l1.data)) == 1)
+
+    # Changes made behind our back are hidden until the TTL expires
+    get_table('contact').put_item(Item={'phone_number':'61412123123', 'unit':'test', 'member_id':2})
+    g2 = client.get('/rest/contact/61412123123', headers=headers)
+    assert(json.loads(g2.data).get('member_id') == 1)
+    assert(cache.hits >= 1)
+
+    # Unless the client asks for a fresh read
+    g3 = client.get('/rest/contact/61412123123', headers=dict(headers, **{'Cache-Control':'no-cache'}))
+    assert(json.loads(g3.data).get('member_id') == 2)
+
+    # Writes invalidate the item and both the old and new unit lists
+    c2 = client.put('/rest/contact/61412123123', data={"unit":"other", "member_id":"3"}, headers=headers)
+    assert(c2.status_code == 200)
+    g4 = client.get('/rest/contact/61412123123', headers=headers)
+    assert(json.loads(g4.data).get('member_id') == 3)
+    assert(json.loads(client.get('/rest/unit/test/contacts', headers=headers).data) == [])
+    assert(len(json.loads(client.get('/rest/unit/other/contacts', headers=headers).data)) == 1)
+
+    # Bounded, least recently used entries go first
+    small = LRUCache(2)
+    small.set('a', 1, 60)
+    small.set('b', 2, 60)
+    small.get('a')
+    small.set('c', 3, 60)
+    assert(small.get('b') is MISSING)
+    assert(small.get('a') == 1)
+
+    # A value read before an invalidation isn't kept
+    generation = small.generation('a')
+    small.invalidate('a')
+    small.set('a', 'stale', 60, generation)
+    assert(small.get('a') is MISSING)
+    small.set('a', 'fresh', 60, small.generation('a'))
+    assert(small.get('a') == 'fresh')
+
+
+def test_single_flight():
+    import threading
+    from web.singleflight import SingleFlight
+
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_read():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return ['result']
+
+    results = []
+    def reader():
+        results.append(flight.do('key', slow_read))
+
+    leader = threading.Thread(target=reader)
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=reader) for i in range(5)]
+    for f in followers:
+        f.start()
+    while flight.shared < 5:
+        time.sleep(0.01)
+    release.set()
+    for t in [leader] + followers:
+        t.join(5)
+
+    assert(len(calls) == 1)
+    assert(results == [['result']]*6)
+    assert(flight.stats() == {'calls':1, 'shared':5, 'in_flight':0})
+
+    # Failures are shared too, and nothing is remembered afterwards
+    def broken():
+        raise ValueError("broken")
+    with pytest.raises(ValueError):
+        flight.do('key', broken)
+    assert(flight.do('key', lambda: 'again') == 'again')
+
+
+def test_list_after_write(app, mocker):
+    # A list read after a write neither joins nor caches a read from before it
+    import threading
+    from web import rest
+    from web.cache import LRUCache
+    cache = mocker.patch('web.rest.item_cache', LRUCache(100))
+    started = threading.Event()
+    release = threading.Event()
+    reads = []
+
+    def list_pages(self, key):
+        reads.append(key)
+        if len(reads) == 1:
+            started.set()
+            release.wait(5)
+            yield [{'unit':key, 'name':'Before'}]
+        else:
+            yield [{'unit':key, 'name':'After'}]
+    mocker.patch.object(rest.MemberUnitTable, '_list_pages', list_pages)
+
+    results = []
+    def early():
+        with app.test_request_context():
+            results.append(rest.MemberUnitTable().list_items('test'))
+    thread = threading.Thread(target=early)
+    thread.start()
+    started.wait(5)
+    with app.test_request_context():
+        rest.MemberTable()._cache_invalidate({'member_id':1, 'unit':'test'})
+        assert(rest.MemberUnitTable().list_items('test') == [{'unit':'test', 'name':'After'}])
+    release.set()
+    thread.join(5)
+
+    assert(results == [[{'unit':'test', 'name':'Before'}]])
+    assert(len(reads) == 2)
+    with app.test_request_context():
+        assert(rest.MemberUnitTable().list_items('test') == [{'unit':'test', 'name':'After'}])
+    assert(len(reads) == 2)
+
+
+def test_member_contacts(client, clear_db, admin_token, token_secret):
+    headers = {'Authorization':"Bearer " + admin_token}
+    for u in ['test', 'other']:
+        ur = client.put('/rest/unit/'+u, data={"capcode":"23"}, headers=headers)
+        assert(ur.status_code == 201)
+
+    phones = sorted(gen_phone() for i in range(3))
+    for p in phones:
+        cr = client.put('/rest/contact/'+p, data={"unit":"test", "member_id":"4321"}, headers=headers)
+        assert(cr.status_code == 201)
+    cr = client.put('/rest/contact/'+gen_phone(), data={"unit":"test", "member_id":"1234"}, headers=headers)
+    assert(cr.status_code == 201)
+
+    g1 = client.get('/rest/member/4321/contacts', headers=headers)
+    assert(g1.status_code == 200)
+    assert(sorted(c['phone_number'] for c in json.loads(g1.data)) == phones)
+    assert(json.loads(client.get('/rest/member/999/contacts', headers=headers).data) == [])
+    assert(client.get('/rest/member/abc/contacts', headers=headers).status_code == 422)
+    assert(client.get('/rest/member/abc', headers=headers).status_code == 422)
+
+    # Own unit access needs every contact to be in the unit
+    unit_admin = str(jwt.encode({
+        'member_id' : 2,
+        'name' : 'Unit Admin',
+        'unit' : 'test',
+        'roles' : ['unit-admin'],
+        'permissions' : ['myunit-contact-read'],
+        'iss' : 'sms-page',
+        'exp' : int(time.time()+1000),
+    }, token_secret, algorithm='HS256'), 'utf-8')
+    uheaders = {'Authorization':"Bearer " + unit_admin}
+    assert(client.get('/rest/member/4321/contacts', headers=uheaders).status_code == 200)
+
+    cr = client.put('/rest/contact/'+phones[0], data={"unit":"other", "member_id":"4321"}, headers=headers)
+    assert(cr.status_code == 200)
+    assert(client.get('/rest/member/4321/contacts', headers=uheaders).status_code == 403)
+    assert(client.get('/rest/member/4321/contacts', headers=headers).status_code == 200)
+
+
+def test_member_search(app, client, clear_db, admin_token):
+    from web import rest
+    rest.member_names.clear()
+    headers = {'Authorization':"Bearer " + admin_token}
+    for u in ['test', 'other']:
+        ur = client.put('/rest/unit/'+u, data={"capcode":"23"}, headers=headers)
+        assert(ur.status_code == 201)
+    names = ['Jane Smith', 'José Ávila', 'John Smithers', 'Mary Jones']
+    for (i, name) in enumerate(names):
+        get_table('member').put_item(Item={'unit':'test', 'name':name, 'member_id':100+i, 'roles':set(['none'])})
+
+    def search(q, **args):
+        res = client.get('/rest/unit/test/members', query_string=dict(q=q, **args), headers=headers)
+        assert(res.status_code == 200)
+        return sorted(m['name'] for m in json.loads(res.data))
+
+    assert(search('j') == ['Jane Smith', 'John Smithers', 'José Ávila', 'Mary Jones'])
+    assert(search('SMI') == ['Jane Smith', 'John Smithers'])
+    assert(search('jose av') == ['José Ávila'])
+    assert(search('avila') == ['José Ávila'])
+    assert(search('smithers') == ['John Smithers'])
+    assert(search('x') == [])
+    assert(len(search('j', limit=2)) == 2)
+    for limit in ('0', '-1', 'all'):
+        res = client.get('/rest/unit/test/members', query_string={'q':'j', 'limit':limit}, headers=headers)
+        assert(res.status_code == 422)
+
+    # Writes behind our back aren't seen, writes through MemberTable are
+    get_table('member').put_item(Item={'unit':'test', 'name':'Sam Smart', 'member_id':200, 'roles':set(['none'])})
+    assert(search('sm') == ['Jane Smith', 'John Smithers'])
+    with app.test_request_context():
+        item = {'member_id':'101', 'name':'José Ávila', 'unit':'other', 'roles':set(['none'])}
+        assert(rest.MemberTable().single_put(item)[1] == 200)
+    assert(search('sm') == ['Jane Smith', 'John Smithers', 'Sam Smart'])
+    assert(search('jos') == [])
+
+
+def test_contact_pagelog(client, clear_db, admin_token, token_secret):
+    headers = {'Authorization':"Bearer " + admin_token}
+    phone = gen_phone()
+    for i in range(10):
+        dynamodb.add_pagelog('test', 'test', decimal.Decimal(1000+i), phone, 'Page '+str(i))
+    dynamodb.add_pagelog('test', 'test', decimal.Decimal(999), gen_phone(), 'Other number')
+
+    def pages(token_headers, **args):
+        res = client.get('/rest/contact/'+phone+'/pagelog', query_string=args, headers=token_headers)
+        return res.status_code, [p['body'] for p in json.loads(res.data)] if res.status_code == 200 else None
+
+    assert(pages(headers) == (200, ['Page '+str(i) for i in range(9, -1, -1)]))
+    assert(pages(headers, limit=3) == (200, ['Page 9', 'Page 8', 'Page 7']))
+    assert(pages(headers, since=1002, until='1004.5') == (200, ['Page 4', 'Page 3', 'Page 2']))
+    assert(pages(headers, since=1008) == (200, ['Page 9', 'Page 8']))
+    assert(pages(headers, until=1000) == (200, ['Page 0']))
+    assert(pages(headers, since='x')[0] == 422)
+    for bad in ({'since':'NaN'}, {'since':'Infinity'}, {'until':'1e200'}, {'until':'-sNaN'}):
+        assert(pages(headers, **bad)[0] == 422)
+    assert(pages(headers, since=1005, until=1002)[0] == 422)
+    assert(pages(headers, since=1005, until=1005) == (200, ['Page 5']))
+
+    unit_member = str(jwt.encode({
+        'member_id' : 2,
+        'name' : 'Unit Member',
+        'unit' : 'test',
+        'roles' : ['none'],
+        'permissions' : ['myunit-pagelog-read'],
+        'iss' : 'sms-page',
+        'exp' : int(time.time()+1000),
+    }, token_secret, algorithm='HS256'), 'utf-8')
+    uheaders = {'Authorization':"Bearer " + unit_member}
+    assert(pages(uheaders, limit=1) == (200, ['Page 9']))
+
+    # Paged by another unit as well, only site wide readers see it
+    dynamodb.add_pagelog('test', 'other', decimal.Decimal(2000), phone, 'Other unit')
+    assert(pages(uheaders)[0] == 403)
+    assert(pages(headers, limit=1) == (200, ['Other unit']))
+
+
+def test_pagelog_stats(client, clear_db, admin_token, token_secret):
+    headers = {'Authorization':"Bearer " + admin_token}
+    u1 = client.put('/rest/unit/test', data={"capcode":"23"}, headers=headers)
+    assert(u1.status_code == 201)
+
+    write_token = jwt.encode({
+        'member_id' : 1,
+        'name' : 'Pager',
+        'unit' : 'test',
+        'roles' : [],
+        'permissions' : ['pagelog-write'],
+        'iss' : 'sms-page',
+        'exp' : int(time.time()+1000),
+    }, token_secret, algorithm='HS256')
+    wheaders = {'Authorization':"Bearer " + str(write_token, 'utf-8')}
+
+    # 2017-11-03 10:00 UTC, two pages that hour, one the next, one the next day
+    base = 1509703200
+    entries = [{"phone_number":gen_phone(), "timestamp":base+t, "body":"Page"}
+               for t in (0, 1800, 3600, 86400)]
+    p1 = client.post('/rest/unit/test/pagelog', json=entries, headers=wheaders)
+    assert(p1.status_code == 201)
+    dynamodb.add_pagelog('test', 'test', decimal.Decimal(base+60), gen_phone(), 'Single')
+
+    def stats(**args):
+        res = client.get('/rest/unit/test/pagelog/stats', query_string=args, headers=headers)
+        assert(res.status_code == 200)
+        return [(s['bucket'], s['pages']) for s in json.loads(res.data)]
+
+    assert(stats() == [('2017-11-03', 4), ('2017-11-04', 1)])
+    assert(stats(granularity='hour', until=base+3600) == [('2017-11-03T10', 3), ('2017-11-03T11', 1)])
+    assert(stats(granularity='hour', since=base+3600) == [('2017-11-03T11', 1), ('2017-11-04T10', 1)])
+    day = json.loads(client.get('/rest/unit/test/pagelog/stats', headers=headers).data)[0]
+    assert(day['start'] == 1509667200)
+    bad = client.get('/rest/unit/test/pagelog/stats', query_string={'granularity':'week'}, headers=headers)
+    assert(bad.status_code == 422)
+    reversed_range = {'since':base+86400, 'until':base}
+    bad = client.get('/rest/unit/test/pagelog/stats', query_string=reversed_range, headers=headers)
+    assert(bad.status_code == 422)
+    assert(stats(since=base, until=base) == [('2017-11-03', 4)])
+
+    # Timestamps the rollups can't bucket are refused before writing
+    for ts in (1e12, 1e20, 'NaN'):
+        p2 = client.post('/rest/unit/test/pagelog', json=[{"phone_number":gen_phone(), "timestamp":ts, "body":"Page"}], headers=wheaders)
+        assert(p2.status_code == 422)
+    assert(len(json.loads(client.get('/rest/unit/test/pagelog', headers=headers).data)) == 5)
+
+    # Repeated entries are one log item and counted once
+    dup = {"phone_number":gen_phone(), "timestamp":base+2*86400, "body":"Page"}
+    p3 = client.post('/rest/unit/test/pagelog', json=[dup, dict(dup)], headers=wheaders)
+    assert(p3.status_code == 201)
+    assert(stats() == [('2017-11-03', 4), ('2017-11-04', 1), ('2017-11-05', 1)])
+
+    # Rebuild recounts from the log
+    stats_table = get_table('page_stats')
+    stats_table.put_item(Item={'unit':'test', 'bucket':'day#2017-11-03', 'pages':99})
+    stats_table.put_item(Item={'unit':'test', 'bucket':'day#2001-01-01', 'pages':1})
+    dynamodb.rebuild_page_stats('test', segments=1)
+    assert(stats() == [('2017-11-03', 4), ('2017-11-04', 1), ('2017-11-05', 1)])
+
+
+@responses.activate
+def test_warm(client, clear_db, admin_token):
+    from web import warm, rest
+    responses.add(responses.HEAD, 'https://graph.microsoft.com/v1.0/', status=401)
+    headers = {'Authorization':"Bearer " + admin_token}
+    u1 = client.put('/rest/unit/Warmed', data={"capcode":"23"}, headers=headers)
+    assert(u1.status_code == 201)
+    dynamodb.populate_role('test')
+    rest.ExistingUnit.known_units.clear()
+    rest.ExistingRoleSet.known_roles.clear()
+
+    report = warm.warm({}, None)
+    assert(report['errors'] == {})
+    assert(set(report['steps']) == set(name for (name, _) in warm.steps))
+    # Each value is rounded separately
+    assert(report['total'] >= sum(report['steps'].values()) - 0.001)
+    # The scan counts as a lookup of every name, the TTL outlives the
+    # 4 minute schedule
+    assert(time.monotonic() - rest.ExistingUnit.known_units['Warmed'] < 5)
+    assert(time.monotonic() - rest.ExistingRoleSet.known_roles['unit-admin'] < 5)
+    assert(rest.ExistingUnit.known_unit_ttl > 240)
+
+    # A name gone from the table keeps the age of its own lookup
+    looked_up = time.monotonic() - rest.ExistingUnit.known_unit_ttl - 1
+    rest.ExistingUnit.known_units['Deleted'] = looked_up
+    assert(not warm.warm()['cold'])
+    assert(rest.ExistingUnit.known_units['Deleted'] == looked_up)
+    assert(not rest.ExistingUnit._verify_unit_exists('Deleted'))
+
+
+def test_rate_limit(client, clear_db, admin_token, token_secret, mocker):
+    from web import rest
+    from web.ratelimit import Limit
+    from web.metrics import rate_limited_count
+    mocker.patch.object(rest.UnitTable, 'rate_limit', Limit(rate=0.01, burst=3))
+    headers = {'Authorization':"Bearer " + admin_token}
+
+    for i in range(3):
+        assert(client.get('/rest/unit/test', headers=headers).status_code == 404)
+    limited = client.get('/rest/unit/test', headers=headers)
+    assert(limited.status_code == 429)
+    assert(int(limited.headers['Retry-After']) >= 1)
+    assert(json.loads(limited.data).get('error') == 'RateLimited')
+    assert(rate_limited_count.value('UnitTable', 'member') >= 1)
+
+    # Other members of the unit have their own bucket, up to the unit's limit
+    other = str(jwt.encode({
+        'member_id' : 2,
+        'name' : 'Other',
+        'unit' : 'test',
+        'roles' : [],
+        'permissions' : ['unit-read'],
+        'iss' : 'sms-page',
+        'exp' : int(time.time()+1000),
+    }, token_secret, algorithm='HS256'), 'utf-8')
+    oheaders = {'Authorization':"Bearer " + other}
+    assert(client.get('/rest/unit/test', headers=oheaders).status_code == 404)
+
+    # Other resources are unaffected
+    assert(client.get('/rest/unit/test/contacts', headers=headers).status_code == 404)
+
+    # Page log writes are exempt, reads are not
+    mocker.patch.object(rest.PageLogUnitTable, 'rate_limit', Limit(rate=0.01, burst=3))
+    for i in range(5):
+        assert(client.post('/rest/unit/test/pagelog', headers=headers).status_code == 403)
+    for i in range(3):
+        assert(client.get('/rest/unit/test/pagelog', headers=headers).status_code == 404)
+    assert(client.get('/rest/unit/test/pagelog', headers=headers).status_code == 429)
+
+    # Anonymous callers are bucketed by address, behind a trusted proxy
+    # by the forwarded one
+    from web import ratelimit
+    mocker.patch.object(rest.RoleTable, 'rate_limit', Limit(rate=0.01, burst=1))
+    def role(forwarded):
+        return client.get('/rest/role/none', headers={'X-Forwarded-For':forwarded}).status_code
+    assert(role('10.0.0.1') != 429)
+    assert(role('10.0.0.2') == 429) # Spoofable, so ignored by default
+    mocker.patch.object(ratelimit, 'trusted_proxies', 1)
+    assert(role('10.0.0.3') != 429)
+    assert(role('10.0.0.4') != 429)
+    assert(role('10.0.0.9, 10.0.0.4') == 429)
+    assert(role('') == 429) # Missing, the proxy's own address
+
+    # Least recently used buckets are dropped beyond max_buckets
+    limited_buckets = ratelimit.TokenBuckets(max_buckets=2)
+    tight = Limit(rate=0.01, burst=1)
+    assert(limited_buckets.take([('a', tight)]) == (None, 0))
+    assert(limited_buckets.take([('b', tight)]) == (None, 0))
+    assert(limited_buckets.take([('a', tight)])[0] == 0)
+    assert(limited_buckets.take([('c', tight)]) == (None, 0))
+    assert(len(limited_buckets) == 2)
+    assert(limited_buckets.take([('a', tight)])[0] == 0) # Kept, b was dropped
+    assert(limited_buckets.take([('b', tight)]) == (None, 0))
+
+
+def test_request_profiling(client, clear_db, admin_token, token_secret, tmp_path, mocker):
+    from web import profiling, rest
+    mocker.patch.object(profiling, 'profile_dir', str(tmp_path))
+    headers = {'Authorization':"Bearer " + admin_token, 'X-Profile':'1'}
+    u1 = client.put('/rest/unit/test', data={"capcode":"23"}, headers=headers)
+    assert(u1.status_code == 201)
+
+    # Off unless enabled, and only for the profiling permission
+    assert('X-Profile-Id' not in client.get('/rest/unit/test', headers=headers).headers)
+    mocker.patch.object(profiling, 'enabled', True)
+    assert('X-Profile-Id' not in client.get('/rest/unit/test', headers=headers).headers)
+
+    profiler = str(jwt.encode({
+        'member_id' : 3,
+        'name' : 'Profiler',
+        'unit' : 'test',
+        'roles' : [],
+        'permissions' : ['unit-read', 'request-profile'],
+        'iss' : 'sms-page',
+        'exp' : int(time.time()+1000),
+    }, token_secret, algorithm='HS256'), 'utf-8')
+    pheaders = {'Authorization':"Bearer " + profiler}
+    assert('X-Profile-Id' not in client.get('/rest/unit/test', headers=pheaders).headers)
+
+    g1 = client.get('/rest/unit/test', headers=dict(pheaders, **{'X-Profile':'1'}))
+    assert(g1.status_code == 200)
+    assert(json.loads(g1.data).get('capcode') == 23)
+    profile_id = g1.headers['X-Profile-Id']
+    assert(set(json.loads(g1.headers['X-Profile-Summary'])) == set(['app', 'boto', 'marshmallow', 'flask', 'other']))
+    assert((tmp_path / (profile_id + '.prof')).exists())
+    with open(str(tmp_path / (profile_id + '.json'))) as f:
+        summary = json.load(f)
+    assert(summary['resource'] == 'UnitTable')
+    assert(summary['categories']['boto'] > 0)
+    assert(len(summary['top']) > 0)
+
+    # Saved when the resource raises, with the response code
+    from werkzeug.exceptions import NotFound
+    def saved():
+        return set(p.name for p in tmp_path.glob('*.json'))
+    before = saved()
+    mocker.patch.object(rest.UnitTable, 'single_get', side_effect=NotFound())
+    assert(client.get('/rest/unit/test', headers=dict(pheaders, **{'X-Profile':'1'})).status_code == 404)
+    mocker.patch.object(rest.UnitTable, 'single_get', side_effect=RuntimeError('broken'))
+    with pytest.raises(RuntimeError):
+        client.get('/rest/unit/test', headers=dict(pheaders, **{'X-Profile':'1'}))
+    codes = []
+    for name in saved() - before:
+        with open(str(tmp_path / name)) as f:
+            codes.append(json.load(f)['code'])
+    assert(sorted(codes) == [404, 500])
+
+
+def test_memory_tracing(client, clear_db, admin_token, mocker, caplog):
+    from web import memory
+    from web.models import get_dynamodb
+    from web.metrics import memory_peak_bytes
+    headers = {'Authorization':"Bearer " + admin_token}
+    assert(client.put('/rest/unit/test', data={"capcode":"23"}, headers=headers).status_code == 201)
+    for i in range(20):
+        c = client.put('/rest/contact/'+gen_phone(), data={"unit":"test", "member_id":str(i)}, headers=headers)
+        assert(c.status_code == 201)
+
+    mocker.patch.object(memory, 'enabled', True)
+    memory.trace_dynamodb(get_dynamodb().meta.client)
+    before = memory_peak_bytes.count('ContactUnitTable', 'encode')
+    with caplog.at_level('INFO', logger='web.memory'):
+        g1 = client.get('/rest/unit/test/contacts', headers=dict(headers, **{'Cache-Control':'no-cache'}))
+    assert(g1.status_code == 200)
+    assert(len(json.loads(g1.data)) == 20)
+
+    reports = [r.memory for r in caplog.records if hasattr(r, 'memory')]
+    assert(len(reports) == 1)
+    report = reports[0]
+    assert(report['resource'] == 'ContactUnitTable')
+    assert(set(report['phases']) == set(['app', 'query', 'deserialize', 'encode', 'respond']))
+    for name in ('query', 'deserialize', 'encode'):
+        assert(report['phases'][name]['peak'] > 0)
+    assert(report['peak'] == max(p['peak'] for p in report['phases'].values()))
+    assert(memory_peak_bytes.count('ContactUnitTable', 'encode') == before + 1)
+
+    # Without tracemalloc.reset_peak(), before Python 3.9
+    mocker.patch.object(memory, '_reset_peak', None)
+    with caplog.at_level('INFO', logger='web.memory'):
+        g2 = client.get('/rest/unit/test/contacts', headers=dict(headers, **{'Cache-Control':'no-cache'}))
+    assert(g2.status_code == 200)
+    report = [r.memory for r in caplog.records if hasattr(r, 'memory')][-1]
+    assert(report['phases']['encode']['peak'] > 0)
+    assert(report['peak'] == max(p['peak'] for p in report['phases'].values()))
+
+
+def test_fast_lists(client, clear_db, admin_token, mocker):
+    from web import rest
+    from web.models import get_table, python_value
+    headers = {'Authorization':"Bearer " + admin_token, 'Cache-Control':'no-cache'}
+    assert(client.put('/rest/unit/test', data={"capcode":"23"}, headers=headers).status_code == 201)
+    for i in range(30):
+        get_table('member').put_item(Item={'unit':'test', 'name':fake.name(), 'member_id':100+i,
+                                           'roles':set(['none', 'unit-admin'])})
+        get_table('contact').put_item(Item={'unit':'test', 'phone_number':gen_phone(), 'member_id':100+i})
+        get_table('page_log').put_item(Item={'unit':'test', 'phone_number':gen_phone(), 'body':'page',
+                                             'timestamp':decimal.Decimal('1500000000.25')+i})
+
+    def fetch(path, csv=False):
+        h = dict(headers, Accept='text/csv') if csv else headers
+        r = client.get(path, headers=h)
+        assert(r.status_code == 200)
+        if csv:
+            return sorted(r.data.decode('utf-8').splitlines())
+        items = json.loads(r.data)
+        for item in items:
+            if 'roles' in item:
+                item['roles'] = sorted(item['roles'])
+        return sorted(items, key=lambda i: i['phone_number'] if 'phone_number' in i else i['member_id'])
+
+    paths = ['/rest/unit/test/members', '/rest/unit/test/contacts', '/rest/unit/test/pagelog']
+    slow = [(fetch(p), fetch(p, csv=True)) for p in paths]
+    mocker.patch.object(rest, 'fast_lists', True)
+    resource_query = mocker.spy(rest.DynamoResource, '_query_pages')
+    fast = [(fetch(p), fetch(p, csv=True)) for p in paths]
+    assert(resource_query.call_count == 0)
+    assert(fast == slow)
+    assert(len(fast[2][0]) == 30)
+    assert(fast[2][0][0]['timestamp'] != int(fast[2][0][0]['timestamp']))
+
+    # Cached lists aren't shared between the two paths
+    mocker.patch.object(rest.item_cache, 'size', 1000)
+    mocker.patch.object(rest.MemberUnitTable, 'rate_limit', None)
+    rest.item_cache.clear()
+    headers = {'Authorization':"Bearer " + admin_token}
+    members = '/rest/unit/test/members'
+    name = slow[0][0][0]['name']
+    def cached_reads():
+        return [fetch(members), fetch(members, csv=True),
+                json.loads(client.get(members + '?q=' + name, headers=headers).data)]
+    for fast_path in (True, False, True):
+        mocker.patch.object(rest, 'fast_lists', fast_path)
+        assert(cached_reads() == cached_reads())
+        assert(cached_reads()[:2] == list(slow[0]))
+    assert(('list', 'member', 'unit', 'test', 'fast') in rest.item_cache._items)
+    assert(('list', 'member', 'unit', 'test') in rest.item_cache._items)
+
+    assert(python_value({'N':'12'}) == 12)
+    assert(python_value({'N':'1.5'}) == 1.5)
+    assert(python_value({'N':'2.0'}) == 2 and isinstance(python_value({'N':'2.0'}), int))
+    assert(python_value({'NS':['1', '2.5']}) == [1, 2.5])
+    assert(python_value({'M':{'a':{'L':[{'S':'x'}, {'BOOL':True}, {'NULL':True}]}}}) == {'a':['x', True, None]})
+
+
+def test_changed_since(client, clear_db, admin_token, mocker):
+    from web import rest
+    from web.models import get_table
+    mocker.patch.object(rest, 'changes_overlap', 0)
+    headers = {'Authorization':"Bearer " + admin_token}
+    assert(client.put('/rest/unit/test', data={"capcode":"23"}, headers=headers).status_code == 201)
+    phones = [gen_phone() for _ in range(5)]
+    for p in phones:
+        c = client.put('/rest/contact/'+p, data={"unit":"test", "member_id":"1234"}, headers=headers)
+        assert(c.status_code == 201)
+        assert(json.loads(c.data)['updated_at'] > 0)
+
+    # Unstamped items aren't in the index until stamp_updated_at()
+    old = gen_phone()
+    get_table('contact').put_item(Item={'phone_number':old, 'unit':'test', 'member_id':99})
+
+    g1 = client.get('/rest/unit/test/contacts?changed_since=0', headers=headers)
+    assert(g1.status_code == 200)
+    c1 = json.loads(g1.data)
+    assert(sorted(i['phone_number'] for i in c1['items']) == sorted(phones))
+    watermark = c1['watermark']
+    assert(watermark > 0)
+
+    time.sleep(0.01)
+    assert(client.put('/rest/contact/'+phones[0], data={"unit":"test", "member_id":"4321"}, headers=headers).status_code == 200)
+    c2 = json.loads(client.get('/rest/unit/test/contacts?changed_since={}'.format(watermark), headers=headers).data)
+    assert([(i['phone_number'], i['member_id']) for i in c2['items']] == [(phones[0], 4321)])
+    assert(c2['watermark'] >= watermark)
+    c3 = json.loads(client.get('/rest/unit/test/contacts?changed_since={}'.format(c2['watermark']+1), headers=headers).data)
+    assert(c3['items'] == [])
+
+    dynamodb.stamp_updated_at('test', segments=2)
+    c4 = json.loads(client.get('/rest/unit/test/contacts?changed_since=0', headers=headers).data)
+    assert(old in [i['phone_number'] for i in c4['items']])
+    assert(len(c4['items']) == 6)
+
+    get_table('member').put_item(Item={'unit':'test', 'name':'Sam Smart', 'member_id':200,
+                                       'roles':set(['none']), 'updated_at':rest.change_stamp()})
+    m1 = json.loads(client.get('/rest/unit/test/members?changed_since={}'.format(watermark), headers=headers).data)
+    assert([m['member_id'] for m in m1['items']] == [200])
+
+    # Moving a contact out of the unit is a removal there
+    assert(client.put('/rest/unit/other', data={"capcode":"24"}, headers=headers).status_code == 201)
+    moved = c4['watermark']
+    time.sleep(0.01)
+    assert(client.put('/rest/contact/'+phones[1], data={"unit":"other", "member_id":"1234"}, headers=headers).status_code == 200)
+    c5 = json.loads(client.get('/rest/unit/test/contacts?changed_since={}'.format(moved), headers=headers).data)
+    assert(c5['items'] == [])
+    assert(c5['removed'] == [phones[1]])
+    o1 = json.loads(client.get('/rest/unit/other/contacts?changed_since={}'.format(moved), headers=headers).data)
+    assert([i['phone_number'] for i in o1['items']] == [phones[1]])
+    assert(o1['removed'] == [])
+
+    # Moved back, it is both removed and current, removals apply first
+    assert(client.put('/rest/contact/'+phones[1], data={"unit":"test", "member_id":"1234"}, headers=headers).status_code == 200)
+    c6 = json.loads(client.get('/rest/unit/test/contacts?changed_since={}'.format(moved), headers=headers).data)
+    assert([i['phone_number'] for i in c6['items']] == [phones[1]])
+    assert(c6['removed'] == [phones[1]])
+    assert(c4['removed'] == [])
+
+    # Removals expire with the table's TTL, older watermarks are refused
+    ttl = get_table('removal').meta.client.describe_time_to_live(TableName=get_table('removal').name)
+    assert(ttl['TimeToLiveDescription']['AttributeName'] == 'expires')
+    removal = get_table('removal').scan()['Items'][0]
+    assert(removal['expires'] == removal['updated_at'] // 1000 + rest.removal_retention * 86400)
+    expired = rest.change_stamp() - rest.removal_retention * 86400000 - 1000
+    assert(client.get('/rest/unit/test/contacts?changed_since={}'.format(expired), headers=headers).status_code == 410)
+
+    # The move and its removal are written together or not at all
+    from web import models
+    failed = botocore.exceptions.ClientError({'Error':{'Code':'InternalServerError', 'Message':'no'}}, 'TransactWriteItems')
+    transact = mocker.patch.object(models.get_dynamodb_client(), 'transact_write_items', side_effect=failed)
+    assert(client.put('/rest/contact/'+phones[1], data={"unit":"other", "member_id":"1234"}, headers=headers).status_code == 500)
+    assert(transact.call_count == 1)
+    assert(get_table('contact').get_item(Key={'phone_number':phones[1]})['Item']['unit'] == 'test')
+    # A concurrent write is retried against the item it left
+    conflict = botocore.exceptions.ClientError({'Error':{'Code':'TransactionCanceledException', 'Message':'no'}}, 'TransactWriteItems')
+    transact.side_effect = [conflict, conflict, {}]
+    assert(client.put('/rest/contact/'+phones[1], data={"unit":"other", "member_id":"1234"}, headers=headers).status_code == 200)
+    assert(transact.call_count == 4)
+    mocker.stopall()
+
+    bad = client.get('/rest/unit/test/members?changed_since=yesterday', headers=headers)
+    assert(bad.status_code == 422)
@@ -8,30 +8,48 @@ from flask import Flask, jsonify
 from web.authenticate import auth_pages, AuthMiddleware
 from web.rest import rest_pages
 from web.models import DecimalEncoder
+from web.metrics import metrics_pages
 
 
 
-class CORSMiddleware:
-    def __init__(self, wrapapp):
-        self.app = wrapapp
+CORS_HEADERS = (
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Max-Age', '86400'), # 1 day
+    ('Access-Control-Allow-Methods', 'POST, OPTIONS, GET, PUT, DELETE'),
+    ('Access-Control-Allow-Headers', 'Authorization, Content-Type, Cache-Control, X-Profile'),
+    ('Access-Control-Expose-Headers', 'Retry-After, X-Profile-Id, X-Profile-Summary'),
+)
 
+# Routes that don't use credentials
+public_paths = ['/', '/authenticate', '/metrics']
+
+
+class EdgeMiddleware(AuthMiddleware):
+    # CORS and authentication in a single layer.
+    # Preflight requests are answered here without reaching Flask, the
+    # CORS headers are the whole response. Tokens are only decoded for
+    # routes that may check them.
     def __call__(self, environ, start_response):
-        def custom_start_response(status, headers, exc_info=None):
-            headers.append(('Access-Control-Allow-Origin', '*'))
-            headers.append(('Access-Control-Max-Age', '86400')) # 1 day
-            headers.append(('Access-Control-Allow-Methods', 'POST, OPTIONS, GET, PUT, DELETE'))
-            headers.append(('Access-Control-Allow-Headers', 'Authorization'))
+        if environ.get('REQUEST_METHOD') == 'OPTIONS':
+            start_response('204 No Content', list(CORS_HEADERS))
+            return []
+
+        if environ.get('PATH_INFO') not in self.skip_paths:
+            self.decode(environ)
+
+        def cors_start_response(status, headers, exc_info=None):
+            headers.extend(CORS_HEADERS)
             return start_response(status, headers, exc_info)
-        return self.app(environ, custom_start_response)
+        return self.app(environ, cors_start_response)
 
 
 app = Flask(__name__)
 app.json_encoder = DecimalEncoder
 app.register_blueprint(auth_pages)
 app.register_blueprint(rest_pages)
+app.register_blueprint(metrics_pages)
 
-app.wsgi_app = CORSMiddleware(app.wsgi_app)
-app.wsgi_app = AuthMiddleware(app.wsgi_app)
+app.wsgi_app = EdgeMiddleware(app.wsgi_app, skip_paths=public_paths)
 
 @app.route('/')
 def basic_info():
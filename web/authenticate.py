@@ -7,17 +7,24 @@ import time
 import re
 import base64
 import json
+import hashlib
 import jwt
 import requests
+import botocore
 
 from flask import Blueprint, request, jsonify
 
-from web.models import lookup_member, lookup_role
+from web.models import lookup_member, lookup_role, retry_after
+from web.metrics import graph_latency
+from web.permissions import encode_claims
 
 # Authentication process is documented at git://sms-page/authentication.md
 
 auth_pages = Blueprint('auth_pages', __name__)
 
+# Reused for every Graph call, keeps the TLS connection open between requests
+graph_session = requests.Session()
+
 # Secret key comes from env as a base64 string
 # For good quality encryption we require a 512 bit key (64 bytes)
 # We enforce this requirement
@@ -31,13 +38,18 @@ except Exception:
     # This exception is not designed to be caught, we want to bail out
     raise EnvironmentError("The 'TOKEN_SECRET' environment variable must be supplied, it must be a base64 encoded string and it must be at least 86 characters long")
 
+# Seconds since the Graph sign in that refreshed tokens are issued for
+session_max_age = int(os.environ.get('SESSION_MAX_AGE', 14*86400))
+
 
 @auth_pages.route('/authenticate')
 def gen_resource_token():
     access_bearer = request.headers.get('Authorization') # with Bearer text
     headers = {'Authorization':access_bearer}
     resource = "https://graph.microsoft.com/v1.0/me"
-    resp = requests.get(resource, headers=headers)
+    start = time.perf_counter()
+    resp = graph_session.get(resource, headers=headers)
+    graph_latency.observe(time.perf_counter() - start, str(resp.status_code))
 
     if resp.status_code != 200:
         return ('Cannot verify authorization token', resp.status_code)
@@ -51,40 +63,100 @@ def gen_resource_token():
     else:
         return ('This service is for vicses members only.', 403)
 
-    member = lookup_member(ses_id)
-    if member is None:
-        return ('You must be authorized to use this service.', 403)
+    try:
+        member = lookup_member(ses_id)
+        if member is None:
+            return ('You must be authorized to use this service.', 403)
+
+        roles = json.loads(member['roles'])
+        role_permissions = lookup_permissions(roles)
+    except botocore.exceptions.ClientError:
+        # lookups only raise once throttling retries are exhausted
+        return busy_response()
+
+    return issue_token(ses_id, member, roles, role_permissions, int(time.time()))
+
+
+@auth_pages.route('/authenticate/refresh', methods=['POST'])
+def refresh_resource_token():
+    # Reissues a still valid resource token without going back to Graph.
+    # The member and their roles are read again, so changes to either
+    # apply. The Graph sign in time is carried over, once it is older
+    # than SESSION_MAX_AGE the member has to sign in again.
+    credentials = request.environ.get('authentication.credentials')
+    if credentials is None:
+        return ('A valid resource token is required.', 401)
+    auth_time = credentials.get('auth_time')
+    if not isinstance(auth_time, int) or auth_time + session_max_age < time.time():
+        return ('Session expired, sign in again.', 401)
+
+    ses_id = credentials.get('member_id')
+    try:
+        member = lookup_member(ses_id)
+        if member is None:
+            return ('You must be authorized to use this service.', 403)
+
+        roles = json.loads(member['roles'])
+        role_permissions = lookup_permissions(roles)
+    except botocore.exceptions.ClientError:
+        return busy_response()
+
+    return issue_token(ses_id, member, roles, role_permissions, auth_time)
 
-    roles = json.loads(member['roles'])
-    permissions = set()
+
+def busy_response():
+    return ('Service busy, try again later.', 503, {'Retry-After':str(retry_after)})
+
+
+def roles_version(role_permissions):
+    # Identifies a set of roles and what each permits, changes when a
+    # role's permissions do
+    canonical = json.dumps(role_permissions, sort_keys=True)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+
+
+def lookup_permissions(roles):
+    # role -> sorted permissions, empty for a role that can't be read
+    role_permissions = {}
     for role in roles:
         try:
-            permissions.update(lookup_role(role)['permissions'])
+            role_permissions[role] = sorted(lookup_role(role)['permissions'])
+        except botocore.exceptions.ClientError:
+            raise # Throttled, we can't issue a token missing permissions
         except Exception:
-            pass # Could have corruption, role without matching entry
+            role_permissions[role] = [] # Could have corruption, role without matching entry
+    return role_permissions
+
 
+def issue_token(ses_id, member, roles, role_permissions, auth_time):
     # Build authorization token
     # This uses an internal secret so cannot be duplicated or modified.
     # It can be validated without requiring any external resources.
+    # Roles and permissions are carried as bitmasks, see web.permissions
     authorization = {
-        'member_id'   : ses_id,
-        'name'        : member['name'],
-        'unit'        : member['unit'],
-        'roles'       : roles,
-        'permissions' : list(permissions),
-        'iss'         : 'sms-page',
-        'exp'         : int(time.time())+86400+86400, # Two days
+        'member_id'     : ses_id,
+        'name'          : member['name'],
+        'unit'          : member['unit'],
+        'roles_version' : roles_version(role_permissions),
+        'auth_time'     : auth_time, # Graph sign in, limits refreshes
+        'iss'           : 'sms-page',
+        'exp'           : int(time.time())+86400+86400, # Two days
     }
+    permissions = set().union(*role_permissions.values())
+    authorization.update(encode_claims(roles, permissions))
     token = jwt.encode(authorization, token_secret, algorithm='HS256')
 
     return jsonify({'resource_token':str(token, 'utf-8')})
 
 
 class AuthMiddleware:
-    def __init__(self, app):
+    def __init__(self, app, skip_paths=()):
         self.app = app
+        # Routes that never look at credentials, no point decoding
+        self.skip_paths = frozenset(skip_paths)
 
-    def __call__(self, environ, start_response):
+    @staticmethod
+    def decode(environ):
         try:
             auth_header = environ['HTTP_AUTHORIZATION']
             if not auth_header[:7].lower() == "bearer ":
@@ -98,4 +170,7 @@ class AuthMiddleware:
         except Exception:
             pass # We just don't set 'authentication.credentials'
 
+    def __call__(self, environ, start_response):
+        if not (self.skip_paths and environ.get('PATH_INFO') in self.skip_paths):
+            self.decode(environ)
         return self.app(environ, start_response)
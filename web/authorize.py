@@ -8,6 +8,9 @@ from typing import NamedTuple, Set
 
 from flask import request
 
+from web.metrics import authorization_count
+from web.permissions import decode_claims, permission_bits, role_bits
+
 
 # TODO: This should be somewhere else
 def auth_failure(reason):
@@ -17,6 +20,8 @@ def auth_failure(reason):
 def authorized(*predicates):
     # Multiple predicates are combined in an OR fashion
     def decorator(func):
+        name = func.__qualname__
+
         @wraps(func)
         def wrapper(*args, **kwargs):
             # kwargs contains the url matched portions
@@ -30,6 +35,7 @@ def authorized(*predicates):
                     reasons.append(error)
                 else:
                     # We matched an authorization, good to go
+                    authorization_count.inc(name, 'allowed')
                     return func(*args, **kwargs)
 
             if post_run:
@@ -40,9 +46,12 @@ def authorized(*predicates):
                     error = p(resp, **kwargs)
                     if error:
                         reasons.append(error)
+                        authorization_count.inc(name, 'denied')
                         return auth_failure(reasons)
+                authorization_count.inc(name, 'allowed')
                 return resp # All passed
             else:
+                authorization_count.inc(name, 'denied')
                 return auth_failure(reasons)
 
         return wrapper
@@ -53,8 +62,10 @@ class Credentials(NamedTuple):
     member_id: int
     name: str
     unit: str
-    roles: Set[str]
-    permissions: Set[str]
+    roles: Set[str] # Only those not covered by role_mask
+    permissions: Set[str] # Only those not covered by permission_mask
+    role_mask: int = 0
+    permission_mask: int = 0
 
 
 # Based on TurboGears predicate implementation
@@ -66,12 +77,15 @@ class Predicate:
     def get_credentials():
         # Spliting out mainly to help testing
         cdict = request.environ.get('authentication.credentials')
+        (role_mask, permission_mask, roles, permissions) = decode_claims(cdict)
         credentials = Credentials(
             member_id = cdict['member_id'],
             name = cdict['name'],
             unit = cdict['unit'],
-            roles = set(cdict['roles']),
-            permissions = set(cdict['permissions'])
+            roles = roles,
+            permissions = permissions,
+            role_mask = role_mask,
+            permission_mask = permission_mask,
         )
         return credentials
 
@@ -89,7 +103,8 @@ class Predicate:
 class PostPredicate(Predicate):
     # Called after execution of the original request
     def __call__(self, response, **kwargs):
-        (rdata, rcode) = response
+        # Responses may also carry headers, (data, code, headers)
+        (rdata, rcode) = response[:2]
         try:
             return self.evaluate(self.get_credentials(), rdata, rcode, kwargs)
         except Exception as e:
@@ -106,9 +121,11 @@ class post_own_unit(PostPredicate):
     def evaluate(self, credentials, data, code, kwargs):
         if code != 200:
             return self.failtext
-        unit = data.get('unit')
-        if credentials.unit != unit:
-            return self.failtext
+        # Index lookups return a list, every entry must be in our unit
+        items = data if isinstance(data, list) else [data]
+        for item in items:
+            if credentials.unit != item.get('unit'):
+                return self.failtext
 
 
 class own_unit(Predicate):
@@ -135,9 +152,11 @@ class has_role(Predicate):
     def __init__(self, *roles):
         super().__init__()
         self.roles = set(roles)
+        (self.mask, _) = role_bits.encode(roles)
 
     def evaluate(self, credentials, url_params):
-        if credentials.roles & self.roles:
+        # Names are still checked, for unregistered roles and old tokens
+        if credentials.role_mask & self.mask or credentials.roles & self.roles:
             return False # No error
         return "Required role not found"
 
@@ -146,9 +165,10 @@ class has_permission(Predicate):
     def __init__(self, *permissions):
         super().__init__()
         self.permissions = set(permissions)
+        (self.mask, _) = permission_bits.encode(permissions)
 
     def evaluate(self, credentials, url_params):
-        if credentials.permissions & self.permissions:
+        if credentials.permission_mask & self.mask or credentials.permissions & self.permissions:
             return False # No error
         return "Required permission not found"
 
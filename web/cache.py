@@ -0,0 +1,72 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+import time
+import threading
+from collections import OrderedDict
+
+# Bounded in-process cache with per entry expiry and LRU eviction.
+# Each process (or Lambda container) has its own copy, so entries can be
+# stale by up to their TTL when another process writes. Writes through
+# this process invalidate immediately.
+#
+# A value read from the database before a write can land after that
+# write's invalidation. Callers take generation(key) before reading and
+# pass it to set(), which drops the value if the key was invalidated in
+# between. Generations are striped over a fixed number of slots, keys
+# sharing a slot only cost an extra read.
+
+MISSING = object() # Distinguishes a cache miss from a cached None
+
+
+class LRUCache:
+    def __init__(self, size):
+        self.size = size # 0 disables the cache
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict() # key -> (expiry, value)
+        self._generations = [0] * 1024 # Invalidations per slot
+        self._lock = threading.Lock()
+
+    def _slot(self, key):
+        return hash(key) % len(self._generations)
+
+    def generation(self, key):
+        return self._generations[self._slot(key)]
+
+    def get(self, key):
+        if not self.size:
+            return MISSING
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return MISSING
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl, generation=None):
+        if not self.size:
+            return
+        with self._lock:
+            if generation is not None and self._generations[self._slot(key)] != generation:
+                return # Invalidated since the value was read
+            self._items[key] = (time.monotonic() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+            self._generations[self._slot(key)] += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._generations = [g + 1 for g in self._generations]
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,145 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+import os
+import sys
+import json
+import logging
+import threading
+import tracemalloc
+from functools import wraps
+
+from flask import request
+
+from web.metrics import memory_peak_bytes, memory_blocks
+
+# Allocation tracking per request phase, with MEMORY_PROFILING=1.
+# A request is split into phases as it runs:
+#   app         - routing, authorization, validation and our own code
+#   query       - building and sending DynamoDB requests, botocore parsing
+#   deserialize - boto3 turning the parsed response into Python types
+#   encode      - jsonify, the JSON string and its bytes in the response
+#   respond     - from the encoded response back out of the resource
+# For each phase the peak is the most memory the request held at any
+# point within it, relative to the request start, and blocks is the net
+# change in allocated blocks. Both are logged, with the report in the
+# log record's 'memory' attribute, and observed in the
+# sms_page_request_memory_peak_bytes and _blocks histograms.
+#
+# tracemalloc is process wide and slows every thread while running, so
+# one request is traced at a time and concurrent ones run untraced. They
+# still allocate while it runs, with threaded workers a traced request's
+# figures include whatever other threads allocated and freed at the same
+# time. Trace a single threaded worker for clean numbers. Streamed CSV
+# bodies are written after the resource returns and are not covered.
+#
+# Python before 3.9 has no tracemalloc.reset_peak(), only the peak since
+# the request started. There a phase's peak is exact when the request
+# reached a new high within it, otherwise it is the larger of the
+# memory held as the phase started and ended, a lower bound. The
+# request's overall peak is exact either way.
+
+enabled = os.environ.get('MEMORY_PROFILING') == '1'
+PHASES = ('app', 'query', 'deserialize', 'encode', 'respond')
+
+_local = threading.local()
+_tracing = threading.Lock()
+_reset_peak = getattr(tracemalloc, 'reset_peak', None) # Python 3.9+
+
+
+class Phases:
+    def __init__(self):
+        self.current = 'app'
+        self.peaks = dict.fromkeys(PHASES, 0)
+        self.blocks = dict.fromkeys(PHASES, 0)
+        (self.base, _) = tracemalloc.get_traced_memory()
+        self._mark()
+
+    def _mark(self):
+        if _reset_peak:
+            _reset_peak()
+        (self.start_size, self.start_peak) = tracemalloc.get_traced_memory()
+        self.start_blocks = sys.getallocatedblocks()
+
+    def switch(self, phase):
+        # Closes the current phase, phases can be entered repeatedly
+        (size, peak) = tracemalloc.get_traced_memory()
+        if not _reset_peak and peak <= self.start_peak:
+            peak = max(self.start_size, size)
+        current = self.current
+        self.peaks[current] = max(self.peaks[current], peak - self.base)
+        self.blocks[current] += sys.getallocatedblocks() - self.start_blocks
+        self.current = phase
+        self._mark()
+
+    def report(self):
+        return {
+            'peak' : max(self.peaks.values()),
+            'phases' : {p:{'peak':self.peaks[p], 'blocks':self.blocks[p]} for p in PHASES},
+        }
+
+
+def phase(name):
+    # Marks the start of a phase for the request being traced, if any
+    if not enabled:
+        return
+    phases = getattr(_local, 'phases', None)
+    if phases is not None and phases.current != name:
+        phases.switch(name)
+
+
+def _before_dynamodb_call(**kwargs):
+    phase('query')
+
+
+def _after_dynamodb_call(**kwargs):
+    # Registered first, boto3's own after-call handler does the
+    # conversion to Python types
+    phase('deserialize')
+
+
+def trace_dynamodb(client):
+    if enabled:
+        events = client.meta.events
+        events.register_first('before-parameter-build.dynamodb', _before_dynamodb_call,
+                              unique_id='sms-page-memory-before')
+        events.register_first('after-call.dynamodb', _after_dynamodb_call,
+                              unique_id='sms-page-memory-after')
+    return client
+
+
+def trace_resource(resource_func):
+    # Applied to every flask_restful resource through Api(decorators=...)
+    view_class = getattr(resource_func, 'view_class', None)
+    resource = view_class.__name__ if view_class else resource_func.__name__
+
+    @wraps(resource_func)
+    def wrapper(*args, **kwargs):
+        if not enabled or not _tracing.acquire(blocking=False):
+            return resource_func(*args, **kwargs)
+
+        started = not tracemalloc.is_tracing()
+        try:
+            if started:
+                tracemalloc.start()
+            phases = _local.phases = Phases()
+            resp = resource_func(*args, **kwargs)
+            phases.switch(None)
+        finally:
+            _local.phases = None
+            if started:
+                tracemalloc.stop()
+            _tracing.release()
+
+        report = phases.report()
+        report.update(resource=resource, method=request.method, path=request.path,
+                      code=resp.status_code)
+        for (name, values) in report['phases'].items():
+            if values['peak'] or values['blocks']:
+                memory_peak_bytes.observe(values['peak'], resource, name)
+                memory_blocks.observe(values['blocks'], resource, name)
+        logging.getLogger(__name__).info('Memory %s %s: %s', request.method, request.path,
+                                         json.dumps(report), extra={'memory':report})
+        return resp
+    return wrapper
@@ -0,0 +1,251 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+
+from flask import Blueprint, Response, request
+
+# In-process metrics registry, exposed in the Prometheus text format.
+# Every metric is a dict of label tuple -> value guarded by a single lock.
+# The hot path is one dict lookup and an add, no allocation beyond the
+# label tuple, so instrumenting every request is cheap.
+
+metrics_pages = Blueprint('metrics_pages', __name__)
+
+# Seconds, tuned for a Lambda hosted rest service
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Bytes, 64KiB to 1GiB, and allocated block counts for web.memory
+BYTE_BUCKETS = tuple(2**n for n in range(16, 31, 2))
+BLOCK_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for (name, value) in pairs:
+        value = str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+        escaped.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(escaped) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for (labels, value) in values:
+            yield '{}{} {}'.format(self.name, _format_labels(self.labels, labels), value)
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per bucket counts..., +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        # Counts are stored per bucket and accumulated when rendered
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = [0] * (len(self.buckets) + 2)
+                self._values[labels] = entry
+            entry[idx] += 1
+            entry[-1] += value
+
+    def count(self, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            return 0
+        return sum(entry[:-1])
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        with self._lock:
+            values = sorted((k, list(v)) for (k, v) in self._values.items())
+        for (labels, entry) in values:
+            total = 0
+            for (bound, count) in zip(self.buckets, entry):
+                total += count
+                yield '{}_bucket{} {}'.format(
+                    self.name, _format_labels(self.labels, labels, [('le', repr(bound))]), total)
+            total += entry[-2]
+            yield '{}_bucket{} {}'.format(
+                self.name, _format_labels(self.labels, labels, [('le', '+Inf')]), total)
+            yield '{}_sum{} {}'.format(self.name, _format_labels(self.labels, labels), entry[-1])
+            yield '{}_count{} {}'.format(self.name, _format_labels(self.labels, labels), total)
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self.metrics:
+                # Module reloads re-register, keep the original values
+                return self.metrics[metric.name]
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in sorted(self.metrics.values(), key=lambda m: m.name):
+            lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_count = registry.counter(
+    'sms_page_requests_total',
+    'Requests handled per rest resource, method and status code',
+    ('resource', 'method', 'code'))
+request_latency = registry.histogram(
+    'sms_page_request_duration_seconds',
+    'Request latency per rest resource and method',
+    ('resource', 'method'))
+dynamodb_count = registry.counter(
+    'sms_page_dynamodb_operations_total',
+    'DynamoDB operations per table, operation and outcome',
+    ('table', 'operation', 'outcome'))
+dynamodb_latency = registry.histogram(
+    'sms_page_dynamodb_duration_seconds',
+    'DynamoDB operation latency per table and operation',
+    ('table', 'operation'))
+graph_latency = registry.histogram(
+    'sms_page_graph_duration_seconds',
+    'Microsoft Graph call latency from /authenticate',
+    ('code',))
+read_coalescing_count = registry.counter(
+    'sms_page_read_coalescing_total',
+    'Identical concurrent reads, backend calls made and callers sharing a call',
+    ('outcome',))
+authorization_count = registry.counter(
+    'sms_page_authorization_total',
+    'Authorization outcomes per protected function',
+    ('function', 'outcome'))
+
+rate_limited_count = registry.counter(
+    'sms_page_rate_limited_total',
+    'Requests refused by rate limiting per rest resource and exhausted bucket',
+    ('resource', 'scope'))
+warmup_latency = registry.histogram(
+    'sms_page_warmup_duration_seconds',
+    'Keep-warm step latency, see web.warm',
+    ('step',))
+memory_peak_bytes = registry.histogram(
+    'sms_page_request_memory_peak_bytes',
+    'Peak traced memory per rest resource and request phase, see web.memory',
+    ('resource', 'phase'), BYTE_BUCKETS)
+memory_blocks = registry.histogram(
+    'sms_page_request_memory_blocks',
+    'Net allocated blocks per rest resource and request phase, see web.memory',
+    ('resource', 'phase'), BLOCK_BUCKETS)
+
+
+def instrument_resource(resource_func):
+    # Applied to every flask_restful resource through Api(decorators=...)
+    # Wraps the output stage so the final status code is available
+    view_class = getattr(resource_func, 'view_class', None)
+    resource = view_class.__name__ if view_class else resource_func.__name__
+
+    @wraps(resource_func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        code = 500
+        try:
+            resp = resource_func(*args, **kwargs)
+            code = resp.status_code
+            return resp
+        finally:
+            method = request.method
+            request_latency.observe(time.perf_counter() - start, resource, method)
+            request_count.inc(resource, method, str(code))
+    return wrapper
+
+
+def _before_dynamodb_call(params, context, **kwargs):
+    context['metrics_start'] = time.perf_counter()
+    # Batch operations name their tables in RequestItems
+    table = params.get('TableName') or ','.join(sorted(params.get('RequestItems', {})))
+    context['metrics_table'] = table
+
+
+def _after_dynamodb_call(http_response, parsed, model, context, **kwargs):
+    start = context.get('metrics_start')
+    if start is None:
+        return
+    table = context.get('metrics_table', '')
+    dynamodb_latency.observe(time.perf_counter() - start, table, model.name)
+    outcome = 'error' if 'Error' in parsed else 'ok'
+    dynamodb_count.inc(table, model.name, outcome)
+
+
+def instrument_dynamodb(client):
+    # Uses the botocore event hooks, so every call made via the
+    # client is counted regardless of call site
+    events = client.meta.events
+    events.register('before-parameter-build.dynamodb', _before_dynamodb_call,
+                    unique_id='sms-page-metrics-before')
+    events.register('after-call.dynamodb', _after_dynamodb_call,
+                    unique_id='sms-page-metrics-after')
+    return client
+
+
+@metrics_pages.route('/metrics')
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
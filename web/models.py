@@ -5,10 +5,17 @@
 import decimal
 import sys
 import os
+import threading
 import boto3
 import botocore
+import botocore.config
+from botocore.retries import adaptive, bucket, standard, throttling
 from flask.json import JSONEncoder
 
+from web.cache import LRUCache, MISSING
+from web.metrics import instrument_dynamodb
+from web.memory import trace_dynamodb
+
 
 # TODO: Split into multiple encoders, Decimal and set
 class DecimalEncoder(JSONEncoder):
@@ -23,17 +30,184 @@ class DecimalEncoder(JSONEncoder):
         return super(DecimalEncoder, self).default(o)
 
 
-def get_table(name):
-    aws = boto3.Session()
+def number_value(text):
+    # A DynamoDB number as DecimalEncoder would output its Decimal
+    try:
+        return int(text)
+    except ValueError:
+        return fraction_value(text)
+
+
+def fraction_value(text):
+    # As number_value, for numbers that usually have a fractional part
+    value = float(text)
+    if value.is_integer():
+        return int(decimal.Decimal(text))
+    return value
+
+
+def python_value(value, number=number_value):
+    # A low level client attribute value, {type:data}, as it would be
+    # output after the resource layer and DecimalEncoder. Sets are lists.
+    ((kind, data),) = value.items()
+    if kind == 'S' or kind == 'SS' or kind == 'BOOL':
+        return data
+    if kind == 'N':
+        return number(data)
+    if kind == 'NS':
+        return [number_value(n) for n in data]
+    if kind == 'M':
+        return {k:python_value(v) for (k, v) in data.items()}
+    if kind == 'L':
+        return [python_value(v) for v in data]
+    if kind == 'NULL':
+        return None
+    return data # B and BS
+
+
+# Throttling is handled as in botocore's adaptive retry mode, client side
+# rate limiting with exponential backoff and jitter. Adaptive mode gives
+# every client its own rate limiter, and every thread has its own
+# client, so clients use standard mode and share one limiter. It is
+# thread safe, the whole process slows down when throttled. Each worker
+# process has its own.
+# On top of that each request gets a retry budget shared by all of its
+# DynamoDB calls, once spent we give up and tell the client to come back.
+THROTTLE_CODES = frozenset([
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+])
+
+retry_config = botocore.config.Config(retries={
+    'mode' : 'standard',
+    'max_attempts' : int(os.environ.get('DYNAMODB_MAX_ATTEMPTS', 5)),
+})
+retry_budget = int(os.environ.get('DYNAMODB_RETRY_BUDGET', 10))
+retry_after = int(os.environ.get('DYNAMODB_RETRY_AFTER', 1)) # seconds
+
+_retry_state = threading.local()
+
+
+def _build_rate_limiter():
+    # As botocore.retries.adaptive.register_retry_handler() does per client
+    clock = bucket.Clock()
+    return adaptive.ClientRateLimiter(
+        rate_adjustor=throttling.CubicCalculator(starting_max_rate=0, start_time=clock.current_time()),
+        rate_clocker=adaptive.RateClocker(clock),
+        token_bucket=bucket.TokenBucket(max_rate=1, clock=clock),
+        throttling_detector=standard.ThrottlingErrorDetector(retry_event_adapter=standard.RetryEventAdapter()),
+        clock=clock,
+    )
+
+
+rate_limiter = _build_rate_limiter()
+
+
+class RetryBudgetExhausted(botocore.exceptions.ClientError):
+    # A ClientError so existing handlers treat it as a database failure
+    pass
+
+
+def is_throttled(err):
+    return err.response.get('Error', {}).get('Code') in THROTTLE_CODES
+
+
+def reset_retry_budget(budget=None):
+    # Called at the start of each request
+    _retry_state.remaining = retry_budget if budget is None else budget
+
 
+def _spend_retry_budget(response=None, operation=None, **kwargs):
+    remaining = getattr(_retry_state, 'remaining', None)
+    if remaining is None or response is None:
+        return None # Outside a request, or a connection error
+    error = response[1].get('Error', {})
+    if error.get('Code') not in THROTTLE_CODES:
+        return None
+    if remaining <= 0:
+        raise RetryBudgetExhausted({'Error':error}, operation.name)
+    _retry_state.remaining = remaining - 1
+    return None # Leave the retry decision to botocore
+
+
+# boto3 resources aren't thread safe, so each thread builds its own and
+# keeps it for the life of the thread. The plain client used by the
+# fast list path is thread safe and shared by every thread. The
+# generation is bumped by forget_dynamodb(), which stops threads reusing
+# connections built before a fork.
+_local = threading.local()
+_generation = 0
+_dynamodb_client = None
+_dynamodb_lock = threading.Lock()
+
+
+def _connect(kind):
+    # kind is 'resource' or 'client'
+    aws = boto3.Session()
     if "pytest" in sys.modules:
-        stage = "test"
-        dynamodb = aws.resource('dynamodb', endpoint_url='http://localhost:8000')
+        kwargs = {'endpoint_url':'http://localhost:8000'}
+    elif os.environ.get('DYNAMODB_ENDPOINT'):
+        # A local stand-in, eg. DynamoDB Local or moto_server
+        kwargs = {'endpoint_url':os.environ['DYNAMODB_ENDPOINT'],
+                  'region_name':os.environ.get('AWS_REGION', 'ap-southeast-2')}
     else:
-        stage = os.environ.get('STAGE')
-        dynamodb = aws.resource('dynamodb', region_name=os.environ.get('AWS_REGION'), use_ssl=True)
+        kwargs = {'region_name':os.environ.get('AWS_REGION'), 'use_ssl':True}
+    connection = getattr(aws, kind)('dynamodb', config=retry_config, **kwargs)
+    client = connection if kind == 'client' else connection.meta.client
+    client.meta.events.register_first('needs-retry.dynamodb', _spend_retry_budget,
+                                      unique_id='sms-page-retry-budget')
+    client.meta.events.register('before-send.dynamodb', rate_limiter.on_sending_request,
+                                unique_id='sms-page-rate-limit-send')
+    client.meta.events.register('needs-retry.dynamodb', rate_limiter.on_receiving_response,
+                                unique_id='sms-page-rate-limit-measure')
+    trace_dynamodb(instrument_dynamodb(client))
+    return connection
 
-    return dynamodb.Table('sms-page-'+stage+'-'+name)
+
+def get_dynamodb():
+    # Kept for the life of the thread, building a resource is slow
+    if getattr(_local, 'generation', None) != _generation:
+        _local.dynamodb = _connect('resource')
+        _local.generation = _generation
+    return _local.dynamodb
+
+
+def get_dynamodb_client():
+    # A plain client, without the resource layer's conversion of every
+    # attribute to and from Python types. The resource's own client
+    # can't be used, boto3 registers the conversion on it.
+    global _dynamodb_client # pylint: disable=global-statement
+    if _dynamodb_client is None:
+        with _dynamodb_lock:
+            if _dynamodb_client is None:
+                _dynamodb_client = _connect('client')
+    return _dynamodb_client
+
+
+def forget_dynamodb():
+    # For forked worker processes, the next calls build new connections
+    # rather than sharing the parent's connection pools. The rate limiter
+    # is replaced too, its lock may have been held at the fork.
+    global _generation, _dynamodb_client, rate_limiter # pylint: disable=global-statement
+    with _dynamodb_lock:
+        rate_limiter = _build_rate_limiter()
+        _generation += 1
+        _dynamodb_client = None
+
+
+def get_stage():
+    if "pytest" in sys.modules:
+        return "test"
+    return os.environ.get('STAGE')
+
+
+def table_name(name):
+    return 'sms-page-'+get_stage()+'-'+name
+
+
+def get_table(name):
+    return get_dynamodb().Table(table_name(name))
 
 
 def lookup_member(member_id):
@@ -42,19 +216,38 @@ def lookup_member(member_id):
 
     try:
         ret = get_table('member').get_item(Key={'member_id':int(member_id)})
-    except botocore.exceptions.ClientError:
+    except botocore.exceptions.ClientError as err:
+        if is_throttled(err):
+            raise
         return None # Member table not found
 
     return ret.get('Item') # None if not found
 
 
+# Roles read by /authenticate, every sign in and refresh repeats the same
+# few. Roles are only written by the setup scripts in dynamodb.py, a
+# change can take ROLE_CACHE_TTL seconds to reach new tokens.
+role_cache = LRUCache(1000)
+role_cache_ttl = int(os.environ.get('ROLE_CACHE_TTL', 60))
+
+
 def lookup_role(name):
     if name is None:
         return None
 
+    generation = role_cache.generation(name)
+    role = role_cache.get(name)
+    if role is not MISSING:
+        return role
+
     try:
         ret = get_table("role").get_item(Key={'name':name})
-    except botocore.exceptions.ClientError:
+    except botocore.exceptions.ClientError as err:
+        if is_throttled(err):
+            raise
         return None # Role table not found
 
-    return ret.get('Item') # None if not found
+    role = ret.get('Item') # None if not found
+    if role is not None:
+        role_cache.set(name, role, role_cache_ttl, generation)
+    return role
@@ -0,0 +1,112 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+# Resource tokens are sent with every request, so known permissions and
+# roles are carried as integer bitmasks rather than lists of strings.
+# Anything not in the registry is still carried by name.
+#
+# Bit positions are fixed within a version. New names can be appended to
+# the current version. Removing or reordering names requires a new
+# version, old versions are kept so outstanding tokens still decode.
+
+PERMISSIONS_V1 = (
+    'myunit-unit-write',
+    'myunit-contact-read',
+    'myunit-contact-write',
+    'myunit-member-read',
+    'myunit-member-write',
+    'myunit-pagelog-read',
+    'myunit-pagelog-write',
+    'unit-read',
+    'unit-write',
+    'contact-read',
+    'contact-write',
+    'member-read',
+    'member-write',
+    'pagelog-read',
+    'pagelog-write',
+    'request-profile',
+)
+
+ROLES_V1 = (
+    'site-admin',
+    'unit-admin',
+    'contact-maintainer',
+    'none',
+)
+
+
+class BitRegistry:
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.bits = {name:1 << i for (i, name) in enumerate(self.names)}
+
+    def encode(self, names):
+        # Returns (mask, names not in the registry)
+        mask = 0
+        unknown = []
+        for name in names:
+            bit = self.bits.get(name)
+            if bit is None:
+                unknown.append(name)
+            else:
+                mask |= bit
+        return mask, unknown
+
+    def decode(self, mask):
+        return set(name for (name, bit) in self.bits.items() if mask & bit)
+
+
+# version -> (permissions, roles)
+registries = {
+    1 : (BitRegistry(PERMISSIONS_V1), BitRegistry(ROLES_V1)),
+}
+current_version = 1
+permission_bits, role_bits = registries[current_version]
+
+
+def encode_claims(roles, permissions):
+    # Token claims for a set of roles and permissions
+    (perm_mask, perm_extra) = permission_bits.encode(permissions)
+    (role_mask, role_extra) = role_bits.encode(roles)
+    return {
+        'roles'        : role_extra,
+        'permissions'  : perm_extra,
+        'role_mask'    : role_mask,
+        'perm_mask'    : perm_mask,
+        'mask_version' : current_version,
+    }
+
+
+def decode_claims(claims):
+    # Returns (role_mask, perm_mask, extra roles, extra permissions) in
+    # terms of the current registry. Tokens from before masks were
+    # introduced carry everything by name.
+    roles = set(claims.get('roles', []))
+    permissions = set(claims.get('permissions', []))
+    version = claims.get('mask_version')
+    if version is None:
+        return 0, 0, roles, permissions
+
+    role_mask = claims.get('role_mask', 0)
+    perm_mask = claims.get('perm_mask', 0)
+    if version != current_version:
+        # Translate through the names, bits may have moved
+        (old_perms, old_roles) = registries[version]
+        (perm_mask, extra) = permission_bits.encode(old_perms.decode(perm_mask))
+        permissions.update(extra)
+        (role_mask, extra) = role_bits.encode(old_roles.decode(role_mask))
+        roles.update(extra)
+    return role_mask, perm_mask, roles, permissions
+
+
+def claim_permissions(claims):
+    # The full set of permission names held by a token
+    (_, perm_mask, _, permissions) = decode_claims(claims)
+    return permissions | permission_bits.decode(perm_mask)
+
+
+def claim_roles(claims):
+    (role_mask, _, roles, _) = decode_claims(claims)
+    return roles | role_bits.decode(role_mask)
@@ -0,0 +1,120 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+import os
+import time
+import json
+import uuid
+import pstats
+import logging
+import cProfile
+import tempfile
+from functools import wraps
+
+from flask import request
+from werkzeug.exceptions import HTTPException
+
+from web.permissions import claim_permissions
+
+# On demand profiling of a single request.
+# Needs REQUEST_PROFILING=1 in the environment, an 'X-Profile' request
+# header and a token holding the request-profile permission. The request
+# runs under cProfile, which only sees the request's own thread, so
+# other requests are unaffected apart from sharing the CPU.
+#
+# The profile is written to PROFILE_DIR as <id>.prof, for pstats or
+# snakeviz, with a <id>.json summary beside it. The summary is logged,
+# and the response carries X-Profile-Id and the time per category. A
+# request that raises is still saved and logged, with the exception's
+# HTTP code (500 for anything else) in the summary.
+
+enabled = os.environ.get('REQUEST_PROFILING') == '1'
+profile_dir = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'sms-page-profiles'))
+PERMISSION = 'request-profile'
+TOP_FUNCTIONS = 25
+
+_app_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Self time is attributed by the file a function is in
+CATEGORIES = (
+    ('boto', ('/boto3/', '/botocore/', '/urllib3/', '/s3transfer/')),
+    ('marshmallow', ('/marshmallow/',)),
+    ('flask', ('/flask/', '/flask_restful/', '/werkzeug/', '/jinja2/')),
+)
+
+
+def category(filename):
+    if filename.startswith(_app_dir):
+        return 'app'
+    for (name, markers) in CATEGORIES:
+        if any(m in filename for m in markers):
+            return name
+    return 'other' # Standard library, json, jwt and builtins
+
+
+def summarise(profiler, elapsed):
+    stats = pstats.Stats(profiler).stats # (file, line, name) -> (cc, nc, tt, ct, callers)
+    categories = dict.fromkeys(['app', 'boto', 'marshmallow', 'flask', 'other'], 0.0)
+    for ((filename, _, _), (_, _, tottime, _, _)) in stats.items():
+        categories[category(filename)] += tottime
+    top = sorted(stats.items(), key=lambda s: s[1][3], reverse=True)[:TOP_FUNCTIONS]
+    return {
+        'elapsed' : round(elapsed, 6),
+        'categories' : {k:round(v, 6) for (k, v) in categories.items()},
+        'top' : [{
+            'function' : '{}:{}({})'.format(os.path.basename(filename), line, name),
+            'category' : category(filename),
+            'calls' : ncalls,
+            'tottime' : round(tottime, 6),
+            'cumtime' : round(cumtime, 6),
+        } for ((filename, line, name), (_, ncalls, tottime, cumtime, _)) in top],
+    }
+
+
+def wants_profile():
+    if not enabled or not request.headers.get('X-Profile'):
+        return False
+    credentials = request.environ.get('authentication.credentials')
+    return credentials is not None and PERMISSION in claim_permissions(credentials)
+
+
+def save(profiler, summary, resource):
+    # Writes the profile and its summary, returns the profile id
+    profile_id = '{}-{}-{}'.format(int(time.time()), resource, uuid.uuid4().hex[:8])
+    os.makedirs(profile_dir, exist_ok=True)
+    profiler.dump_stats(os.path.join(profile_dir, profile_id + '.prof'))
+    with open(os.path.join(profile_dir, profile_id + '.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+    logging.getLogger(__name__).info('Profile %s: %s', profile_id, json.dumps(summary))
+    return profile_id
+
+
+def profile_resource(resource_func):
+    # Applied to every flask_restful resource through Api(decorators=...)
+    view_class = getattr(resource_func, 'view_class', None)
+    resource = view_class.__name__ if view_class else resource_func.__name__
+
+    @wraps(resource_func)
+    def wrapper(*args, **kwargs):
+        if not wants_profile():
+            return resource_func(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        code = 500
+        try:
+            resp = profiler.runcall(resource_func, *args, **kwargs)
+            code = resp.status_code
+        except HTTPException as err:
+            code = err.code
+            raise
+        finally:
+            summary = summarise(profiler, time.perf_counter() - start)
+            summary.update(resource=resource, method=request.method, path=request.path, code=code)
+            profile_id = save(profiler, summary, resource)
+
+        resp.headers['X-Profile-Id'] = profile_id
+        resp.headers['X-Profile-Summary'] = json.dumps(summary['categories'], separators=(',', ':'))
+        return resp
+    return wrapper
@@ -0,0 +1,133 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+from typing import NamedTuple
+
+from flask import request, jsonify
+
+from web.metrics import rate_limited_count
+
+# Token bucket rate limiting, per member and per unit, for each rest
+# resource. A request takes a token from both the member's and the
+# unit's bucket, and is refused with 429 if either is empty. Buckets
+# refill continuously at the limit's rate up to its burst size.
+# Requests without credentials share a bucket per client address, see
+# client_address().
+#
+# Limits are in-process, each process (or Lambda container) counts
+# separately. The aim is to stop a single runaway client draining the
+# provisioned table capacity, not precise accounting.
+
+
+class Limit(NamedTuple):
+    rate: float # Requests per second, sustained
+    burst: int # Requests allowed at once
+
+
+# Default for every DynamoResource, see DynamoResource.rate_limit
+default_limit = Limit(float(os.environ.get('RATE_LIMIT', 10)),
+                      int(os.environ.get('RATE_LIMIT_BURST', 100)))
+# A unit's bucket is this many members worth
+unit_factor = int(os.environ.get('RATE_LIMIT_UNIT_FACTOR', 5))
+# Proxies in front of serve.py that append to X-Forwarded-For, 0 when
+# clients connect directly. Lambda passes the client address itself.
+trusted_proxies = int(os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', 0))
+
+
+class TokenBuckets:
+    # Beyond max_buckets the least recently used bucket is dropped, as in
+    # web.cache. It is the one most likely to have refilled, and a full
+    # bucket is the same as no bucket.
+    def __init__(self, max_buckets=10000):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict() # key -> (tokens, last refill, limit)
+        self._lock = threading.Lock()
+
+    def take(self, wanted):
+        # wanted is [(key, limit)], a token is only taken if every bucket
+        # has one. Returns the index of the first empty bucket and the
+        # seconds until it has a token, or (None, 0).
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            for (i, (key, limit)) in enumerate(wanted):
+                (tokens, last, _) = self._buckets.get(key, (limit.burst, now, limit))
+                tokens = min(limit.burst, tokens + (now - last) * limit.rate)
+                if tokens < 1:
+                    self._store(key, (tokens, now, limit))
+                    return i, (1 - tokens) / limit.rate
+                levels.append(tokens)
+            for ((key, limit), tokens) in zip(wanted, levels):
+                self._store(key, (tokens - 1, now, limit))
+        return None, 0
+
+    def _store(self, key, bucket):
+        # Called with the lock held
+        self._buckets[key] = bucket
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+buckets = TokenBuckets()
+
+
+def client_address():
+    # With trusted_proxies set the client is the address the outermost
+    # trusted proxy saw, each proxy appends its peer to X-Forwarded-For.
+    # Entries further left are whatever the client sent.
+    if trusted_proxies:
+        forwarded = [a.strip() for a in request.headers.get('X-Forwarded-For', '').split(',')]
+        if len(forwarded) >= trusted_proxies and forwarded[-trusted_proxies]:
+            return forwarded[-trusted_proxies]
+    return request.remote_addr
+
+
+def rate_limit_resource(resource_func):
+    # Applied to every flask_restful resource through Api(decorators=...)
+    # The limit is the resource class's rate_limit, None for unlimited. A
+    # method's own limit, such as post_rate_limit, takes precedence.
+    view_class = getattr(resource_func, 'view_class', None)
+    resource = view_class.__name__ if view_class else resource_func.__name__
+
+    @wraps(resource_func)
+    def wrapper(*args, **kwargs):
+        limit = getattr(view_class, request.method.lower() + '_rate_limit',
+                        getattr(view_class, 'rate_limit', default_limit))
+        if limit is None:
+            return resource_func(*args, **kwargs)
+        unit_limit = Limit(limit.rate * unit_factor, limit.burst * unit_factor)
+
+        credentials = request.environ.get('authentication.credentials')
+        if credentials:
+            scopes = ('member', 'unit')
+            wanted = [((resource, 'member', credentials.get('member_id')), limit),
+                      ((resource, 'unit', credentials.get('unit')), unit_limit)]
+        else:
+            scopes = ('anonymous',)
+            wanted = [((resource, 'anonymous', client_address()), limit)]
+
+        (empty, wait) = buckets.take(wanted)
+        if empty is None:
+            return resource_func(*args, **kwargs)
+
+        rate_limited_count.inc(resource, scopes[empty])
+        resp = jsonify({"error":"RateLimited", "detail":"Too many {} requests".format(scopes[empty])})
+        resp.status_code = 429 # Too Many Requests
+        resp.headers['Retry-After'] = str(max(1, math.ceil(wait)))
+        return resp
+    return wrapper
@@ -2,21 +2,62 @@
 # sms-page-rest is free software, you can distribute or modify it
 # under the terms of the GNU Affero General Public License (AGPL-3).
 
+import os
 import re
+import io
+import csv
+import time
+import decimal
 import logging
+import itertools
+import threading
+import functools
+import collections
 
 import marshmallow
 import botocore
 from boto3.dynamodb.conditions import Key
-from flask import Blueprint, request, jsonify
+from boto3.dynamodb.types import TypeSerializer, DYNAMODB_CONTEXT
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from flask_restful import Resource, Api
 
+from pagestats import granularities, bucket, bucket_start, record_pages
 from web.authorize import authorized, own_unit, has_permission, has_all
-from web.models import get_table
+from web.models import get_table, reset_retry_budget, is_throttled, retry_after
+from web.models import get_dynamodb_client, table_name, python_value, number_value, fraction_value
+from web.metrics import instrument_resource, read_coalescing_count
+from web.ratelimit import rate_limit_resource, default_limit, Limit
+from web.profiling import profile_resource
+from web import memory
+from web.cache import LRUCache, MISSING
+from web.singleflight import SingleFlight
+from web.search import PrefixIndex, normalise
 
 rest_pages = Blueprint('rest_pages', __name__)
 
-api = Api(rest_pages)
+# Rate limiting runs inside instrumentation, so refusals are counted.
+# Profiling is outermost, it sees everything else. Memory tracing is
+# innermost so only the resource's own allocations are attributed.
+api = Api(rest_pages, decorators=[memory.trace_resource, rate_limit_resource,
+                                       instrument_resource, profile_resource])
+
+
+@rest_pages.before_app_request
+def start_request():
+    reset_retry_budget()
+
+
+def database_error(err):
+    if is_throttled(err):
+        # Retries exhausted, the table is over capacity
+        return ({"error":"Throttled", "detail":err.response['Error'].get('Message', '')},
+                503, {'Retry-After':str(retry_after)}) # Service Unavailable
+    return {"error":"DatabaseError", "detail":err.response['Error']['Message']}, 500
+
+
+def key_error(name):
+    # A path segment that doesn't fit an Integer key
+    return {"error":"ValidationError", "detail":"{} must be an integer".format(name)}, 422
 
 
 class AusMobileNumber(marshmallow.fields.Field):
@@ -30,16 +71,51 @@ class AusMobileNumber(marshmallow.fields.Field):
         self.validators.insert(0, self._verify_aus_num)
 
 
-class ExistingUnit(marshmallow.fields.Field):
+class PageTimestamp(marshmallow.fields.Decimal):
     @staticmethod
-    def _verify_unit_exists(name):
+    def _verify_bucketable(timestamp):
+        # Epoch seconds that the page_stats rollups can bucket, rejects
+        # milliseconds as sent by Date.now(), NaN and the like
+        try:
+            bucket('hour', timestamp)
+        except (ValueError, OverflowError, decimal.InvalidOperation):
+            return False
+        return True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.validators.insert(0, self._verify_bucketable)
+
+
+class ExistingUnit(marshmallow.fields.Field):
+    # Batches repeat the same unit, remember the ones we have seen.
+    # Only positive results are kept, a new unit is visible immediately.
+    # An entry expires known_unit_ttl after the lookup that found it, a
+    # deleted unit stops being refreshed and drops out (see web.warm).
+    # Shared between threads, single dict operations are atomic and a
+    # lost update only costs an extra lookup.
+    known_units = {} # name -> time.monotonic() of the lookup
+    known_unit_ttl = 300 # seconds
+
+    @classmethod
+    def _verify_unit_exists(cls, name):
+        looked_up = cls.known_units.get(name)
+        if looked_up is not None and time.monotonic() - looked_up < cls.known_unit_ttl:
+            return True
+
+        start = time.monotonic()
         try:
             unit_response = get_table('unit').query(
                 KeyConditionExpression = Key('name').eq(name),
                 ConsistentRead = False,
             )
-            return not unit_response.get('Count') == 0
-        except botocore.exceptions.ClientError:
+            if unit_response.get('Count') == 0:
+                return False
+            cls.known_units[name] = start
+            return True
+        except botocore.exceptions.ClientError as err:
+            if is_throttled(err):
+                raise # Not a validation failure, surfaced by single_put
             return False
 
     def __init__(self, *args, **kwargs):
@@ -48,8 +124,13 @@ class ExistingUnit(marshmallow.fields.Field):
 
 
 class ExistingRoleSet(marshmallow.fields.Field):
-    @staticmethod
-    def _verify_role_exists(name_set):
+    # Every member repeats the same few roles, as with ExistingUnit only
+    # roles that exist are remembered, for known_role_ttl after the lookup.
+    known_roles = {} # name -> time.monotonic() of the lookup
+    known_role_ttl = 300 # seconds
+
+    @classmethod
+    def _verify_role_exists(cls, name_set):
         logger = logging.getLogger(__name__)
         logger.debug('VERIFY ROLE: %s', name_set)
 
@@ -58,6 +139,10 @@ class ExistingRoleSet(marshmallow.fields.Field):
             return True
 
         for name in name_set:
+            start = time.monotonic()
+            looked_up = cls.known_roles.get(name)
+            if looked_up is not None and start - looked_up < cls.known_role_ttl:
+                continue
             try:
                 role_response = get_table('role').query(
                     KeyConditionExpression = Key('name').eq(name),
@@ -65,7 +150,10 @@ class ExistingRoleSet(marshmallow.fields.Field):
                 )
                 if role_response.get('Count') == 0:
                     return False
-            except botocore.exceptions.ClientError:
+                cls.known_roles[name] = start
+            except botocore.exceptions.ClientError as err:
+                if is_throttled(err):
+                    raise
                 return False
         return True
 
@@ -100,29 +188,240 @@ class UnitSchema(marshmallow.Schema):
 class PageLogSchema(marshmallow.Schema):
     phone_number = AusMobileNumber(required=True)
     unit = ExistingUnit(required=True)
-    timestamp = marshmallow.fields.Decimal(required=True)
+    timestamp = PageTimestamp(required=True)
     body = marshmallow.fields.Str(required=True)
 
 
+class CompiledSchema:
+    # Schema metadata worked out once per schema class, rather than
+    # walking the declared fields on every request.
+    def __init__(self, schema):
+        self.schema = schema
+        fields = schema._declared_fields
+        self.columns = list(fields)
+        self.integer_fields = frozenset(
+            n for (n, f) in fields.items() if isinstance(f, marshmallow.fields.Integer))
+        self.decimal_fields = frozenset(
+            n for (n, f) in fields.items() if isinstance(f, marshmallow.fields.Decimal))
+        self._numbers = dict([(n, int) for n in self.integer_fields] +
+                             [(n, fraction_value) for n in self.decimal_fields])
+        self._local = threading.local()
+
+    def instance(self):
+        # Schema instances are reused, one per thread
+        inst = getattr(self._local, 'instance', None)
+        if inst is None:
+            inst = self.schema(strict=True)
+            self._local.instance = inst
+        return inst
+
+    def validate(self, data, many=False):
+        # Raises marshmallow ValidationError
+        self.instance().validate(data, many=many)
+
+    def cast_key(self, name, key):
+        # Integer types need to be cast before use
+        if name in self.integer_fields:
+            return int(key)
+        return key
+
+    def cast_item(self, item):
+        # Integer and Decimal types need to be cast before insertion
+        # boto3 rejects floats, so Decimals go via their string form
+        for name in self.integer_fields:
+            item[name] = int(item.get(name))
+        for name in self.decimal_fields:
+            item[name] = decimal.Decimal(str(item.get(name)))
+
+    def python_item(self, item):
+        # A low level client item, straight to output types. Numbers in
+        # Integer and Decimal fields go straight to the expected type.
+        numbers = self._numbers
+        return {name:python_value(value, numbers.get(name, number_value))
+                for (name, value) in item.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def compile_schema(schema):
+    return CompiledSchema(schema)
+
+
+# Concurrent identical reads share a single DynamoDB call.
+# Authorization still runs per request on the shared result.
+inflight = SingleFlight(read_coalescing_count)
+
+
+def coalesced_get_item(table_name, key, generation=None):
+    # key is a single {attribute:value}. Callers with the item_cache
+    # generation only join calls made since the same invalidation.
+    ((name, value),) = key.items()
+    return inflight.do(('get_item', table_name, name, value, generation),
+                       lambda: get_table(table_name).get_item(Key=key))
+
+
 def assert_has_unit(name):
     try:
-        ret = get_table('unit').get_item(Key={'name':name})
+        ret = coalesced_get_item('unit', {'name':name})
     except botocore.exceptions.ClientError as err:
-        return {"error":"DatabaseError", "detail":err.response['Error']['Message']}, 500
+        return database_error(err)
 
     if ret.get('Item') is None:
         return {}, 404
 
 
+# Optional read-through cache for single items and unit lists.
+# Sized by DYNAMO_CACHE_SIZE, the default of 0 disables it. Each resource
+# chooses its own TTL with cache_ttl.
+item_cache = LRUCache(int(os.environ.get('DYNAMO_CACHE_SIZE', 0)))
+
+# Unit lists of resources with a schema can skip the boto3 resource
+# layer, which makes a Decimal of every number only for DecimalEncoder
+# to turn it back. With DYNAMODB_FAST_LISTS=1 they are queried with the
+# low level client and converted by CompiledSchema.python_item instead.
+# The output is the same apart from the order of set members. The items
+# themselves hold lists and floats rather than sets and Decimals, so they
+# are cached and coalesced apart from the resource layer's.
+fast_lists = os.environ.get('DYNAMODB_FAST_LISTS') == '1'
+serializer = TypeSerializer()
+
+# single_put stamps items with updated_at, in milliseconds since the
+# epoch, for resources with stamp_updates. Unit lists with a
+# change_index answer ?changed_since= with the items stamped since that
+# watermark, and the watermark to use next. Index reads are eventually
+# consistent and every process has its own clock, so the next watermark
+# is held back by CHANGES_OVERLAP milliseconds. Items near it are
+# returned twice, clients should apply changes as upserts.
+#
+# An item moved to another unit drops out of its old unit's index, so
+# single_put records the move in the removal table, keyed by
+# '<table>/<old unit>' and '<stamp>/<item key>'. Changes include the keys
+# removed since the watermark, to apply before the upserts as a moved
+# item may since have come back. Removals expire after REMOVAL_RETENTION
+# days, older watermarks are refused and the client reloads the unit.
+changes_overlap = int(os.environ.get('CHANGES_OVERLAP', 5000))
+removal_retention = int(os.environ.get('REMOVAL_RETENTION', 30)) # days
+# Tries at a stamped put before a concurrent writer wins, see _stamped_put
+put_attempts = 3
+
+
+def change_stamp():
+    return int(time.time() * 1000)
+
+
+def removal_item(table, unit, key, stamp):
+    # The removal table entry for the item with key leaving unit's list
+    return {
+        'unit_list' : '{}/{}'.format(table, unit),
+        'removed_id' : '{:013d}/{}'.format(stamp, key),
+        'item_key' : key,
+        'updated_at' : stamp,
+        'expires' : stamp // 1000 + removal_retention * 86400, # TTL, in seconds
+    }
+
+
+def timestamp_arg(name):
+    # A query string timestamp or None, the same as boto3 would store it.
+    # Raises ValueError or DecimalException for anything DynamoDB can't
+    # hold, eg. NaN, Infinity or 1e200.
+    value = request.args.get(name)
+    if value is None:
+        return None
+    value = decimal.Decimal(value)
+    if not value.is_finite():
+        raise ValueError("{} must be finite".format(name))
+    return DYNAMODB_CONTEXT.create_decimal(value)
+
+
+def cache_bypassed():
+    # Clients needing a fresh read send 'Cache-Control: no-cache'
+    return 'no-cache' in request.headers.get('Cache-Control', '')
+
+
+def wants_csv():
+    # JSON unless the client prefers CSV, */* gets JSON
+    best = request.accept_mimetypes.best_match(['application/json', 'text/csv'])
+    return best == 'text/csv'
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value % 1 == 0 else float(value)
+    if isinstance(value, (set, list, tuple)):
+        return ';'.join(sorted(str(v) for v in value))
+    return value
+
+
+def csv_response(schema, pages):
+    # Rows are written as each query page arrives, memory use is bounded
+    # by the page size rather than the size of the unit
+    columns = compile_schema(schema).columns
+
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(columns)
+        try:
+            for page in pages:
+                for item in page:
+                    writer.writerow([_csv_value(item.get(c)) for c in columns])
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        except botocore.exceptions.ClientError as err:
+            # Headers are already sent. Raising makes the server abort the
+            # chunked response, so the client sees an incomplete transfer
+            # rather than a short export that looks complete.
+            logging.getLogger(__name__).error('CSV export failed: %s', err)
+            raise
+        yield buf.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv')
+
+
 class DynamoResource(Resource):
     # These attributes should be set by the implementing class
     table_name = None
     index_name = None # Optional, will be used for gets if included
     partition_key = None # Only needed for gets
-    schema = None # Only needed for single_put()
+    range_key = None # Only needed for batch_put() on ranged tables
+    schema = None # Only needed for single_put() and batch_put()
+    cache_ttl = None # Seconds to cache gets, None disables
+    rate_limit = default_limit # Per member, see web.ratelimit. None disables
+    # <method>_rate_limit, eg. post_rate_limit, overrides it for one method
+    csv_export = True # Set False when post authorization needs the rows
+    stamp_updates = False # Set updated_at in single_put(), for changes_get()
+    change_index = None # On partition_key and updated_at, for changes_get()
 
     # Don't use standard methods, makes it hard to disable
 
+    @property
+    def compiled(self):
+        return compile_schema(self.schema)
+
+    def _cache_get(self, key):
+        if self.cache_ttl is None or cache_bypassed():
+            return MISSING
+        return item_cache.get(key)
+
+    def _cache_set(self, key, value, generation):
+        # generation is item_cache.generation(key) from before the read
+        if self.cache_ttl is not None:
+            item_cache.set(key, value, self.cache_ttl, generation)
+
+    def _cache_invalidate(self, *items):
+        # Drops the item and every list the item could appear in,
+        # lists are keyed by the attribute they were queried on
+        for item in items:
+            if not item:
+                continue
+            item_cache.invalidate(('item', self.table_name, item.get(self.partition_key)))
+            for (name, value) in item.items():
+                if isinstance(value, (str, int, decimal.Decimal)):
+                    item_cache.invalidate(('list', self.table_name, name, value))
+                    item_cache.invalidate(('list', self.table_name, name, value, 'fast'))
+
     def _single_query(self, key):
         # Necessary when index lookup is performed
         qargs = {
@@ -135,7 +434,7 @@ class DynamoResource(Resource):
         try:
             response = get_table(self.table_name).query(**qargs)
         except botocore.exceptions.ClientError as err:
-            return {"error":"DatabaseError", "detail":err.response['Error']['Message']}, 500
+            return database_error(err)
 
         if response.get('Count') == 0:
             return {}, 404
@@ -147,11 +446,15 @@ class DynamoResource(Resource):
                 "detail":"single_get() returned multiple values. This function is not suitable for ranged values."
             }, 500
 
-    def _single_get(self, key):
+    def _single_get(self, key, generation):
         try:
-            ret = get_table(self.table_name).get_item(Key={self.partition_key:key})
+            if cache_bypassed():
+                # A fresh read mustn't join a call that started earlier
+                ret = get_table(self.table_name).get_item(Key={self.partition_key:key})
+            else:
+                ret = coalesced_get_item(self.table_name, {self.partition_key:key}, generation)
         except botocore.exceptions.ClientError as err:
-            return {"error":"DatabaseError", "detail":err.response['Error']['Message']}, 500
+            return database_error(err)
 
         if ret.get('Item'):
             return ret.get('Item'), 200
@@ -160,36 +463,185 @@ class DynamoResource(Resource):
 
     def single_get(self, key):
         if self.schema is not None:
-            # Integer types need to be cast before use
-            field_type = self.schema._declared_fields.get(self.partition_key)
-            if isinstance(field_type, marshmallow.fields.Integer):
-                key = int(key)
+            try:
+                key = self.compiled.cast_key(self.partition_key, key)
+            except ValueError:
+                return key_error(self.partition_key)
 
         if self.index_name:
             return self._single_query(key)
-        else:
-            return self._single_get(key)
+
+        cache_key = ('item', self.table_name, key)
+        item = self._cache_get(cache_key)
+        if item is not MISSING:
+            return item, 200
+
+        generation = item_cache.generation(cache_key)
+        ret = self._single_get(key, generation)
+        if ret[1] == 200:
+            self._cache_set(cache_key, ret[0], generation)
+        return ret
+
+    def _list_qargs(self, key):
+        qargs = {
+            "KeyConditionExpression" : Key(self.partition_key).eq(key),
+            "ConsistentRead" : False,
+        }
+        if self.index_name:
+            qargs["IndexName"] = self.index_name # Optional
+        return qargs
 
     def list_get(self, key):
         if self.schema is not None:
-            # Integer types need to be cast before use
-            field_type = self.schema._declared_fields.get(self.partition_key)
-            if isinstance(field_type, marshmallow.fields.Integer):
-                key = int(key)
+            try:
+                key = self.compiled.cast_key(self.partition_key, key)
+            except ValueError:
+                return key_error(self.partition_key)
+
+        try:
+            if self.csv_export and wants_csv() and self.schema is not None:
+                items = self._cache_get(self._list_cache_key(key))
+                if items is not MISSING:
+                    return csv_response(self.schema, [items])
+                pages = self._list_pages(key)
+                # Always fetch the first page, so a failure gets a proper response
+                first = next(pages)
+                return csv_response(self.schema, itertools.chain([first], pages))
+            return self.list_items(key)
+        except botocore.exceptions.ClientError as err:
+            return database_error(err)
+
+    def list_items(self, key):
+        # Every item for an already cast key, through the cache and shared
+        # with concurrent callers. Raises ClientError. Callers after a
+        # write don't join a query made before it, and a query overtaken
+        # by a write isn't cached.
+        cache_key = self._list_cache_key(key)
+        items = self._cache_get(cache_key)
+        if items is not MISSING:
+            return items
+
+        def fetch_all():
+            return [item for page in self._list_pages(key) for item in page]
+
+        generation = item_cache.generation(cache_key)
+        if cache_bypassed():
+            items = fetch_all()
+        else:
+            items = inflight.do(('query', self.index_name, generation) + cache_key, fetch_all)
+
+        self._cache_set(cache_key, items, generation)
+        return items
+
+    def changes_get(self, key, since):
+        # Items for key stamped at or after the since watermark
+        try:
+            since = int(since)
+        except ValueError:
+            return {"error":"ValidationError", "detail":"changed_since must be a watermark"}, 422
+        now = change_stamp()
+        if 0 < since < now - removal_retention * 86400000:
+            # Removals since then may have expired
+            return {"error":"Expired", "detail":"changed_since is too old, sync again from 0"}, 410 # Gone
+        watermark = max(since, now - changes_overlap)
 
         qargs = {
-            "KeyConditionExpression" : Key(self.partition_key).eq(key),
+            "KeyConditionExpression" : Key(self.partition_key).eq(key) & Key('updated_at').gte(since),
+            "IndexName" : self.change_index,
+            "ConsistentRead" : False,
+        }
+        removals = {
+            "KeyConditionExpression" : Key('unit_list').eq('{}/{}'.format(self.table_name, key))
+                                       & Key('removed_id').gte('{:013d}'.format(since)),
             "ConsistentRead" : False,
         }
+        try:
+            items = [item for page in self._query_pages(qargs) for item in page]
+            removed = [r['item_key'] for page in self._query_pages(removals, 'removal') for r in page]
+        except botocore.exceptions.ClientError as err:
+            return database_error(err)
+        # An item moved out more than once has a removal for each move
+        removed = list(collections.OrderedDict.fromkeys(removed))
+        return {"items":items, "removed":removed, "watermark":watermark}, 200
+
+    def range_get(self, key, low=None, high=None, limit=None, newest_first=False):
+        # Items for key with range_key between low and high inclusive,
+        # either bound may be None. Stops reading once limit is reached.
+        condition = Key(self.partition_key).eq(key)
+        if low is not None and high is not None:
+            condition &= Key(self.range_key).between(low, high)
+        elif low is not None:
+            condition &= Key(self.range_key).gte(low)
+        elif high is not None:
+            condition &= Key(self.range_key).lte(high)
+
+        qargs = {
+            "KeyConditionExpression" : condition,
+            "ConsistentRead" : False,
+            "ScanIndexForward" : not newest_first,
+        }
         if self.index_name:
             qargs["IndexName"] = self.index_name # Optional
+        if limit:
+            qargs["Limit"] = limit
 
+        items = []
         try:
-            response = get_table(self.table_name).query(**qargs)
+            for page in self._query_pages(qargs):
+                items.extend(page)
+                if limit and len(items) >= limit:
+                    break
         except botocore.exceptions.ClientError as err:
-            return {"error":"DatabaseError", "detail":err.response['Error']['Message']}, 500
+            return database_error(err)
+        return items[:limit] if limit else items
 
-        return response[u'Items']
+    def _fast_lists(self):
+        return fast_lists and self.schema is not None
+
+    def _list_cache_key(self, key):
+        cache_key = ('list', self.table_name, self.partition_key, key)
+        return cache_key + ('fast',) if self._fast_lists() else cache_key
+
+    def _list_pages(self, key):
+        if self._fast_lists():
+            return self._fast_query_pages(key)
+        return self._query_pages(self._list_qargs(key))
+
+    def _fast_query_pages(self, key):
+        # As _query_pages(self._list_qargs(key)) but via the low level client
+        qargs = {
+            "TableName" : table_name(self.table_name),
+            "KeyConditionExpression" : "#k = :k",
+            "ExpressionAttributeNames" : {"#k" : self.partition_key},
+            "ExpressionAttributeValues" : {":k" : serializer.serialize(key)},
+            "ConsistentRead" : False,
+        }
+        if self.index_name:
+            qargs["IndexName"] = self.index_name
+        client = get_dynamodb_client()
+        python_item = self.compiled.python_item
+        while True:
+            response = client.query(**qargs)
+            memory.phase('deserialize')
+            page = [python_item(item) for item in response['Items']]
+            memory.phase('app')
+            yield page
+            last_key = response.get('LastEvaluatedKey')
+            if not last_key:
+                return
+            qargs["ExclusiveStartKey"] = last_key
+
+    def _query_pages(self, qargs, table_name=None):
+        # A query returns at most 1MB, follow LastEvaluatedKey for the rest
+        table = get_table(table_name or self.table_name)
+        while True:
+            response = table.query(**qargs)
+            memory.phase('app')
+            yield response[u'Items']
+            last_key = response.get('LastEvaluatedKey')
+            if not last_key:
+                return
+            qargs = dict(qargs, ExclusiveStartKey=last_key)
 
     def single_put(self, item):
         # Must be a full insert or update, don't support partial updates
@@ -198,33 +650,117 @@ class DynamoResource(Resource):
             # TODO: Be consistent, numeric strings in, numeric strings out
             # TODO: When debugging schema failure should throw
             try:
-                self.schema(strict=True).validate(item)
+                self.compiled.validate(item)
             except marshmallow.exceptions.ValidationError as err:
                 # TODO: Use JSON Encoder
                 return {"error":"ValidationError", "detail":err.normalized_messages()}, 422 # Unprocessable Entity
+            except botocore.exceptions.ClientError as err:
+                return database_error(err)
 
-            # Integer types need to be cast before insertion
-            for name, field in self.schema._declared_fields.items():
-                if isinstance(field, marshmallow.fields.Integer):
-                    item[name] = int(item.get(name))
+            self.compiled.cast_item(item)
 
         try:
-            ret = get_table(self.table_name).put_item(Item=item, ReturnValues='ALL_OLD')
+            if self.stamp_updates:
+                item['updated_at'] = change_stamp()
+                old = self._stamped_put(item)
+            else:
+                ret = get_table(self.table_name).put_item(Item=item, ReturnValues='ALL_OLD')
+                old = ret.get('Attributes')
         except botocore.exceptions.ClientError as err:
-            return {"error":"DatabaseError", "detail":err.response['Error']['Message']}, 500
+            return database_error(err)
+
+        # Covers both the old and new unit when an item moves
+        self._cache_invalidate(item, old)
 
-        if ret.get('Attributes'):
+        if old:
             code = 200 # Update
         else:
             code = 201 # New
 
         return item, code
 
+    def _stamped_put(self, item):
+        # put_item for stamp_updates resources, returns the old item.
+        # A move to another unit is written in one transaction with its
+        # removal, for changes_get() on the old unit. Both writes are
+        # conditional on the item read first, if a concurrent write gets
+        # in between the put starts over. Raises ClientError.
+        table = get_table(self.table_name)
+        key = {self.partition_key:item[self.partition_key]}
+        for attempt in range(put_attempts):
+            old = table.get_item(Key=key, ConsistentRead=True).get('Item')
+            condition = self._unchanged_condition(old)
+            try:
+                if old and old.get('unit') not in (None, item.get('unit')):
+                    self._put_moved(item, old, condition)
+                else:
+                    table.put_item(Item=item, **condition)
+                return old
+            except botocore.exceptions.ClientError as err:
+                conflict = err.response['Error']['Code'] in ('ConditionalCheckFailedException',
+                                                             'TransactionCanceledException')
+                if not conflict or attempt == put_attempts - 1:
+                    raise
+        return None # Not reached
+
+    def _unchanged_condition(self, old):
+        # Expression arguments for a write that fails if old isn't current
+        if old is None:
+            return {'ConditionExpression':'attribute_not_exists(#k)',
+                    'ExpressionAttributeNames':{'#k':self.partition_key}}
+        if 'unit' not in old:
+            return {'ConditionExpression':'attribute_not_exists(#u)',
+                    'ExpressionAttributeNames':{'#u':'unit'}}
+        return {'ConditionExpression':'#u = :u', 'ExpressionAttributeNames':{'#u':'unit'},
+                'ExpressionAttributeValues':{':u':old['unit']}}
+
+    def _put_moved(self, item, old, condition):
+        removal = removal_item(self.table_name, old['unit'], old[self.partition_key], item['updated_at'])
+        put = dict(condition, TableName=table_name(self.table_name),
+                   Item={k:serializer.serialize(v) for (k, v) in item.items()})
+        if 'ExpressionAttributeValues' in put:
+            put['ExpressionAttributeValues'] = {k:serializer.serialize(v)
+                                                for (k, v) in put['ExpressionAttributeValues'].items()}
+        get_dynamodb_client().transact_write_items(TransactItems=[
+            {'Put':put},
+            {'Put':{'TableName':table_name('removal'),
+                    'Item':{k:serializer.serialize(v) for (k, v) in removal.items()}}},
+        ])
+
+    def batch_put(self, items):
+        # Inserts many items with BatchWriteItem, 25 items per request.
+        # Everything is validated before anything is written.
+        if self.schema is not None:
+            try:
+                self.compiled.validate(items, many=True)
+            except marshmallow.exceptions.ValidationError as err:
+                return {"error":"ValidationError", "detail":err.normalized_messages()}, 422 # Unprocessable Entity
+            except botocore.exceptions.ClientError as err:
+                return database_error(err)
+
+            for item in items:
+                self.compiled.cast_item(item)
+
+        # Items with a duplicate key in a single request are rejected,
+        # the writer keeps the last one instead.
+        pkeys = [k for k in (self.partition_key, self.range_key) if k]
+        try:
+            # The writer resends any UnprocessedItems until all are written
+            with get_table(self.table_name).batch_writer(overwrite_by_pkeys=pkeys) as batch:
+                for item in items:
+                    batch.put_item(Item=item)
+        except botocore.exceptions.ClientError as err:
+            return database_error(err)
+
+        self._cache_invalidate(*items)
+        return {"count":len(items)}, 201
+
 
 class UnitTable(DynamoResource):
     table_name = 'unit'
     partition_key = 'name'
     schema = UnitSchema
+    cache_ttl = 300
 
     @authorized(has_permission('unit-read'), own_unit())
     def get(self, unit):
@@ -241,6 +777,10 @@ class ContactUnitTable(DynamoResource):
     table_name = 'contact'
     index_name = 'contact_unit'
     partition_key = 'unit'
+    schema = ContactSchema # Used for CSV columns
+    cache_ttl = 60
+    rate_limit = Limit(rate=0.5, burst=20) # Whole unit reads are expensive
+    change_index = 'contact_updated'
 
     # Index resource, no adding entries
     @authorized(has_permission('contact-read'), has_all(own_unit(), has_permission('myunit-contact-read')))
@@ -248,6 +788,8 @@ class ContactUnitTable(DynamoResource):
         fault = assert_has_unit(unit)
         if fault:
             return fault
+        if 'changed_since' in request.args:
+            return self.changes_get(unit, request.args['changed_since'])
         return self.list_get(unit)
 
 
@@ -255,6 +797,8 @@ class PageLogUnitTable(DynamoResource):
     table_name = 'page_log'
     partition_key = 'unit'
     range_key = 'timestamp'
+    schema = PageLogSchema
+    post_rate_limit = None # Never hold up the paging service
 
     @authorized(has_permission('pagelog-read'), has_all(own_unit(), has_permission('myunit-pagelog-read')))
     def get(self, unit):
@@ -264,11 +808,111 @@ class PageLogUnitTable(DynamoResource):
             return fault
         return self.list_get(unit)
 
+    @authorized(has_permission('pagelog-write'), has_all(own_unit(), has_permission('myunit-pagelog-write')))
+    def post(self, unit):
+        # Accepts a single entry or a JSON list of entries
+        fault = assert_has_unit(unit)
+        if fault:
+            return fault
+
+        entries = request.get_json(silent=True)
+        if entries is None:
+            entries = request.form.to_dict()
+        if isinstance(entries, dict):
+            entries = [entries]
+        if not isinstance(entries, list) or not all(isinstance(e, dict) for e in entries):
+            return {"error":"ValidationError", "detail":"Expected an entry or a list of entries"}, 422
+
+        for entry in entries:
+            entry['unit'] = unit
+        return self.batch_put(entries)
+
+    def batch_put(self, items):
+        ret = super().batch_put(items)
+        if ret[1] == 201:
+            try:
+                record_pages(get_table('page_stats'), items)
+            except botocore.exceptions.ClientError as err:
+                # The log is written, the rollups can be rebuilt from it
+                logging.getLogger(__name__).error('Page stats not updated: %s', err)
+        return ret
+
+
+class PageStatsUnitTable(DynamoResource):
+    table_name = 'page_stats'
+    partition_key = 'unit'
+    range_key = 'bucket'
+
+    # Read only, maintained by PageLogUnitTable writes
+    @authorized(has_permission('pagelog-read'), has_all(own_unit(), has_permission('myunit-pagelog-read')))
+    def get(self, unit):
+        granularity = request.args.get('granularity', 'day')
+        if granularity not in granularities:
+            return {"error":"ValidationError", "detail":"granularity must be one of "+", ".join(granularities)}, 422
+        try:
+            since = request.args.get('since')
+            low = granularity+'#' if since is None else bucket(granularity, decimal.Decimal(since))
+            until = request.args.get('until')
+            high = granularity+'#~' if until is None else bucket(granularity, decimal.Decimal(until))
+        except (ValueError, OverflowError, decimal.InvalidOperation):
+            return {"error":"ValidationError", "detail":"since and until must be timestamps"}, 422
+        if low > high:
+            # DynamoDB refuses a between with the bounds reversed
+            return {"error":"ValidationError", "detail":"since must not be after until"}, 422
+
+        fault = assert_has_unit(unit)
+        if fault:
+            return fault
+        ret = self.range_get(unit, low, high)
+        if not isinstance(ret, list):
+            return ret
+        # Buckets without pages aren't stored
+        return [{
+            "bucket" : item['bucket'].split('#', 1)[1],
+            "start" : bucket_start(item['bucket']),
+            "pages" : item['pages'],
+        } for item in ret]
+
+
+class ContactPageLogTable(DynamoResource):
+    table_name = 'page_log'
+    index_name = 'page_log_phone'
+    partition_key = 'phone_number'
+    range_key = 'timestamp'
+    schema = PageLogSchema
+    default_limit = 100
+    max_limit = 1000
+
+    # Index resource, no adding entries
+    # Pages to a number can come from several units, own_unit access
+    # requires every entry returned to be from the member's unit
+    @authorized(has_permission('pagelog-read'), has_all(own_unit(), has_permission('myunit-pagelog-read')))
+    def get(self, phone_num):
+        # Newest first, optionally bounded by since and until timestamps
+        try:
+            since = timestamp_arg('since')
+            until = timestamp_arg('until')
+            limit = min(int(request.args.get('limit', self.default_limit)), self.max_limit)
+        except (ValueError, decimal.DecimalException):
+            return {"error":"ValidationError", "detail":"since and until must be timestamps, limit an integer"}, 422
+        if limit < 1:
+            return {"error":"ValidationError", "detail":"limit must be positive"}, 422
+        if since is not None and until is not None and since > until:
+            # DynamoDB refuses a between with the bounds reversed
+            return {"error":"ValidationError", "detail":"since must not be after until"}, 422
+
+        ret = self.range_get(phone_num, since, until, limit, newest_first=True)
+        if isinstance(ret, list):
+            return ret, 200
+        return ret
+
 
 class ContactTable(DynamoResource):
     table_name = 'contact'
     partition_key = 'phone_number'
     schema = ContactSchema
+    cache_ttl = 60
+    stamp_updates = True
 
     @authorized(has_permission('contact-read'), has_all(own_unit(), has_permission('myunit-contact-read')))
     def get(self, phone_num):
@@ -281,10 +925,30 @@ class ContactTable(DynamoResource):
         return self.single_put(item)
 
 
+class ContactMemberTable(DynamoResource):
+    table_name = 'contact'
+    index_name = 'contact_member'
+    partition_key = 'member_id'
+    schema = ContactSchema # Used to cast member_id
+    cache_ttl = 60
+    csv_export = False
+
+    # Index resource, no adding entries
+    # The unit is only known once the contacts are read, own_unit is
+    # checked against every contact returned
+    @authorized(has_permission('contact-read'), has_all(own_unit(), has_permission('myunit-contact-read')))
+    def get(self, member_id):
+        ret = self.list_get(member_id)
+        if isinstance(ret, list):
+            return ret, 200
+        return ret
+
+
 class RoleTable(DynamoResource):
     table_name = 'role'
     partition_key = 'name'
     schema = RoleSchema
+    cache_ttl = 300
 
     # Get only, roles are pre-populated by the system
     # No permission limitations, not sensative info
@@ -292,10 +956,23 @@ class RoleTable(DynamoResource):
         return self.single_get(name)
 
 
+# Name search index for each unit's members, see MemberUnitTable
+member_names = PrefixIndex('name', int(os.environ.get('MEMBER_SEARCH_TTL', 300)))
+
+
 class MemberTable(DynamoResource):
     table_name = 'member'
     partition_key = 'member_id'
     schema = MemberSchema
+    cache_ttl = 60
+    stamp_updates = True
+
+    def _cache_invalidate(self, *items):
+        super()._cache_invalidate(*items)
+        # Covers both the old and new unit when a member moves
+        for item in items:
+            if item:
+                member_names.invalidate(item.get('unit'))
 
     @authorized(has_permission('member-read'), has_all(own_unit(), has_permission('myunit-member-read')))
     def get(self, member_id):
@@ -317,29 +994,62 @@ class MemberUnitTable(DynamoResource):
     index_name = 'member_unit'
     partition_key = 'unit'
     schema = MemberSchema
+    cache_ttl = 60
+    rate_limit = Limit(rate=0.5, burst=20) # Whole unit reads are expensive
+    change_index = 'member_updated'
+
+    search_limit = 25 # Default number of search results
 
     @authorized(has_permission('member-read'), has_all(own_unit(), has_permission('myunit-member-read')))
     def get(self, unit):
         fault = assert_has_unit(unit)
         if fault:
             return fault
+        if 'q' in request.args:
+            return self.search(unit, request.args['q'])
+        if 'changed_since' in request.args:
+            return self.changes_get(unit, request.args['changed_since'])
         return self.list_get(unit)
 
+    def search(self, unit, text):
+        # Members whose name, or a later word of it, starts with text
+        try:
+            limit = int(request.args.get('limit', self.search_limit))
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            return {"error":"ValidationError", "detail":"limit must be a positive integer"}, 422
+
+        index = None if cache_bypassed() else member_names.get(unit)
+        if index is None:
+            generation = member_names.generation(unit)
+            try:
+                items = self.list_items(unit)
+            except botocore.exceptions.ClientError as err:
+                return database_error(err)
+            index = member_names.build(unit, items, generation)
+        return index.search(normalise(text), limit)
+
 
 # TODO: POST for /rest/unit/<>/actions ??
 
 api.add_resource(ContactTable, '/rest/contact/<string:phone_num>')
+api.add_resource(ContactPageLogTable, '/rest/contact/<string:phone_num>/pagelog')
 api.add_resource(RoleTable, '/rest/role/<string:name>')
 api.add_resource(MemberTable, '/rest/member/<member_id>')
+api.add_resource(ContactMemberTable, '/rest/member/<member_id>/contacts')
 api.add_resource(UnitTable, '/rest/unit/<string:unit>')
 api.add_resource(ContactUnitTable, '/rest/unit/<string:unit>/contacts')
 api.add_resource(PageLogUnitTable, '/rest/unit/<string:unit>/pagelog')
+api.add_resource(PageStatsUnitTable, '/rest/unit/<string:unit>/pagelog/stats')
 api.add_resource(MemberUnitTable, '/rest/unit/<string:unit>/members')
 
 
 @api.representation('application/json')
 def output_json(data, code, headers=None):
+    memory.phase('encode')
     resp = jsonify(data)
+    memory.phase('respond')
     resp.status_code = code
     resp.headers.extend(headers or {})
     return resp
@@ -0,0 +1,89 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+import time
+import bisect
+import threading
+import unicodedata
+
+# In-process prefix search over names, one sorted index per unit.
+# Every word of a name is indexed, so 'smi' finds 'Jane Smith'.
+# Indexes are built on first search from the unit's member list and
+# dropped when a member of the unit is written through this process.
+# Other processes catch up when the TTL expires.
+
+
+def normalise(text):
+    # Case and accent insensitive, 'José  Ávila' -> 'jose avila'
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.casefold().split())
+
+
+class _Index:
+    def __init__(self, items, field, expiry):
+        self.expiry = expiry
+        entries = []
+        for (position, item) in enumerate(items):
+            words = normalise(item.get(field)).split(' ')
+            for i in range(len(words)):
+                entries.append((' '.join(words[i:]), position))
+        entries.sort()
+        self.keys = [e[0] for e in entries]
+        self.positions = [e[1] for e in entries]
+        self.items = items
+
+    def search(self, prefix, limit):
+        found = []
+        seen = set()
+        i = bisect.bisect_left(self.keys, prefix)
+        while i < len(self.keys) and self.keys[i].startswith(prefix):
+            position = self.positions[i]
+            if position not in seen:
+                seen.add(position)
+                found.append(self.items[position])
+                if len(found) >= limit:
+                    break
+            i += 1
+        return found
+
+
+class PrefixIndex:
+    def __init__(self, field, ttl):
+        self.field = field # Item attribute holding the name
+        self.ttl = ttl
+        self._indexes = {} # unit -> _Index
+        self._generations = {} # unit -> count of invalidations
+        self._lock = threading.Lock()
+
+    def generation(self, unit):
+        # Taken before reading the items an index is built from
+        with self._lock:
+            return self._generations.get(unit, 0)
+
+    def get(self, unit):
+        with self._lock:
+            index = self._indexes.get(unit)
+        if index is None or index.expiry < time.monotonic():
+            return None
+        return index
+
+    def build(self, unit, items, generation):
+        index = _Index(items, self.field, time.monotonic() + self.ttl)
+        with self._lock:
+            # A write during the read may not be in the items, don't keep them
+            if self._generations.get(unit, 0) == generation:
+                self._indexes[unit] = index
+        return index
+
+    def invalidate(self, unit):
+        with self._lock:
+            self._generations[unit] = self._generations.get(unit, 0) + 1
+            self._indexes.pop(unit, None)
+
+    def clear(self):
+        with self._lock:
+            for unit in self._indexes:
+                self._generations[unit] = self._generations.get(unit, 0) + 1
+            self._indexes.clear()
@@ -0,0 +1,60 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+import threading
+
+# Merges identical concurrent reads into a single backend call.
+# The first caller for a key makes the call, any caller arriving while it
+# is in flight waits and gets the same result, or the same exception.
+# Nothing is kept once the call completes, this is not a cache.
+# Results are shared between threads, callers must not modify them.
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, counter=None):
+        self.counter = counter # Optional metrics counter, labelled by outcome
+        self.calls = 0 # Backend calls made
+        self.shared = 0 # Callers served by another caller's call
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._in_flight[key] = call
+                self.calls += 1
+            else:
+                self.shared += 1
+        if self.counter is not None:
+            self.counter.inc('call' if leader else 'shared')
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+
+    def stats(self):
+        return {'calls':self.calls, 'shared':self.shared, 'in_flight':len(self._in_flight)}
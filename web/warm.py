@@ -0,0 +1,119 @@
+# Copyright 2017 David Tulloh This file is part of sms-page-rest.
+# sms-page-rest is free software, you can distribute or modify it
+# under the terms of the GNU Affero General Public License (AGPL-3).
+
+import time
+import logging
+
+import jwt
+from boto3.dynamodb.conditions import Key
+
+from web import authenticate, rest
+from web.models import get_dynamodb, get_table
+from web.metrics import warmup_latency
+
+# Keep-warm hook, called by a scheduled zappa event rather than going
+# through the app. Importing this module loads the whole app, then each
+# step builds or primes something the first real request would
+# otherwise pay for. Steps are independent, a failure is logged and the
+# rest still run. See the events entry in zappa_settings.example.json.
+
+_warmed = False
+
+
+def _step(report, name, func):
+    start = time.perf_counter()
+    try:
+        result = func()
+    except Exception as err: # pylint: disable=broad-except
+        report['errors'][name] = str(err)
+        logging.getLogger(__name__).warning('Warm up step %s failed: %s', name, err)
+        result = None
+    elapsed = time.perf_counter() - start
+    report['steps'][name] = round(elapsed, 4)
+    warmup_latency.observe(elapsed, name)
+    return result
+
+
+def _dynamodb():
+    # Client creation, endpoint resolution and the first connection
+    get_dynamodb().meta.client.describe_table(TableName=get_table('unit').name)
+
+
+def _graph():
+    # Opens the pooled TLS connection used by /authenticate, any
+    # response will do
+    authenticate.graph_session.head('https://graph.microsoft.com/v1.0/', timeout=5)
+
+
+def _prime(table_name, cache):
+    # Records every name in the table as looked up now in a validation
+    # cache, the scan is the lookup. Names missing from the scan keep the
+    # time of their own last lookup and expire with it, so a deleted name
+    # lasts no longer than the cache's TTL. A later lookup is kept.
+    table = get_table(table_name)
+    kwargs = {'ProjectionExpression':'#n', 'ExpressionAttributeNames':{'#n':'name'}}
+    looked_up = time.monotonic()
+    count = 0
+    while True:
+        response = table.scan(**kwargs)
+        for item in response['Items']:
+            if cache.get(item['name'], looked_up) <= looked_up:
+                cache[item['name']] = looked_up
+        count += len(response['Items'])
+        if not response.get('LastEvaluatedKey'):
+            return count
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def _roles():
+    # Fills the role existence cache used by member validation
+    return _prime('role', rest.ExistingRoleSet.known_roles)
+
+
+def _units():
+    # Fills the unit existence cache used by validation
+    return _prime('unit', rest.ExistingUnit.known_units)
+
+
+def _unit_lookup():
+    # The query path used by the list endpoints
+    get_table('member').query(IndexName='member_unit',
+                              KeyConditionExpression=Key('unit').eq('~warm'), Limit=1)
+
+
+def _schemas():
+    for resource in rest.DynamoResource.__subclasses__():
+        if resource.schema is not None:
+            rest.compile_schema(resource.schema).instance()
+
+
+def _jwt():
+    # Same calls as issue_token and AuthMiddleware
+    claims = {'member_id':'0', 'iss':'sms-page', 'exp':int(time.time())+60}
+    token = jwt.encode(claims, authenticate.token_secret, algorithm='HS256')
+    jwt.decode(token, authenticate.token_secret, algorithms=['HS256'], issuer='sms-page')
+
+
+steps = [
+    ('dynamodb', _dynamodb),
+    ('graph', _graph),
+    ('roles', _roles),
+    ('units', _units),
+    ('unit_lookup', _unit_lookup),
+    ('schemas', _schemas),
+    ('jwt', _jwt),
+]
+
+
+def warm(event=None, context=None):
+    # zappa event handler, returns and logs the time taken by each step
+    global _warmed # pylint: disable=global-statement
+    start = time.perf_counter()
+    report = {'cold':not _warmed, 'steps':{}, 'errors':{}}
+    for (name, func) in steps:
+        _step(report, name, func)
+    report['total'] = round(time.perf_counter() - start, 4)
+    _warmed = True
+    logging.getLogger(__name__).info('Warm up: %s', report)
+    return report